@@ -1,1210 +1,727 @@
 import streamlit as st
-
 import os
-
-import asyncio
-
+import sys
 import json
-
-import nest_asyncio
-
 import time
-
+import uuid
 import shutil
-
 import zipfile
-
-import re
-
-import base64
-
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
-
-from gtts import gTTS
-
-import google.generativeai as genai
-
-from google.api_core import exceptions
-
-import requests
-
-from bs4 import BeautifulSoup
-
-import edge_tts
-
 import streamlit.components.v1 as components
-
-from PIL import Image
-
-
-
-# 非同期処理の適用
-
-nest_asyncio.apply()
-
-
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from artifact_store import ArtifactStore, StoredFile
+from menu_catalog import MenuCatalog, input_fingerprint
+from tts_loop import TTSLoop
+from segment_cache import SegmentCache
+from dictionary_index import DictionaryIndex
+from pdf_input import is_pdf, page_count, read_pdf, make_executor
+from cancellation import CancelToken, cancel_usage, remove_partial, wait_for
+from mem_profile import MemoryProfiler
+from menu_json import json_usage
+from menu_pipeline import (
+    MENU_TEXT_TOKEN_BUDGET, VOICE_OPTIONS,
+    sanitize_filename, make_thumbnail_bytes, estimate_tokens, fetch_text_from_url,
+    list_generate_models, create_model, build_menu_prompt, generate_with_retry, read_menu_json, MENU_SCHEMA,
+    image_part, analyze_batch, analyze_in_batches, merge_categories,
+    build_intro_segments, intro_track_title, translate_menu, presynthesize_intro, process_all_tracks_fast,
+    write_standalone_html_player, write_zip, write_streaming_export, build_preview_html,
+)
 
 # ページ設定
-
 st.set_page_config(page_title="Menu Player Generator", layout="wide")
 
-
-
 # CSSでボタンのスタイル調整（間隔確保）
-
 st.markdown("""
-
 <style>
-
     div[data-testid="column"] {
-
         margin-bottom: 10px;
-
     }
-
 </style>
-
 """, unsafe_allow_html=True)
 
-
-
 # --- 辞書ファイルの管理 ---
-
 DICT_FILE = "my_dictionary.json"
 
-
-
 def load_dictionary():
-
     if os.path.exists(DICT_FILE):
-
         with open(DICT_FILE, "r", encoding="utf-8") as f:
-
             return json.load(f)
-
     return {}
 
-
-
 def save_dictionary(new_dict):
-
     with open(DICT_FILE, "w", encoding="utf-8") as f:
-
         json.dump(new_dict, f, ensure_ascii=False, indent=2)
 
-
-
-# --- 関数定義 ---
-
-def sanitize_filename(name):
-
-    return re.sub(r'[\\/*?:"<>|]', "", name).replace(" ", "_").replace("　", "_")
-
-
-
-def fetch_text_from_url(url):
-
+def dictionary_version():
     try:
+        stat = os.stat(DICT_FILE)
+        return f"{stat.st_mtime_ns}_{stat.st_size}"
+    except OSError:
+        return ""
+
+# 検索用のインデックスは、辞書ファイルが変わったときだけ作り直す（全セッション共通）
+@st.cache_resource(max_entries=1, show_spinner=False)
+def get_dictionary_index(version):
+    return DictionaryIndex(load_dictionary())
+
+DICT_PAGE_SIZE = 50
+
+def reset_dictionary_page():
+    st.session_state.dict_page = 1
+
+# --- セッションごとの生成物ストア ---
+@st.cache_resource
+def get_artifact_store():
+    return ArtifactStore()
+
+# --- 音声合成用の共有イベントループ（全セッションで1つ） ---
+@st.cache_resource
+def get_tts_loop():
+    return TTSLoop()
+
+# 「はじめに・目次」の定型文の音声（全セッションで共有）
+@st.cache_resource
+def get_segment_cache():
+    return SegmentCache()
+
+# edge-tts の接続プール（全セッションで共有）。edge_tts・aiohttp の読み込みを初回表示から外すため、使うときに作る
+# edge_tts の内部が変わって読み込めないときは、プールを使わない
+@st.cache_resource
+def get_tts_pool():
+    try: from tts_pool import TTSPool, TTS_POOL_SIZE
+    except ImportError: return None
+    return TTSPool() if TTS_POOL_SIZE > 0 else None
+
+# AI解析や書き出しを行うスレッド（全セッションで共有）
+BACKGROUND_WORKERS = 32
+
+@st.cache_resource
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="menu-run")
+
+# fn() を別スレッドで実行して結果を返す。このスレッドは経過秒数と、届いた再試行の知らせ（notes）を表示しながら待つ
+# （st の呼び出しのたびに、中止ボタン・再実行・ページ移動・切断を Streamlit から例外で知らされるので、待つ間も画面を更新し続ける）
+def run_in_background(token, status, label, fn, notes=None, on_note=None):
+    t0 = time.monotonic()
+    def on_wait():
+        status.caption(f"⏳ {label}（{time.monotonic() - t0:.0f}秒）")
+        if notes and on_note:
+            on_note(notes[-1])
+            notes.clear()
+    result = wait_for(get_background_executor().submit(fn), token, on_wait)
+    status.empty()
+    return result
+
+def get_session_artifacts():
+    ctx = get_script_run_ctx()
+    return get_artifact_store().session(ctx.session_id if ctx else "local")
+
+def render_memory_usage(artifacts, slot):
+    usage = get_artifact_store().usage()
+    tts = get_tts_loop().usage()
+    segments = get_segment_cache().usage()
+    # 接続プールは、どこかのセッションで合成したあとだけ表示する
+    pool = get_tts_pool() if "tts_pool" in sys.modules else None
+    connections = f"・接続の再利用 {pool.usage()['reused']}回" if pool else ""
+    cancelled = cancel_usage()
+    parsed = json_usage()
+    mb = lambda n: f"{n / (1024 * 1024):.1f}MB"
+    slot.caption(
+        f"💾 このセッション: メモリ {mb(artifacts.memory_bytes)} / ディスク {mb(artifacts.disk_bytes)}  \n"
+        f"全体 ({usage['sessions']}セッション): メモリ {mb(usage['memory_bytes'])} / 上限 {mb(usage['memory_budget'])}  \n"
+        f"🔊 音声合成: 実行中 {tts['active']} / 上限 {tts['concurrency']}・待ち {tts['waiting']}・定型文の再利用 {segments['hits']}回{connections}"
+        + (f"  \n⏹ 中止: {cancelled['runs']}回（AI {cancelled['llm_calls']}回・音声 {cancelled['tts_tasks']}件を取り消し、"
+           f"途中のファイル {cancelled['files']}個・{mb(cancelled['bytes'])}を削除）" if cancelled["runs"] else "")
+        + (f"  \n🧩 AIの出力: {parsed['responses']}回のうち 修復 {parsed['repaired']}回・途中で切れた {parsed['truncated']}回"
+           f"（続きの取得 {parsed['continuations']}回）・読み取れず {parsed['failed']}回"
+           if parsed["responses"] > parsed["clean"] else "")
+    )
 
-        headers = {'User-Agent': 'Mozilla/5.0'}
-
-        response = requests.get(url, headers=headers, timeout=10)
-
-        response.encoding = response.apparent_encoding
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        for s in soup(["script", "style", "header", "footer", "nav"]): s.extract()
-
-        text = soup.get_text(separator="\n")
-
-        lines = [line.strip() for line in text.splitlines() if line.strip()]
-
-        return "\n".join(lines)
-
-    except: return None
-
-
-
-async def generate_single_track_fast(text, filename, voice_code, rate_value):
-
-    for attempt in range(3):
-
-        try:
-
-            comm = edge_tts.Communicate(text, voice_code, rate=rate_value)
-
-            await comm.save(filename)
-
-            if os.path.exists(filename) and os.path.getsize(filename) > 0:
-
-                return True
-
-        except:
+# --- 作成履歴（カタログ）からの復元 ---
+# Webプレイヤーも作業領域へ複製する（作成履歴の側は、作り直しや削除で消えることがあるため）
+def restore_from_catalog(artifacts, catalog, entry, run_dir):
+    zip_path = catalog.write_zip(entry, os.path.join(run_dir, entry["zip_name"]))
+    return {
+        "zip_path": zip_path,
+        "zip_name": entry["zip_name"],
+        "html_path": shutil.copyfile(catalog.html_path(entry), os.path.join(run_dir, entry["html_name"])),
+        "html_name": entry["html_name"],
+        "tracks": catalog.tracks(entry),
+        "variants": catalog.variants(entry),
+        "from_catalog": entry["created_at"],
+    }
 
-            await asyncio.sleep(1)
+# プレビューのHTML（音声を埋め込むので大きい）は結果ごとに1回だけ作り、作業領域に置いておく
+def store_previews(artifacts, variants):
+    return [artifacts.put(build_preview_html(v["tracks"]).encode(), key=f"result_preview_{i}") for i, v in enumerate(variants)]
+
+# ストリーミング版（Webサーバーに置くと、チャプターの先頭から少しずつ読み込んで再生する）
+def store_stream_export(artifacts, run_dir, store_name, variants, map_url, zip_name, token=None):
+    export_dir = os.path.join(run_dir, "stream_export")
+    os.makedirs(export_dir)
+    # 作成履歴から復元したバリエーションには言語がないので、声の選択肢から補う
+    variants = [{**v, "lang": v.get("lang") or VOICE_OPTIONS.get(v["label"], ("", "ja"))[1]} for v in variants]
+    write_streaming_export(export_dir, store_name, variants, map_url, token)
+    zip_path = write_zip(os.path.join(run_dir, zip_name), export_dir, zipfile.ZIP_STORED, token)
+    return {"stream_path": zip_path, "stream_name": zip_name}
+
+# 作成の結果を確定する。ファイルは作成ごとのディレクトリにあるので、ここで登録を差し替えるまで前の結果のダウンロードは壊れない
+# 差し替えたら、前の作成のディレクトリ（音声など登録していないファイル）も消す
+def commit_result(artifacts, run_dir, result):
+    stream_path = result.pop("stream_path", None)
+    if stream_path: result["stream_key"] = artifacts.put_file(stream_path, key="result_stream")
+    else: artifacts.delete("result_stream")
+    result["zip_key"] = artifacts.put_file(result.pop("zip_path"), key="result_zip")
+    result["html_key"] = artifacts.put_file(result.pop("html_path"), key="result_html")
+    result["preview_keys"] = store_previews(artifacts, result["variants"])
+    st.session_state.generated_result = result
+    previous, st.session_state.result_run_dir = st.session_state.get("result_run_dir"), run_dir
+    if previous and previous != run_dir: shutil.rmtree(previous, ignore_errors=True)
 
+# --- 関数定義 ---
+# 画像確認グリッド用のサムネイル（内容のハッシュをキーに、再実行をまたいでキャッシュ）
+@st.cache_data(max_entries=300, show_spinner=False)
+def make_thumbnail(digest, _data):
+    return make_thumbnail_bytes(_data)
+
+def get_thumbnail(img_file):
+    data = img_file.getvalue()
+    try: return make_thumbnail(hashlib.sha1(data).hexdigest(), data)
+    except: return data
+
+# PDFのページ数（アップロード直後の表示用。中身のハッシュをキーにキャッシュ）
+@st.cache_data(max_entries=50, show_spinner=False)
+def get_pdf_page_count(digest, _data):
+    return page_count(_data)
+
+# PDFのページを画像にするワーカー（全セッションで共有）
+@st.cache_resource
+def get_pdf_executor():
+    return make_executor()
+
+# PDF: 文字情報のあるページはテキストで、それ以外は画像にしてAIへ渡す（ページごとにどちらで読んだかを表示する）
+# 読み込み（描画は最大 RENDER_TIMEOUT 秒）はバックグラウンドで行い、中止ボタンで待つのをやめられるようにする
+def load_pdfs(artifacts, pdf_files, token, status):
+    texts, images, rows = [], [], []
+    executor = get_pdf_executor()
     try:
-
-        def gtts_task():
-
-            tts = gTTS(text=text, lang='ja')
-
-            tts.save(filename)
-
-        await asyncio.to_thread(gtts_task)
-
-        return True
-
+        for f in pdf_files:
+            for page in run_in_background(token, status, f"{f.name} を読み込んでいます", partial(read_pdf, f.getvalue(), executor)):
+                label = f"{f.name} {page['page']}ページ"
+                if page["mode"] == "text":
+                    texts.append(f"[{label}]\n{page['text']}")
+                else:
+                    # 画像にしたページは解析のあいだだけ使う。キーを固定して、作成のたびに増えないようにする（解析後に release）
+                    images.append(StoredFile(artifacts, artifacts.put(page["image"], f"pdf_page_{len(images)}"), label, "image/jpeg"))
+                rows.append({"ファイル": f.name, "ページ": page["page"], "読み方": "テキスト" if page["mode"] == "text" else "画像", "理由": page["reason"]})
     except:
+        # 途中で中止・失敗したときは、読み込んだページをここで捨てる
+        for img in images: img.release()
+        raise
+    with st.expander(f"📄 PDF: テキスト {len(texts)}ページ・画像 {len(images)}ページ"):
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+    return "\n\n".join(texts), images
+
+# モデル一覧（APIへの問い合わせ）は再実行のたびに行わず、しばらくキャッシュする
+@st.cache_data(ttl=600, show_spinner=False)
+def get_generate_models(api_key):
+    return list_generate_models(api_key)
+
+def render_model_select(slot, valid_models):
+    default_idx = next((i for i, n in enumerate(valid_models) if "flash" in n), 0)
+    if st.session_state.get("target_model_name") in valid_models:
+        default_idx = valid_models.index(st.session_state.target_model_name)
+    st.session_state.target_model_name = slot.selectbox("使用するAIモデル", valid_models, index=default_idx)
+    return st.session_state.target_model_name
+
+def load_model_select(slot, api_key):
+    # モデル一覧を取得してモデル選択を描画し、選ばれたモデルを返す（取得できなければ None）
+    try: valid_models = get_generate_models(api_key)
+    except: return None
+    if not valid_models: return None
+    st.session_state.valid_models = {api_key: valid_models}
+    return render_model_select(slot, valid_models)
+
+# モデルの振り分け（応答時間・利用上限の記録）はAPIキーごとに全セッションで共有する
+@st.cache_resource(show_spinner=False)
+def get_model_router(api_key):
+    from model_router import ModelRouter
+    return ModelRouter(partial(create_model, api_key))
+
+# プレビュー用プレイヤー（結果ごとに作っておいたHTMLファイルを読んで表示する）
+def render_preview_player(html_path):
+    with open(html_path, "r", encoding="utf-8") as f:
+        components.html(f.read(), height=450)
+
+# 辞書・カメラ・結果の各パネルはフラグメントにして、操作してもそのパネルだけを再実行する
+@st.fragment
+def dictionary_manager():
+    st.caption("よく間違える読み方を登録すると、AIが学習します。(例: 豚肉 -> ぶたにく)")
 
-        return False
-
-
-
-async def process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar):
-
-    tasks = []
-
-    track_info_list = []
-
-    for i, track in enumerate(menu_data):
-
-        safe_title = sanitize_filename(track['title'])
-
-        filename = f"{i+1:02}_{safe_title}.mp3"
-
-        save_path = os.path.join(output_dir, filename)
-
-        speech_text = track['text']
+    # 新規登録
+    with st.form("dict_form", clear_on_submit=True):
+        c_word, c_read = st.columns(2)
+        new_word = c_word.text_input("単語", placeholder="例: 辛口")
+        new_read = c_read.text_input("読み", placeholder="例: からくち")
+        if st.form_submit_button("➕ 追加"):
+            if new_word and new_read:
+                user_dict = load_dictionary()
+                user_dict[new_word] = new_read
+                save_dictionary(user_dict)
+                st.success(f"「{new_word}」を登録しました！")
+                st.rerun(scope="fragment")
+
+    # 登録済みリスト：検索して、表示中のページの分だけを表にする（チェックした語をまとめて削除）
+    version = dictionary_version()
+    index = get_dictionary_index(version)
+    if not len(index): return
+    with st.expander(f"登録済み単語 ({len(index)})"):
+        c_query, c_mode = st.columns([3, 2], vertical_alignment="center")
+        query = c_query.text_input("検索", placeholder="🔍 単語・読みで検索", key="dict_query", on_change=reset_dictionary_page, label_visibility="collapsed")
+        substring = c_mode.toggle("部分一致", key="dict_substring", on_change=reset_dictionary_page, help="オフのときは前方一致で探します。")
+        hits = index.search(query, substring)
+        if not hits:
+            st.caption("見つかりませんでした。")
+            return
+        pages = (len(hits) - 1) // DICT_PAGE_SIZE + 1
+        if st.session_state.get("dict_page", 1) > pages: st.session_state.dict_page = pages
+        page = st.number_input(f"ページ（全{pages}ページ・{len(hits)}語）", min_value=1, max_value=pages, key="dict_page") if pages > 1 else 1
+        select_all = st.checkbox("このページをすべて選択", key=f"dict_all_{version}_{query}_{substring}_{page}")
+        rows = [{"削除": select_all, "単語": word, "読み": read} for word, read in map(index.entry, hits[(page - 1) * DICT_PAGE_SIZE:page * DICT_PAGE_SIZE])]
+        edited = st.data_editor(rows, key=f"dict_editor_{version}_{query}_{substring}_{page}_{select_all}", hide_index=True, disabled=["単語", "読み"], use_container_width=True)
+        selected = [row["単語"] for row in edited if row["削除"]]
+        if st.button(f"🗑️ 選択した{len(selected)}語を削除", disabled=not selected, use_container_width=True):
+            user_dict = load_dictionary()
+            for word in selected: user_dict.pop(word, None)
+            save_dictionary(user_dict)
+            st.rerun(scope="fragment")
+
+def render_image_grid(images, editable=False):
+    st.markdown("###### ▼ 画像確認")
+    cols_per_row = 3
+    for i in range(0, len(images), cols_per_row):
+        cols = st.columns(cols_per_row, gap="medium")
+        batch = images[i:i+cols_per_row]
+        for j, img in enumerate(batch):
+            global_idx = i + j
+            with cols[j]:
+                st.image(get_thumbnail(img), caption=f"No.{global_idx+1}", use_container_width=True)
+                if editable:
+                    c_retake, c_delete = st.columns(2, gap="small")
+                    with c_retake:
+                        if st.button("🔄 撮り直す", key=f"btn_retake_{global_idx}", use_container_width=True):
+                            st.session_state.retake_index = global_idx
+                            st.session_state.show_camera = True
+                            st.rerun(scope="fragment")
+                    with c_delete:
+                        if st.button("🗑️ 削除", key=f"btn_delete_{global_idx}", use_container_width=True):
+                            st.session_state.captured_images.pop(global_idx).release()
+                            st.session_state.retake_index = None
+                            st.session_state.show_camera = False
+                            st.rerun(scope="fragment")
 
+@st.fragment
+def camera_panel(artifacts):
+    if st.session_state.retake_index is not None:
+        target_idx = st.session_state.retake_index
+        st.warning(f"No.{target_idx + 1} の画像を再撮影中...")
+        retake_camera_key = f"retake_camera_{target_idx}_{st.session_state.camera_key}"
+        camera_file = st.camera_input("写真を撮影する (取り直し)", key=retake_camera_key)
         
+        c1, c2 = st.columns(2, gap="large")
+        with c1:
+            if camera_file and st.button("✅ これで決定", type="primary", key="retake_confirm", use_container_width=True):
+                st.session_state.captured_images[target_idx].release()
+                st.session_state.captured_images[target_idx] = StoredFile.from_upload(artifacts, camera_file)
+                st.session_state.retake_index = None
+                st.session_state.show_camera = False 
+                st.session_state.camera_key += 1
+                st.rerun(scope="fragment")
+        with c2:
+            if st.button("❌ キャンセル", key="retake_cancel", use_container_width=True):
+                st.session_state.retake_index = None
+                st.session_state.show_camera = False
+                st.rerun(scope="fragment")
 
-        # i=0 (はじめに) は番号なし
-
-        # i=1 (最初の料理) を「1番」とする
-
-        if i > 0: 
-
-             speech_text = f"{i}、{track['title']}。\n{track['text']}"
-
-             
-
-        tasks.append(generate_single_track_fast(speech_text, save_path, voice_code, rate_value))
-
-        track_info_list.append({"title": track['title'], "path": save_path})
+    elif not st.session_state.show_camera:
+        if st.button("📷 カメラ起動", type="primary"):
+            st.session_state.show_camera = True
+            st.rerun(scope="fragment")
+    else:
+        camera_file = st.camera_input("写真を撮影する", key=f"camera_{st.session_state.camera_key}")
+        if camera_file:
+            c_btn1, c_btn2 = st.columns(2, gap="large")
+            with c_btn1:
+                if st.button("⬇️ 追加して次を撮る", type="primary", use_container_width=True):
+                    st.session_state.captured_images.append(StoredFile.from_upload(artifacts, camera_file))
+                    st.session_state.camera_key += 1
+                    st.rerun(scope="fragment")
+            with c_btn2:
+                if st.button("✅ 追加して終了", type="primary", use_container_width=True):
+                    st.session_state.captured_images.append(StoredFile.from_upload(artifacts, camera_file))
+                    st.session_state.show_camera = False
+                    st.session_state.camera_key += 1
+                    st.rerun(scope="fragment")
+        else:
+            if st.button("❌ 撮影を中止", use_container_width=True):
+                st.session_state.show_camera = False
+                st.rerun(scope="fragment")
+            
+    if st.session_state.captured_images:
+        if st.session_state.retake_index is None and st.session_state.show_camera is False:
+             if st.button("🗑️ 全て削除"):
+                for f in st.session_state.captured_images: f.release()
+                st.session_state.captured_images = []
+                st.rerun(scope="fragment")
+        if st.session_state.retake_index is None:
+            render_image_grid(st.session_state.captured_images, editable=True)
 
+@st.fragment
+def result_section(artifacts):
+    res = st.session_state.generated_result
+    if not res: return
+    st.divider()
+    st.subheader("▶️ プレビュー")
+    if res.get("from_catalog"):
+        st.info(f"📚 作成履歴（{res['from_catalog'][:16].replace('T', ' ')} 作成）から復元しました。AI解析・音声生成は行っていません。")
+    variants = res.get("variants") or [{"label": "", "tracks": res["tracks"]}]
+    idx = 0
+    if len(variants) > 1:
+        labels = [v["label"] for v in variants]
+        idx = labels.index(st.radio("声・言語", labels, horizontal=True))
+    render_preview_player(artifacts.path(res["preview_keys"][idx]))
+    st.divider()
+    st.subheader("📥 保存")
     
-
-    total = len(tasks)
-
-    completed = 0
-
-    for task in asyncio.as_completed(tasks):
-
-        await task
-
-        completed += 1
-
-        progress_bar.progress(completed / total)
-
-    return track_info_list
-
-
-
-# HTMLプレイヤー生成
-
-def create_standalone_html_player(store_name, menu_data, map_url=""):
-
-    playlist_js = []
-
-    for track in menu_data:
-
-        file_path = track['path']
-
-        if os.path.exists(file_path):
-
-            with open(file_path, "rb") as f:
-
-                b64_data = base64.b64encode(f.read()).decode()
-
-                playlist_js.append({"title": track['title'], "src": f"data:audio/mp3;base64,{b64_data}"})
-
-    playlist_json_str = json.dumps(playlist_js, ensure_ascii=False)
-
+    st.info(
+        """
+        **Webプレイヤー**：アクセシビリティ対応済みのHTMLファイルです。スマホへの保存やLINE共有に便利です。  
+        **ZIPファイル**：PCでの保存や、My Menu Bookへの追加にご利用ください。
+        """
+    )
     
+    # ファイルの中身は押されたときに作業領域から読む（再描画のたびにメモリへ載せない）
+    # ダウンロードしてもアプリは再実行しない
+    c1, c2 = st.columns(2)
+    with c1: st.download_button(f"🌐 Webプレイヤー ({res['html_name']})", partial(artifacts.get, res['html_key']), res['html_name'], "text/html", type="primary", on_click="ignore")
+    with c2: st.download_button(f"📦 ZIPファイル ({res['zip_name']})", data=partial(artifacts.get, res['zip_key']), file_name=res['zip_name'], mime="application/zip", on_click="ignore")
+    if res.get("stream_key") and artifacts.exists(res["stream_key"]):
+        st.caption("**ストリーミング版**：Webサーバーに展開して index.html を開くと、チャプターの先頭から少しずつ読み込んで再生します。通信が遅い環境でもすぐに再生が始まります。")
+        st.download_button(f"📡 ストリーミング版 ({res['stream_name']})", data=partial(artifacts.get, res['stream_key']), file_name=res['stream_name'], mime="application/zip", on_click="ignore")
+
+# 中止ボタン: 押すとStreamlitが実行中の作成を止めて再実行するので、次の実行で中止したことを表示する
+def request_cancel():
+    st.session_state.generation_cancelled = True
+
+# 作成を失敗として止める（残りの処理は取り消すが、中止としては数えない）
+def stop_generation(token, cancel_slot, message):
+    token.cancel(count=False)
+    cancel_slot.empty()
+    st.error(message)
+    st.stop()
 
-    map_button_html = ""
+# --- UI ---
+with st.sidebar:
+    st.header("🔧 設定")
+    if "GEMINI_API_KEY" in st.secrets:
+        api_key = st.secrets["GEMINI_API_KEY"]
+        st.success("🔑 APIキー認証済み")
+    else:
+        api_key = st.text_input("Gemini APIキー", type="password")
+    
+    # モデル選択: このセッションで一覧を取得済みならここで描画する
+    # まだなら（初回）、google.generativeaiの読み込みとモデル一覧の取得が要るので、画面の最後か作成開始のときに描画する
+    model_slot = st.empty()
+    target_model_name = None
+    if api_key and st.session_state.get("valid_models", {}).get(api_key):
+        target_model_name = render_model_select(model_slot, st.session_state.valid_models[api_key])
+
+    batch_mode = st.toggle("写真を分割して並列解析", help="写真が多いメニュー（10枚以上など）向け。数枚ずつ同時に解析し、最後にカテゴリーを統合します。")
+    if batch_mode:
+        c_bs, c_cc = st.columns(2)
+        batch_size = c_bs.number_input("1回の枚数", min_value=1, max_value=10, value=4)
+        batch_concurrency = c_cc.number_input("同時実行数", min_value=1, max_value=8, value=3)
+    
+    st.divider()
+    st.subheader("🗣️ 音声設定")
+    selected_voices = st.multiselect("声の種類・言語", list(VOICE_OPTIONS.keys()), default=["女性（七海）"], help="複数選ぶと、1回の解析から声・言語ごとの音声をまとめて作成し、プレイヤーで切り替えられます。")
+    rate_value = "+10%"
 
-    if map_url:
+    # --- 辞書機能 (Sidebar) ---
+    st.divider()
+    st.subheader("📖 辞書登録")
+    dictionary_manager()
 
-        map_button_html = f"""
+    # 使用状況: ここで描画しておき（作成の途中で止まっても残る）、最後に最新の値に更新する
+    st.divider()
+    usage_slot = st.empty()
 
-        <div style="text-align:center; margin-bottom: 15px;">
+st.title("🎧 Menu Player Generator")
+st.caption("視覚障がいのある方のための、アクセシビリティに配慮した音声メニューを作成します。")
 
-            <a href="{map_url}" target="_blank" role="button" aria-label="地図・アクセス（Googleマップが別タブで開きます）" class="map-btn">
+# 再撮影する画像のインデックスを保持するstate
+if 'retake_index' not in st.session_state: st.session_state.retake_index = None
+if 'captured_images' not in st.session_state: st.session_state.captured_images = []
+if 'camera_key' not in st.session_state: st.session_state.camera_key = 0
+if 'generated_result' not in st.session_state: st.session_state.generated_result = None
+if 'show_camera' not in st.session_state: st.session_state.show_camera = False
 
-                🗺️ 地図・アクセス (Google Map)
+# 撮影画像・生成結果の実体はストア側にあるので、破棄済み（長時間放置など）の参照を外す
+artifacts = get_session_artifacts()
+catalog = MenuCatalog()
+st.session_state.captured_images = [f for f in st.session_state.captured_images if f.exists()]
+res = st.session_state.generated_result
+if res and not (artifacts.exists(res['zip_key']) and artifacts.exists(res['html_key'])):
+    st.session_state.generated_result = None
+render_memory_usage(artifacts, usage_slot)
 
-            </a>
+# Step 1
+st.markdown("### 1. お店情報の入力")
+c1, c2 = st.columns(2)
+with c1: store_name = st.text_input("🏠 店舗名（必須）", placeholder="例：カフェタナカ")
+with c2: menu_title = st.text_input("📖 今回のメニュー名 （任意）", placeholder="例：ランチ")
 
-        </div>
+map_url = st.text_input("📍 GoogleマップのURL（任意）", placeholder="例：https://maps.app.goo.gl/...")
+if map_url:
+    st.caption("※プレイヤーに地図へのアクセスボタンが表示されます。")
 
-        """
+st.markdown("---")
 
+st.markdown("### 2. メニューの登録")
+input_method = st.radio("方法", ("📂 アルバムから", "📷 その場で撮影", "🌐 URL入力"), horizontal=True)
 
+final_image_list = []
+pdf_files = []
+target_url = None
 
-    html_template = """<!DOCTYPE html>
+if input_method == "📂 アルバムから":
+    uploaded_files = st.file_uploader("写真・PDFを選択", type=['png', 'jpg', 'jpeg', 'pdf'], accept_multiple_files=True)
+    for f in uploaded_files or []:
+        (pdf_files if is_pdf(f) else final_image_list).append(f)
+    if final_image_list: render_image_grid(final_image_list)
+    for f in pdf_files:
+        try:
+            data = f.getvalue()
+            st.caption(f"📄 {f.name}（{get_pdf_page_count(hashlib.sha1(data).hexdigest(), data)}ページ）")
+        except Exception: st.warning(f"{f.name} はPDFとして開けませんでした。")
+    if pdf_files:
+        st.caption("PDFは、文字情報のあるページをテキストとして、それ以外のページを画像として読み込みます。")
 
-<html lang="ja"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>__STORE_NAME__ 音声メニュー</title>
+elif input_method == "📷 その場で撮影":
+    camera_panel(artifacts)
+    # 撮影済みの画像は、カメラのパネル内で追加・削除されてもsession_stateから最新を読む
+    final_image_list.extend(st.session_state.captured_images)
 
-<style>
+elif input_method == "🌐 URL入力":
+    target_url = st.text_input("URL", placeholder="https://...")
+    url_token_budget = st.number_input("解析に使う最大トークン数", min_value=1000, max_value=30000, value=MENU_TEXT_TOKEN_BUDGET, step=1000, help="ページの中からメニューらしい部分（価格・品目の並び・表やリスト）を優先して、この量まで使います。")
 
-body{font-family:sans-serif;background:#f4f4f4;margin:0;padding:20px;line-height:1.6;}
+st.markdown("---")
 
-.c{max-width:600px;margin:0 auto;background:#fff;padding:20px;border-radius:15px;box-shadow:0 2px 10px rgba(0,0,0,0.1);}
+st.markdown("### 3. 音声メニューの作成")
+disable_create = st.session_state.retake_index is not None
+force_regenerate = st.checkbox("作成履歴を使わずに作り直す", help="同じ写真・URL・設定で作成済みのメニューがあると、通常はAI解析と音声生成をせずにそれを使います。")
+stream_export = st.checkbox("ストリーミング版も作成（Webサーバー公開用）", help="音声を約2秒ずつに分けたWebプレイヤー一式をZIPで作ります。サーバーに置くと、通信が遅くてもチャプターの再生がすぐに始まります。")
+profiler = MemoryProfiler(enabled=False)
+if st.session_state.pop("generation_cancelled", False):
+    st.warning("⏹ 作成を中止しました。途中まで作ったファイルは削除しました。")
+if st.button("🎙️ 作成開始", type="primary", use_container_width=True, disabled=disable_create):
+    if api_key and not target_model_name: target_model_name = load_model_select(model_slot, api_key)
+    if not (api_key and target_model_name and store_name):
+        st.error("設定や店舗名を確認してください"); st.stop()
+    if not (final_image_list or pdf_files or target_url):
+        st.warning("画像かURLを入力してください"); st.stop()
+    if not selected_voices:
+        st.warning("声を1つ以上選んでください"); st.stop()
+    if st.session_state.retake_index is not None:
+        st.warning("撮り直しを終えてから作成してください"); st.stop()
+    user_dict = load_dictionary()
+    # MENU_PLAYER_PROFILE=1 のときだけ、段階ごとのメモリを記録する（プレビューの表示まで）
+    profiler = MemoryProfiler(label=sanitize_filename(store_name))
 
-h1{text-align:center;font-size:1.5em;color:#333;margin-bottom:10px;}
-
-h2{font-size:1.2em;color:#555;margin-top:20px;margin-bottom:10px;border-bottom:2px solid #eee;padding-bottom:5px;}
-
-.box{background:#fff5f5;border:2px solid #ff4b4b;border-radius:10px;padding:15px;text-align:center;margin-bottom:20px;}
-
-.ti{font-size:1.3em;font-weight:bold;color:#b71c1c;}
-
-.ctrl{display:flex;gap:15px;margin:20px 0;justify-content:center;}
-
-button{
-
-    flex:1;
-
-    padding:15px 0;
-
-    font-size:1.8em; 
-
-    font-weight:bold;
-
-    color:#fff;
-
-    background:#ff4b4b; 
-
-    border:none;
-
-    border-radius:8px; 
-
-    cursor:pointer;
-
-    min-height:60px;
-
-    display:flex; justify-content:center; align-items:center;
-
-    transition:background 0.2s;
-
-}
-
-button:hover{background:#e04141;}
-
-button:focus, .map-btn:focus, select:focus, .itm:focus{outline:3px solid #333; outline-offset: 2px;}
-
-.map-btn{display:inline-block; padding:12px 20px; background-color:#4285F4; color:white; text-decoration:none; border-radius:8px; font-weight:bold; box-shadow:0 2px 5px rgba(0,0,0,0.2);}
-
-.lst{border-top:1px solid #eee;padding-top:10px;}
-
-.itm{padding:15px;border-bottom:1px solid #eee;cursor:pointer; font-size:1.1em;}
-
-.itm:hover{background:#f9f9f9;}
-
-.itm.active{background:#ffecec;color:#b71c1c;font-weight:bold;border-left:5px solid #ff4b4b;}
-
-</style></head>
-
-<body>
-
-<main class="c" role="main">
-
-    <h1>🎧 __STORE_NAME__</h1>
-
-    __MAP_BUTTON__
-
-    <section aria-label="再生状況">
-
-        <div class="box"><div class="ti" id="ti" aria-live="polite">Loading...</div></div>
-
-    </section>
-
-    <audio id="au" style="width:100%" aria-label="メニュー読み上げプレイヤー"></audio>
-
-    <section class="ctrl" aria-label="再生コントロール">
-
-        <button onclick="prev()" aria-label="前のチャプターへ">⏮</button>
-
-        <button onclick="toggle()" id="pb" aria-label="再生">▶</button>
-
-        <button onclick="next()" aria-label="次のチャプターへ">⏭</button>
-
-    </section>
-
-    <div style="text-align:center;margin-bottom:20px;">
-
-        <label for="sp" style="font-weight:bold; margin-right:5px;">読み上げ速度:</label>
-
-        <select id="sp" onchange="csp()" style="font-size:1rem; padding:5px;">
-
-            <option value="0.8">0.8 (ゆっくり)</option>
-
-            <option value="1.0" selected>1.0 (標準)</option>
-
-            <option value="1.2">1.2 (やや速い)</option>
-
-            <option value="1.5">1.5 (速い)</option>
-
-        </select>
-
-    </div>
-
-    <h2>📜 チャプター一覧</h2>
-
-    <div id="ls" class="lst" role="list" aria-label="メニューのチャプター一覧"></div>
-
-</main>
-
-<script>
-
-const pl=__PLAYLIST_JSON__;let idx=0;
-
-const au=document.getElementById('au');
-
-const ti=document.getElementById('ti');
-
-const pb=document.getElementById('pb');
-
-function init(){ren();ld(0);csp();}
-
-function ld(i){
-
-    idx=i;
-
-    au.src=pl[idx].src;
-
-    ti.innerText=pl[idx].title;
-
-    ren();
-
-    csp();
-
-}
-
-function toggle(){
-
-    if(au.paused){
-
-        au.play();
-
-        pb.innerText="⏸";
-
-        pb.setAttribute("aria-label", "一時停止");
-
-    }else{
-
-        au.pause();
-
-        pb.innerText="▶";
-
-        pb.setAttribute("aria-label", "再生");
-
-    }
-
-}
-
-function next(){
-
-    if(idx<pl.length-1){
-
-        ld(idx+1);
-
-        au.play();
-
-        pb.innerText="⏸";
-
-        pb.setAttribute("aria-label", "一時停止");
-
-    }
-
-}
-
-function prev(){
-
-    if(idx>0){
-
-        ld(idx-1);
-
-        au.play();
-
-        pb.innerText="⏸";
-
-        pb.setAttribute("aria-label", "一時停止");
-
-    }
-
-}
-
-function csp(){au.playbackRate=parseFloat(document.getElementById('sp').value);}
-
-au.onended=function(){
-
-    if(idx<pl.length-1){ next(); }
-
-    else { pb.innerText="▶"; pb.setAttribute("aria-label", "再生");}
-
-};
-
-function ren(){
-
-    const d=document.getElementById('ls');
-
-    d.innerHTML="";
-
-    pl.forEach((t,i)=>{
-
-        const m=document.createElement('div');
-
-        m.className="itm "+(i===idx?"active":"");
-
-        m.setAttribute("role", "listitem");
-
-        m.setAttribute("tabindex", "0");
-
-        
-
-        let label = t.title;
-
-        if(i > 0){ label = i + ". " + t.title; }
-
-        
-
-        m.setAttribute("aria-label", label);
-
-        m.innerText=label;
-
-        m.onclick=()=>{ld(i);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");};
-
-        m.onkeydown=(e)=>{if(e.key==='Enter'||e.key===' '){e.preventDefault();d.click();}};
-
-        d.appendChild(m);
-
-    });
-
-}
-
-init();
-
-</script></body></html>"""
-
-    final_html = html_template.replace("__STORE_NAME__", store_name)
-
-    final_html = final_html.replace("__PLAYLIST_JSON__", playlist_json_str)
-
-    final_html = final_html.replace("__MAP_BUTTON__", map_button_html)
-
-    return final_html
-
-
-
-# プレビュー用プレイヤー
-
-def render_preview_player(tracks):
-
-    playlist_data = []
-
-    for track in tracks:
-
-        if os.path.exists(track['path']):
-
-            with open(track['path'], "rb") as f:
-
-                b64 = base64.b64encode(f.read()).decode()
-
-                playlist_data.append({"title": track['title'],"src": f"data:audio/mp3;base64,{b64}"})
-
-    playlist_json = json.dumps(playlist_data)
-
-    
-
-    html_template = """<!DOCTYPE html><html><head><style>
-
-    body{margin:0;padding:0;font-family:sans-serif;}
-
-    .p-box{border:2px solid #e0e0e0;border-radius:12px;padding:15px;background:#fcfcfc;text-align:center;}
-
-    .t-ti{font-size:18px;font-weight:bold;color:#333;margin-bottom:10px;padding:10px;background:#fff;border-radius:8px;border-left:5px solid #ff4b4b;}
-
-    .ctrls{display:flex; gap:10px; margin:15px 0;}
-
-    button {
-
-        flex: 1;
-
-        background-color: #ff4b4b; color: white; border: none;
-
-        border-radius: 8px; font-size: 24px; padding: 10px 0;
-
-        cursor: pointer; line-height: 1; min-height: 50px;
-
-    }
-
-    button:hover { background-color: #e04141; }
-
-    button:focus { outline: 3px solid #333; outline-offset: 2px; }
-
-    .lst{text-align:left;max-height:150px;overflow-y:auto;border-top:1px solid #eee;margin-top:10px;padding-top:5px;}
-
-    .it{padding:8px;border-bottom:1px solid #eee;cursor:pointer;font-size:14px;}
-
-    .it:focus{outline:2px solid #333; background:#eee;}
-
-    .it.active{color:#b71c1c;font-weight:bold;background:#ffecec;}
-
-    </style></head><body><div class="p-box"><div id="ti" class="t-ti">...</div><audio id="au" controls style="width:100%;height:30px;"></audio>
-
-    <div class="ctrls">
-
-        <button onclick="pv()" aria-label="前へ">⏮</button>
-
-        <button onclick="tg()" id="pb" aria-label="再生">▶</button>
-
-        <button onclick="nx()" aria-label="次へ">⏭</button>
-
-    </div>
-
-    <div style="font-size:12px;color:#666; margin-top:5px;">
-
-        速度:<select id="sp" onchange="sp()"><option value="0.8">0.8</option><option value="1.0" selected>1.0</option><option value="1.2">1.2</option><option value="1.5">1.5</option></select>
-
-    </div>
-
-    <div id="ls" class="lst" role="list"></div></div>
-
-    <script>
-
-    const pl=__PLAYLIST__;let x=0;const au=document.getElementById('au');const ti=document.getElementById('ti');const pb=document.getElementById('pb');const ls=document.getElementById('ls');
-
-    function init(){rn();ld(0);sp();}
-
-    function ld(i){x=i;au.src=pl[x].src;ti.innerText=pl[x].title;rn();sp();}
-
-    function tg(){if(au.paused){au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");}else{au.pause();pb.innerText="▶";pb.setAttribute("aria-label","再生");}}
-
-    function nx(){if(x<pl.length-1){ld(x+1);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");}}
-
-    function pv(){if(x>0){ld(x-1);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");}}
-
-    function sp(){au.playbackRate=parseFloat(document.getElementById('sp').value);}
-
-    au.onended=function(){if(x<pl.length-1)nx();else{pb.innerText="▶";pb.setAttribute("aria-label","再生");}};
-
-    function rn(){ls.innerHTML="";pl.forEach((t,i)=>{
-
-        const d=document.createElement('div');
-
-        d.className="it "+(i===x?"active":"");
-
-        let l=t.title; if(i>0){l=i+". "+t.title;}
-
-        d.innerText=l;
-
-        d.setAttribute("role","listitem");d.setAttribute("tabindex","0");d.onclick=()=>{ld(i);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");};d.onkeydown=(e)=>{if(e.key==='Enter'||e.key===' '){e.preventDefault();d.click();}};ls.appendChild(d);});}
-
-    init();</script></body></html>"""
-
-    final_html = html_template.replace("__PLAYLIST__", playlist_json)
-
-    components.html(final_html, height=450)
-
-
-
-# --- UI ---
-
-with st.sidebar:
-
-    st.header("🔧 設定")
-
-    if "GEMINI_API_KEY" in st.secrets:
-
-        api_key = st.secrets["GEMINI_API_KEY"]
-
-        st.success("🔑 APIキー認証済み")
-
-    else:
-
-        api_key = st.text_input("Gemini APIキー", type="password")
-
-    
-
-    valid_models = []
-
-    target_model_name = None
-
-    if api_key:
-
-        try:
-
-            genai.configure(api_key=api_key)
-
-            all_models = list(genai.list_models())
-
-            valid_models = [m.name for m in all_models if 'generateContent' in m.supported_generation_methods]
-
-            default_idx = next((i for i, n in enumerate(valid_models) if "flash" in n), 0)
-
-            target_model_name = st.selectbox("使用するAIモデル", valid_models, index=default_idx)
-
-        except: pass
-
-    
-
-    st.divider()
-
-    st.subheader("🗣️ 音声設定")
-
-    voice_options = {"女性（七海）": "ja-JP-NanamiNeural", "男性（慶太）": "ja-JP-KeitaNeural"}
-
-    selected_voice = st.selectbox("声の種類", list(voice_options.keys()))
-
-    voice_code = voice_options[selected_voice]
-
-    rate_value = "+10%"
-
-
-
-    # --- 辞書機能 (Sidebar) ---
-
-    st.divider()
-
-    st.subheader("📖 辞書登録")
-
-    st.caption("よく間違える読み方を登録すると、AIが学習します。(例: 豚肉 -> ぶたにく)")
-
-    
-
-    # 辞書のロード
-
-    user_dict = load_dictionary()
-
-    
-
-    # 新規登録
-
-    with st.form("dict_form", clear_on_submit=True):
-
-        c_word, c_read = st.columns(2)
-
-        new_word = c_word.text_input("単語", placeholder="例: 辛口")
-
-        new_read = c_read.text_input("読み", placeholder="例: からくち")
-
-        if st.form_submit_button("➕ 追加"):
-
-            if new_word and new_read:
-
-                user_dict[new_word] = new_read
-
-                save_dictionary(user_dict)
-
-                st.success(f"「{new_word}」を登録しました！")
-
-                st.rerun()
-
-
-
-    # 登録済みリスト（削除機能）
-
-    if user_dict:
-
-        with st.expander(f"登録済み単語 ({len(user_dict)})"):
-
-            for word, read in list(user_dict.items()):
-
-                c1, c2 = st.columns([3, 1])
-
-                c1.text(f"{word} ➡ {read}")
-
-                if c2.button("🗑️", key=f"del_{word}"):
-
-                    del user_dict[word]
-
-                    save_dictionary(user_dict)
-
-                    st.rerun()
-
-
-
-st.title("🎧 Menu Player Generator")
-
-st.caption("視覚障がいのある方のための、アクセシビリティに配慮した音声メニューを作成します。")
-
-
-
-# 再撮影する画像のインデックスを保持するstate
-
-if 'retake_index' not in st.session_state: st.session_state.retake_index = None
-
-if 'captured_images' not in st.session_state: st.session_state.captured_images = []
-
-if 'camera_key' not in st.session_state: st.session_state.camera_key = 0
-
-if 'generated_result' not in st.session_state: st.session_state.generated_result = None
-
-if 'show_camera' not in st.session_state: st.session_state.show_camera = False
-
-
-
-# Step 1
-
-st.markdown("### 1. お店情報の入力")
-
-c1, c2 = st.columns(2)
-
-with c1: store_name = st.text_input("🏠 店舗名（必須）", placeholder="例：カフェタナカ")
-
-with c2: menu_title = st.text_input("📖 今回のメニュー名 （任意）", placeholder="例：ランチ")
-
-
-
-map_url = st.text_input("📍 GoogleマップのURL（任意）", placeholder="例：https://maps.app.goo.gl/...")
-
-if map_url:
-
-    st.caption("※プレイヤーに地図へのアクセスボタンが表示されます。")
-
-
-
-st.markdown("---")
-
-
-
-st.markdown("### 2. メニューの登録")
-
-input_method = st.radio("方法", ("📂 アルバムから", "📷 その場で撮影", "🌐 URL入力"), horizontal=True)
-
-
-
-final_image_list = []
-
-target_url = None
-
-
-
-if input_method == "📂 アルバムから":
-
-    uploaded_files = st.file_uploader("写真を選択", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True)
-
-    if uploaded_files: final_image_list.extend(uploaded_files)
-
-
-
-elif input_method == "📷 その場で撮影":
-
-    if st.session_state.retake_index is not None:
-
-        target_idx = st.session_state.retake_index
-
-        st.warning(f"No.{target_idx + 1} の画像を再撮影中...")
-
-        retake_camera_key = f"retake_camera_{target_idx}_{st.session_state.camera_key}"
-
-        camera_file = st.camera_input("写真を撮影する (取り直し)", key=retake_camera_key)
-
-        
-
-        c1, c2 = st.columns(2, gap="large")
-
-        with c1:
-
-            if camera_file and st.button("✅ これで決定", type="primary", key="retake_confirm", use_container_width=True):
-
-                st.session_state.captured_images[target_idx] = camera_file
-
-                st.session_state.retake_index = None
-
-                st.session_state.show_camera = False 
-
-                st.session_state.camera_key += 1
-
-                st.rerun()
-
-        with c2:
-
-            if st.button("❌ キャンセル", key="retake_cancel", use_container_width=True):
-
-                st.session_state.retake_index = None
-
-                st.session_state.show_camera = False
-
-                st.rerun()
-
-
-
-    elif not st.session_state.show_camera:
-
-        if st.button("📷 カメラ起動", type="primary"):
-
-            st.session_state.show_camera = True
-
-            st.rerun()
-
-    else:
-
-        camera_file = st.camera_input("写真を撮影する", key=f"camera_{st.session_state.camera_key}")
-
-        if camera_file:
-
-            c_btn1, c_btn2 = st.columns(2, gap="large")
-
-            with c_btn1:
-
-                if st.button("⬇️ 追加して次を撮る", type="primary", use_container_width=True):
-
-                    st.session_state.captured_images.append(camera_file)
-
-                    st.session_state.camera_key += 1
-
-                    st.rerun()
-
-            with c_btn2:
-
-                if st.button("✅ 追加して終了", type="primary", use_container_width=True):
-
-                    st.session_state.captured_images.append(camera_file)
-
-                    st.session_state.show_camera = False
-
-                    st.session_state.camera_key += 1
-
-                    st.rerun()
-
-        else:
-
-            if st.button("❌ 撮影を中止", use_container_width=True):
-
-                st.session_state.show_camera = False
-
-                st.rerun()
-
-            
-
-    if st.session_state.captured_images:
-
-        if st.session_state.retake_index is None and st.session_state.show_camera is False:
-
-             if st.button("🗑️ 全て削除"):
-
-                st.session_state.captured_images = []
-
-                st.rerun()
-
-        final_image_list.extend(st.session_state.captured_images)
-
-
-
-elif input_method == "🌐 URL入力":
-
-    target_url = st.text_input("URL", placeholder="https://...")
-
-
-
-if final_image_list and st.session_state.retake_index is None:
-
-    st.markdown("###### ▼ 画像確認")
-
-    cols_per_row = 3
-
-    for i in range(0, len(final_image_list), cols_per_row):
-
-        cols = st.columns(cols_per_row, gap="medium")
-
-        batch = final_image_list[i:i+cols_per_row]
-
-        for j, img in enumerate(batch):
-
-            global_idx = i + j
-
-            with cols[j]:
-
-                st.image(img, caption=f"No.{global_idx+1}", use_container_width=True)
-
-                if input_method == "📷 その場で撮影" and img in st.session_state.captured_images:
-
-                    c_retake, c_delete = st.columns(2, gap="small")
-
-                    with c_retake:
-
-                        if st.button("🔄 撮り直す", key=f"btn_retake_{global_idx}", use_container_width=True):
-
-                            st.session_state.retake_index = global_idx
-
-                            st.session_state.show_camera = True
-
-                            st.rerun()
-
-                    with c_delete:
-
-                        if st.button("🗑️ 削除", key=f"btn_delete_{global_idx}", use_container_width=True):
-
-                            st.session_state.captured_images.pop(global_idx)
-
-                            st.session_state.retake_index = None
-
-                            st.session_state.show_camera = False
-
-                            st.rerun()
-
-
-
-st.markdown("---")
-
-
-
-st.markdown("### 3. 音声メニューの作成")
-
-disable_create = st.session_state.retake_index is not None
-
-if st.button("🎙️ 作成開始", type="primary", use_container_width=True, disabled=disable_create):
-
-    if not (api_key and target_model_name and store_name):
-
-        st.error("設定や店舗名を確認してください"); st.stop()
-
-    if not (final_image_list or target_url):
-
-        st.warning("画像かURLを入力してください"); st.stop()
-
-
-
-    output_dir = os.path.abspath("menu_audio_album")
-
-    if os.path.exists(output_dir): shutil.rmtree(output_dir)
-
-    os.makedirs(output_dir)
-
-
-
-    with st.spinner('解析中...'):
-
-        try:
-
-            genai.configure(api_key=api_key)
-
-            model = genai.GenerativeModel(target_model_name)
-
-            parts = []
-
-            
-
-            # 辞書データの取得とJSON文字列化
-
-            user_dict_str = json.dumps(user_dict, ensure_ascii=False)
-
-            
-
-            prompt = f"""
-
-            あなたは視覚障害者のためのメニュー読み上げデータ作成のプロです。
-
-            メニューの内容を解析し、聞きやすいように【5つ〜8つ程度の大きなカテゴリー】に分類してまとめてください。
-
-            
-
-            重要ルール:
-
-            1. メニュー項目1つごとに1つのカテゴリーを作らないこと。
-
-            2. 「前菜・サラダ」「メイン料理」「ご飯・麺」「ドリンク」「デザート」のようにグループ化する。
-
-            3. カテゴリー内のメニューは、挨拶などを抜きにして商品名と価格をテンポよく読み上げる文章にする。
-
-            4. 価格の数字には必ず「円」をつけて読み上げる（例：1000 -> 1000円）。
-
-            5. アレルギー、辛さ、量などの重要な注意書きは、省略せず商品名の後に補足して読み上げる。
-
-            
-
-            ★重要：以下の固有名詞・読み方辞書を必ず守ってください。
-
-            {user_dict_str}
-
-
-
-            出力フォーマット（JSONのみ）:
-
-            [
-
-              {{"title": "カテゴリー名（例：前菜・サラダ）", "text": "読み上げ文（例：まずは前菜です。シーザーサラダ800円。ポテトサラダ500円。なお、ドレッシングは別添え可能です。）"}},
-
-              {{"title": "カテゴリー名（例：メイン料理）", "text": "読み上げ文（例：続いてメインです。ハンバーグ定食1200円。ステーキ1500円。ご飯の大盛りは無料です。）"}}
-
-            ]
-
-            """
-
-            
-
-            if final_image_list:
-
-                parts.append(prompt)
-
-                for f in final_image_list:
-
-                    f.seek(0)
-
-                    parts.append({"mime_type": f.type if hasattr(f, 'type') else 'image/jpeg', "data": f.getvalue()})
-
-            elif target_url:
-
-                web_text = fetch_text_from_url(target_url)
-
-                if not web_text: st.error("URLエラー"); st.stop()
-
-                parts.append(prompt + f"\n\n{web_text[:30000]}")
-
-
-
-            resp = None
-
-            for _ in range(3):
-
-                try: resp = model.generate_content(parts); break
-
-                except exceptions.ResourceExhausted: time.sleep(5)
+    # 出力は作成ごとのディレクトリに書き、成功して登録を差し替えるまで前の結果のファイルには触れない
+    run_dir = artifacts.new_dir(f"run_{uuid.uuid4().hex[:12]}")
+    output_dir = os.path.join(run_dir, "menu_audio_album")
+    os.makedirs(output_dir)
+    # 作成の途中で、中止ボタン・もう一度の作成開始・ページ移動・タブを閉じたことによる切断があれば、
+    # 残りの処理（AI解析・音声合成・書き出し）を取り消して、途中まで作ったファイルを消す
+    token = CancelToken()
+    run_paths = [run_dir]
+    cancel_slot = st.empty()
+    cancel_slot.button("⏹ 作成を中止", on_click=request_cancel)
+    run_status = st.empty()
+
+    pdf_images = []
+    artifacts.begin_run()
+    with st.spinner('解析中...'):
+        try:
+            with profiler.stage("入力の読み込み"):
+                web_text = None
+                if not (final_image_list or pdf_files):
+                    web_text = run_in_background(token, run_status, "ページを読み込んでいます", partial(fetch_text_from_url, target_url, url_token_budget))
+                    if not web_text: stop_generation(token, cancel_slot, "URLエラー")
+                    st.caption(f"ページから約{estimate_tokens(web_text)}トークン分のメニュー部分を抽出しました。")
+
+                # 入力と設定が同じなら、作成履歴にある結果をそのまま使う
+                fingerprint = input_fingerprint(
+                    [f.getvalue() for f in final_image_list + pdf_files] if final_image_list or pdf_files else [web_text],
+                    store_name=store_name, menu_title=menu_title, map_url=map_url,
+                    voices=[VOICE_OPTIONS[label][0] for label in selected_voices], rate=rate_value, model=target_model_name, dictionary=user_dict,
+                )
+                cached = None if force_regenerate else catalog.find(fingerprint)
+                if cached:
+                    restored = restore_from_catalog(artifacts, catalog, cached, run_dir)
+                    # ストリーミング版は作成履歴に入れていないので、保存済みの音声から作り直す
+                    if stream_export:
+                        restored.update(store_stream_export(artifacts, run_dir, store_name, restored["variants"], map_url, cached["zip_name"].replace(".zip", "_stream.zip")))
+                    commit_result(artifacts, run_dir, restored)
+                    token.close()
+                    st.rerun()
 
+            pdf_text = None
+            if pdf_files:
+                with profiler.stage("PDFの読み込み"):
+                    pdf_text, pdf_images = load_pdfs(artifacts, pdf_files, token, run_status)
+                    final_image_list = final_image_list + pdf_images
+
+            with profiler.stage("AI解析"):
+                # 解析を待つ間に、あいさつと定型文を共有ループで先に合成し、音声合成の接続も開いておく
+                tts_loop, prepared = get_tts_loop(), {}
+                token.on_cancel(tts_loop.submit(presynthesize_intro(
+                    prepared, store_name, menu_title, [VOICE_OPTIONS[label] for label in selected_voices], rate_value,
+                    get_segment_cache(), artifacts.new_dir(os.path.join(run_dir, "intro_presynth")), tts_loop.slot, get_tts_pool(),
+                )).cancel)
+                router = get_model_router(api_key)
+                try: router.update_models(get_generate_models(api_key))
                 except: pass
-
-
-
-            if not resp: st.error("失敗しました"); st.stop()
-
-
-
-            text_resp = resp.text
-
-            start = text_resp.find('[')
-
-            end = text_resp.rfind(']') + 1
-
-            if start == -1: st.error("解析エラー"); st.stop()
-
-            menu_data = json.loads(text_resp[start:end])
-
-
-
-            intro_t = f"こんにちは、{store_name}です。"
-
-            if menu_title: intro_t += f"ただいまより{menu_title}をご紹介します。"
-
-            intro_t += "このプレイヤーは、スクリーンリーダーでの操作に対応しています。"
-
-            intro_t += f"このメニューは、全部で{len(menu_data)}つのカテゴリーに分かれています。まずは目次です。"
-
-            
-
-            for i, tr in enumerate(menu_data): 
-
-                intro_t += f"{i+1}、{tr['title']}。"
-
-                
-
-            intro_t += "それではどうぞ。"
-
-            menu_data.insert(0, {"title": "はじめに・目次", "text": intro_t})
-
-
-
-            progress_bar = st.progress(0)
-
-            st.info("音声を生成しています... (並列処理中)")
-
-            generated_tracks = asyncio.run(process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar))
-
-
-
-            html_str = create_standalone_html_player(store_name, generated_tracks, map_url)
-
+                model = router.model(target_model_name, token)
+                # 利用上限などでモデルを切り替えたとき・待っているときは、その理由をここに表示する
+                # （AI解析のスレッドからは notes に入れ、このスレッドで表示する）
+                retry_slot = st.empty()
+                show_retry = lambda message: retry_slot.info(f"🔁 {message}")
+                notes = []
+                parts = []
+                prompt = build_menu_prompt(user_dict)
             
+                if final_image_list and batch_mode and len(final_image_list) > batch_size:
+                    st.info(f"写真{len(final_image_list)}枚を{batch_size}枚ずつ並列で解析しています...")
+                    partials, failed = analyze_in_batches(model, prompt, final_image_list, batch_size, batch_concurrency, st.progress(0), show_retry)
+                    for first, last in failed:
+                        st.warning(f"No.{first}〜No.{last} の写真は解析できなかったため、除外しました。")
+                    # PDFの文字情報のページは、写真とは別に1回で解析する
+                    if pdf_text:
+                        text_data = run_in_background(token, run_status, "PDFの文字情報を解析しています", partial(analyze_batch, model, prompt, [], text=pdf_text, on_retry=notes.append), notes, show_retry)
+                        if text_data: partials.append(text_data)
+                        else: st.warning("PDFの文字情報のページは解析できなかったため、除外しました。")
+                    if not partials: stop_generation(token, cancel_slot, "失敗しました")
+                    menu_data = merge_categories(partials)
+                else:
+                    if final_image_list:
+                        parts.append(prompt + (f"\n\n{pdf_text}" if pdf_text else ""))
+                        for f in final_image_list:
+                            parts.append(image_part(f))
+                    elif web_text or pdf_text:
+                        parts.append(prompt + f"\n\n{web_text or pdf_text}")
+
+                    resp = run_in_background(token, run_status, "AIがメニューを解析しています", partial(generate_with_retry, model, parts, notes.append, MENU_SCHEMA), notes, show_retry)
+
+                    if not resp: stop_generation(token, cancel_slot, "失敗しました")
+
+                    # 形の崩れはその場で直し、途中で切れていれば続きだけを取得する（解析はやり直さない）
+                    menu_data = run_in_background(token, run_status, "AIの出力を読み取っています", partial(read_menu_json, model, parts, resp, notes.append), notes, show_retry)
+                    if menu_data is None: stop_generation(token, cancel_slot, "解析エラー")
+
+            for f in pdf_images: f.release()
+
+            # 1回の解析結果（menu_data）から、声・言語ごとのバリエーションを作る
+            with profiler.stage("翻訳"):
+                translations = {}
+                for lang in sorted({VOICE_OPTIONS[label][1] for label in selected_voices} - {"ja"}):
+                    translations[lang] = run_in_background(token, run_status, f"翻訳しています（{lang}）", partial(translate_menu, model, menu_data, store_name, menu_title, lang, notes.append), notes, show_retry)
+                variants = []
+                for label in selected_voices:
+                    voice, lang = VOICE_OPTIONS[label]
+                    v_data, v_store, v_title = menu_data, store_name, menu_title
+                    if lang in translations:
+                        t = translations[lang]
+                        # カテゴリーの数が元と違う翻訳（途中で切れて補えなかったなど）では、声ごとにチャプターが食い違うので作らない
+                        if len(t["categories"]) != len(menu_data):
+                            st.warning(f"{label}: 翻訳のカテゴリー数（{len(t['categories'])}）が元のメニュー（{len(menu_data)}）と合わないため、この声は作成しませんでした。")
+                            continue
+                        v_data, v_store, v_title = t["categories"], t.get("store_name") or store_name, t.get("menu_title") or menu_title
+                    intro_segments = build_intro_segments(v_store, v_title, v_data, lang)
+                    v_data = [{"title": intro_track_title(lang), "text": "".join(text for text, _ in intro_segments)}] + v_data
+                    v_dir = output_dir if len(selected_voices) == 1 else artifacts.new_dir(os.path.join(output_dir, sanitize_filename(label)))
+                    variants.append({"label": label, "voice": voice, "lang": lang, "menu_data": v_data, "output_dir": v_dir, "intro_segments": intro_segments})
+                if not variants: stop_generation(token, cancel_slot, "翻訳に失敗しました")
+
+            with profiler.stage("音声合成"):
+                progress_bar = st.progress(0)
+                st.info("音声を生成しています... (並列処理中)")
+                # 合成は共有ループで行い、このスレッドでは進捗バーの更新だけをする
+                done = [0, 1]
+                def report(completed, total): done[:] = [completed, total]
+                variants = tts_loop.run(
+                    process_all_tracks_fast(variants, rate_value, report, slot=tts_loop.slot, segment_cache=get_segment_cache(), tts_pool=get_tts_pool(), prepared=prepared),
+                    on_wait=lambda: progress_bar.progress(done[0] / done[1]),
+                )
+                progress_bar.progress(1.0)
 
             d_str = datetime.now().strftime('%Y%m%d')
-
             s_name = sanitize_filename(store_name)
-
+            html_name = f"{s_name}_player.html"
+            with profiler.stage("Webプレイヤー"):
+                html_path = run_in_background(token, run_status, "Webプレイヤーを作成しています", partial(
+                    write_standalone_html_player, os.path.join(run_dir, html_name), store_name, variants, map_url, token))
             zip_name = f"{s_name}_{d_str}.zip"
-
-            zip_path = os.path.abspath(zip_name)
-
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
-
-                for root, dirs, files in os.walk(output_dir):
-
-                    for file in files: z.write(os.path.join(root, file), file)
-
-
-
-            with open(zip_path, "rb") as f:
-
-                zip_data = f.read()
-
-
-
-            st.session_state.generated_result = {
-
-                "zip_data": zip_data,
-
+            with profiler.stage("ZIP"):
+                zip_path = run_in_background(token, run_status, "ZIPを作成しています", partial(write_zip, os.path.join(run_dir, zip_name), output_dir, token=token))
+
+            stream = {}
+            if stream_export:
+                with profiler.stage("ストリーミング版"):
+                    stream = run_in_background(token, run_status, "ストリーミング版を作成しています", partial(
+                        store_stream_export, artifacts, run_dir, store_name, variants, map_url, f"{s_name}_{d_str}_stream.zip", token))
+
+            commit_result(artifacts, run_dir, {
+                **stream,
+                "zip_path": zip_path,
                 "zip_name": zip_name,
-
-                "html_content": html_str, 
-
-                "html_name": f"{s_name}_player.html",
-
-                "tracks": generated_tracks
-
-            }
-
+                "html_path": html_path,
+                "html_name": html_name,
+                "tracks": variants[0]["tracks"],
+                "variants": [{"label": v["label"], "lang": v["lang"], "tracks": v["tracks"]} for v in variants],
+            })
+            token.close()
+            cancel_slot.empty()
+            try:
+                with profiler.stage("作成履歴への保存"):
+                    all_tracks = [{**t, "variant": v["label"], "arcname": os.path.relpath(t["path"], output_dir)} for v in variants for t in v["tracks"]]
+                    catalog.add(fingerprint, store_name, menu_title, variants[0]["menu_data"], all_tracks, html_path, html_name, zip_name, voice="、".join(selected_voices))
+            except Exception as e: st.warning(f"作成履歴への保存に失敗しました: {e}")
             st.balloons()
-
-        except Exception as e: st.error(f"エラー: {e}")
-
-
-
-if st.session_state.generated_result:
-
-    res = st.session_state.generated_result
-
-    st.divider()
-
-    st.subheader("▶️ プレビュー")
-
-    render_preview_player(res["tracks"])
-
-    st.divider()
-
-    st.subheader("📥 保存")
-
-    
-
-    st.info(
-
-        """
-
-        **Webプレイヤー**：アクセシビリティ対応済みのHTMLファイルです。スマホへの保存やLINE共有に便利です。  
-
-        **ZIPファイル**：PCでの保存や、My Menu Bookへの追加にご利用ください。
-
-        """
-
-    )
-
-    
-
-    c1, c2 = st.columns(2)
-
-    with c1: st.download_button(f"🌐 Webプレイヤー ({res['html_name']})", res['html_content'], res['html_name'], "text/html", type="primary")
-
-    with c2: st.download_button(f"📦 ZIPファイル ({res['zip_name']})", data=res["zip_data"], file_name=res['zip_name'], mime="application/zip")
-
+        except Exception as e:
+            token.cancel(count=False)
+            cancel_slot.empty()
+            st.error(f"エラー: {e}")
+        finally:
+            artifacts.end_run()
+            for f in pdf_images: f.release()
+            # 結果を確定する前に抜けた（失敗・中止・再実行・切断）ときは、残りの処理を取り消して途中のファイルを消す
+            # 中止として数えるのは、失敗で止めた（cancel(count=False) 済みの）とき以外
+            if not token.closed:
+                interrupted = token.cancel()
+                remove_partial(run_paths, count=interrupted)
+
+with profiler.stage("プレビュー"):
+    result_section(artifacts)
+profile_path = profiler.finish()
+if profile_path: st.caption(f"🧪 メモリプロファイルを書き出しました: {profile_path}")
+
+render_memory_usage(artifacts, usage_slot)
+
+# 初回表示を速くするため、モデル一覧の初回の取得とモデル選択の描画は最後に行う
+if api_key and not target_model_name: load_model_select(model_slot, api_key)
@@ -0,0 +1,231 @@
+# セッションごとの生成物（撮影画像・ZIP・Webプレイヤーなど）を管理するストア
+# - セッション単位と全体の2段階でメモリ上限を持ち、超えた分はディスクへ退避する
+# - 一定サイズ以上のデータは最初からディスクに置く
+# - 一定時間アクセスのないセッションは、古い順（LRU）に作業ディレクトリごと破棄する（作成中のセッションは破棄しない）
+# - セッション数が上限を超えても、アクセスのあるセッションは破棄せず、古い順にメモリ上のデータをディスクへ退避する
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+MB = 1024 * 1024
+SESSION_MEMORY_BUDGET = int(os.environ.get("MENU_PLAYER_SESSION_BUDGET_MB", "64")) * MB
+GLOBAL_MEMORY_BUDGET = int(os.environ.get("MENU_PLAYER_GLOBAL_BUDGET_MB", "512")) * MB
+SPILL_THRESHOLD = int(os.environ.get("MENU_PLAYER_SPILL_THRESHOLD_MB", "4")) * MB
+SESSION_IDLE_TIMEOUT = int(os.environ.get("MENU_PLAYER_SESSION_IDLE_MIN", "30")) * 60
+MAX_SESSIONS = int(os.environ.get("MENU_PLAYER_MAX_SESSIONS", "200"))
+WORKSPACE_ROOT = os.environ.get("MENU_PLAYER_WORKSPACE", os.path.join(tempfile.gettempdir(), "menu_player_sessions"))
+
+
+class Blob:
+    def __init__(self, key, data=None, path=None, size=0):
+        self.key = key
+        self.data = data
+        self.path = path
+        self.size = size
+
+    @property
+    def in_memory(self):
+        return self.data is not None
+
+
+class SessionArtifacts:
+    def __init__(self, store, session_id):
+        self.store = store
+        self.session_id = session_id
+        self.workspace = os.path.join(store.root, session_id)
+        self.blobs = OrderedDict()
+        self.last_access = time.time()
+        self.running = 0
+        os.makedirs(self.workspace, exist_ok=True)
+
+    @property
+    def memory_bytes(self):
+        return sum(b.size for b in self.blobs.values() if b.in_memory)
+
+    @property
+    def disk_bytes(self):
+        return sum(b.size for b in self.blobs.values() if not b.in_memory)
+
+    def put(self, data, key=None):
+        key = key or uuid.uuid4().hex
+        with self.store.lock:
+            self._drop(key)
+            if len(data) >= SPILL_THRESHOLD:
+                blob = Blob(key, path=self._write(key, data), size=len(data))
+            else:
+                blob = Blob(key, data=bytes(data), size=len(data))
+            self.blobs[key] = blob
+            self.store._enforce_budget(self)
+        return key
+
+    def put_file(self, path, key=None):
+        # 既にディスク上にあるファイル（ZIP・HTMLなど）をそのまま登録する
+        key = key or uuid.uuid4().hex
+        with self.store.lock:
+            self._drop(key, keep_path=path)
+            self.blobs[key] = Blob(key, path=path, size=os.path.getsize(path))
+        return key
+
+    def get(self, key):
+        with self.store.lock:
+            blob = self.blobs.get(key)
+            if blob is None: return None
+            self.blobs.move_to_end(key)
+            if blob.in_memory: return blob.data
+            path = blob.path
+        if not os.path.exists(path): return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def path(self, key):
+        # ファイルとして渡したい場合はディスクへ退避してパスを返す
+        with self.store.lock:
+            blob = self.blobs.get(key)
+            if blob is None: return None
+            if blob.in_memory: self._spill(blob)
+            return blob.path
+
+    def exists(self, key):
+        # ディスク上のファイルが消されていれば、ないものとして扱う
+        with self.store.lock:
+            blob = self.blobs.get(key)
+            return blob is not None and (blob.in_memory or os.path.exists(blob.path))
+
+    def delete(self, key):
+        with self.store.lock:
+            self._drop(key)
+
+    def begin_run(self):
+        # 作成（AI解析〜書き出し）のあいだは、アクセスがなくても破棄しない。終わったら end_run
+        with self.store.lock:
+            self.running += 1
+            self.last_access = time.time()
+
+    def end_run(self):
+        with self.store.lock:
+            self.running -= 1
+            self.last_access = time.time()
+
+    def new_dir(self, name):
+        # 作業ディレクトリ内に、空のサブディレクトリを作り直して返す
+        path = os.path.join(self.workspace, name)
+        if os.path.exists(path): shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def _write(self, key, data):
+        path = os.path.join(self.workspace, f"blob_{key}")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _spill(self, blob):
+        blob.path = self._write(blob.key, blob.data)
+        blob.data = None
+
+    def _drop(self, key, keep_path=None):
+        # 作業ディレクトリ内のファイルはストアの持ち物なので一緒に消す
+        blob = self.blobs.pop(key, None)
+        if not blob or not blob.path or blob.path == keep_path: return
+        if blob.path.startswith(self.workspace + os.sep) and os.path.exists(blob.path):
+            os.remove(blob.path)
+
+    def _spill_until(self, limit):
+        for blob in list(self.blobs.values()):
+            if self.memory_bytes <= limit: break
+            if blob.in_memory: self._spill(blob)
+
+
+class ArtifactStore:
+    def __init__(self, root=WORKSPACE_ROOT, session_budget=SESSION_MEMORY_BUDGET, global_budget=GLOBAL_MEMORY_BUDGET):
+        self.root = root
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self.lock = threading.RLock()
+        self.sessions = OrderedDict()
+        self.evicted = 0
+        os.makedirs(root, exist_ok=True)
+
+    def session(self, session_id):
+        with self.lock:
+            s = self.sessions.get(session_id)
+            if s is None:
+                s = SessionArtifacts(self, session_id)
+                self.sessions[session_id] = s
+            s.last_access = time.time()
+            self.sessions.move_to_end(session_id)
+            self._evict_idle(keep=session_id)
+            return s
+
+    def drop_session(self, session_id):
+        with self.lock:
+            s = self.sessions.pop(session_id, None)
+            if s: self._discard(s)
+
+    def usage(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "memory_bytes": sum(s.memory_bytes for s in self.sessions.values()),
+                "disk_bytes": sum(s.disk_bytes for s in self.sessions.values()),
+                "memory_budget": self.global_budget,
+                "evicted": self.evicted,
+            }
+
+    def _enforce_budget(self, current):
+        # セッション上限 → 全体上限（アクセスの古いセッションから）の順でディスクへ退避
+        current._spill_until(self.session_budget)
+        total = sum(s.memory_bytes for s in self.sessions.values())
+        if total <= self.global_budget: return
+        for s in list(self.sessions.values()):
+            before = s.memory_bytes
+            s._spill_until(max(0, before - (total - self.global_budget)))
+            total -= before - s.memory_bytes
+            if total <= self.global_budget: break
+
+    def _evict_idle(self, keep):
+        # sessions はアクセスの古い順に並んでいる
+        now = time.time()
+        for sid, s in list(self.sessions.items()):
+            if sid == keep or s.running: continue
+            if now - s.last_access > SESSION_IDLE_TIMEOUT:
+                self.sessions.pop(sid)
+                self._discard(s)
+                self.evicted += 1
+        # それでも上限を超えるときは、破棄せずに古いセッションから順にメモリ上のデータをディスクへ退避する
+        for s in list(self.sessions.values())[:max(0, len(self.sessions) - MAX_SESSIONS)]:
+            if s.session_id != keep: s._spill_until(0)
+
+    def _discard(self, s):
+        s.blobs.clear()
+        shutil.rmtree(s.workspace, ignore_errors=True)
+
+
+class StoredFile:
+    # UploadedFileの代わりにsession_stateへ入れる軽量な参照（中身はストア側）
+    def __init__(self, artifacts, key, name, type):
+        self.artifacts = artifacts
+        self.key = key
+        self.name = name
+        self.type = type
+
+    @classmethod
+    def from_upload(cls, artifacts, uploaded_file):
+        key = artifacts.put(uploaded_file.getvalue())
+        return cls(artifacts, key, uploaded_file.name, getattr(uploaded_file, "type", "image/jpeg"))
+
+    def getvalue(self):
+        return self.artifacts.get(self.key)
+
+    def seek(self, pos):
+        pass
+
+    def exists(self):
+        return self.artifacts.exists(self.key)
+
+    def release(self):
+        self.artifacts.delete(self.key)
@@ -0,0 +1,117 @@
+# 作成処理の中止（協調的なキャンセル）
+# - 作成1回ごとに CancelToken を作り、AI解析・音声合成・Webプレイヤー/ZIPの書き出しに渡す
+#   各処理は区切りごとに check() し、中止されていれば Cancelled で抜ける
+# - 中止のきっかけ（中止ボタン・同じセッションでの再実行やページ移動・タブを閉じたことによる切断）は、
+#   Streamlit がスクリプトのスレッドの次の st 呼び出しで RerunException / StopException として知らせる
+#   そのため重い処理は別スレッドや共有ループで動かし、スクリプトのスレッドは wait_for で表示を更新しながら待つ
+# - cancel() で、登録しておいた後始末（共有ループのタスクの取り消しなど）を呼ぶ
+# - 実行中のAPI呼び出しは途中で切れないので、戻ってきた結果を捨てる
+# - 取り消した処理はプロセス全体で数える（cancel_usage）
+import concurrent.futures
+import os
+import shutil
+import threading
+
+CANCEL_GRACE = 2.0  # 中止したあと、書き出し中の処理が区切りで止まるのを待つ上限（秒）
+WAIT_INTERVAL = 0.2
+
+_lock = threading.Lock()
+_stats = {"runs": 0, "llm_calls": 0, "tts_tasks": 0, "files": 0, "bytes": 0}
+
+
+class Cancelled(Exception):
+    pass
+
+
+def count_cancelled(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def cancel_usage():
+    with _lock:
+        return dict(_stats)
+
+
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.closed = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set(): raise Cancelled()
+
+    def sleep(self, seconds):
+        # 待っている間に中止されたら、すぐに抜ける
+        if self.event.wait(seconds): raise Cancelled()
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, count=True):
+        # 中止して True を返す。終わった（close した）作成や、中止済みなら何もしない
+        # count: 中止として数えるか（失敗で止めるときは数えない）
+        with self.lock:
+            if self.closed or self.event.is_set(): return False
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        if count: count_cancelled("runs")
+        for callback in callbacks:
+            try: callback()
+            except Exception: pass
+        return True
+
+    def close(self):
+        # 結果を確定した。以後の cancel() は何もしない
+        with self.lock:
+            self.closed = True
+            self.callbacks = []
+
+
+def wait_for(future, token, on_wait=None, interval=WAIT_INTERVAL):
+    # スクリプトのスレッドで future を待つ。待つ間は on_wait() で表示を更新する
+    # on_wait の st 呼び出しで中止などを知らされたら、token を中止し、処理が区切りで止まるのを少し待ってから例外を上げ直す
+    while True:
+        try:
+            return future.result(timeout=interval)
+        except concurrent.futures.TimeoutError:
+            pass
+        try:
+            if on_wait: on_wait()
+        except BaseException:
+            token.cancel()
+            future.cancel()
+            try: future.result(timeout=CANCEL_GRACE)
+            except BaseException: pass
+            raise
+
+
+def remove_partial(paths, count=True):
+    # 途中まで作ったファイル・ディレクトリを消す。count: 消した分を中止の集計に入れるか
+    files = size = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                for name in names:
+                    try: size += os.path.getsize(os.path.join(root, name))
+                    except OSError: continue
+                    files += 1
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            size += os.path.getsize(path)
+            files += 1
+            os.remove(path)
+    if count:
+        count_cancelled("files", files)
+        count_cancelled("bytes", size)
+    return files, size
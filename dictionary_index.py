@@ -0,0 +1,58 @@
+# 読み方辞書（単語→読み）の検索用インデックス
+# - 単語と読みを正規化（全角・半角、カタカナ→ひらがな、大文字→小文字）してから索引にする
+# - 前方一致: 正規化した単語・読みをそれぞれ並べ替えて持ち、二分探索で範囲を取る
+# - 部分一致: 1文字・2文字ごとの転置インデックスで候補を絞り、最後に文字列で確かめる
+# - 辞書を保存するたびに作り直す（数千語でも数十ミリ秒）
+import bisect
+import unicodedata
+
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text).lower().translate(KATAKANA_TO_HIRAGANA)
+
+
+def grams(text):
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class DictionaryIndex:
+    def __init__(self, entries):
+        # entries: {単語: 読み}。結果は単語の並び順（self.words の添字）で返す
+        self.words = sorted(entries)
+        self.readings = [entries[w] for w in self.words]
+        self.keys = [(normalize(w), normalize(r)) for w, r in zip(self.words, self.readings)]
+        self.by_word = sorted((k[0], i) for i, k in enumerate(self.keys))
+        self.by_reading = sorted((k[1], i) for i, k in enumerate(self.keys))
+        self.postings = {}
+        for i, (word, reading) in enumerate(self.keys):
+            for gram in grams(word) | grams(reading):
+                self.postings.setdefault(gram, set()).add(i)
+
+    def __len__(self):
+        return len(self.words)
+
+    def _prefix(self, query):
+        hits = set()
+        for table in (self.by_word, self.by_reading):
+            for key, i in table[bisect.bisect_left(table, (query,)):]:
+                if not key.startswith(query): break
+                hits.add(i)
+        return hits
+
+    def _substring(self, query):
+        candidates = None
+        for gram in ({query} if len(query) == 1 else {query[i:i + 2] for i in range(len(query) - 1)}):
+            candidates = self.postings.get(gram, set()) if candidates is None else candidates & self.postings.get(gram, set())
+            if not candidates: return set()
+        return {i for i in candidates if query in self.keys[i][0] or query in self.keys[i][1]}
+
+    def search(self, query, substring=False):
+        # 一致した語の添字を、単語の並び順で返す（空の検索語なら全て）
+        query = normalize(query.strip())
+        if not query: return list(range(len(self.words)))
+        return sorted(self._substring(query) if substring else self._prefix(query))
+
+    def entry(self, i):
+        return self.words[i], self.readings[i]
@@ -0,0 +1,151 @@
+# 生成処理のメモリプロファイル（任意）
+# - 環境変数 MENU_PLAYER_PROFILE=1 のときだけ有効（無効なら stage() は何もしない）
+# - 段階ごとに、tracemalloc で見たPythonオブジェクトのピーク・残留量と、RSSのピークを記録する
+# - 終了時に上位の確保箇所を標準出力へ出し、バージョン間で比較できるJSONレポートを書き出す
+#   （比較は tools/compare_profiles.py）
+# - tracemalloc はプロセス全体を見るので、他のセッションが同時に作成していると値が混ざる
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_ENABLED = os.environ.get("MENU_PLAYER_PROFILE", "") not in ("", "0")
+PROFILE_DIR = os.environ.get("MENU_PLAYER_PROFILE_DIR", "profiles")
+PROFILE_TOP = int(os.environ.get("MENU_PLAYER_PROFILE_TOP", "10"))
+PROFILE_FRAMES = 1  # 確保箇所は行単位でまとめるので、記録するフレームは1つで足りる
+MIN_SITE_BYTES = 10 * 1024
+RSS_INTERVAL = 0.01
+MB = 1024 * 1024
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # /procがない環境では、プロセス開始からの最大値で代用する
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def code_version():
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+class RSSSampler:
+    # 段階の実行中、別スレッドで一定間隔ごとにRSSを読んでピークを取る
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+class MemoryProfiler:
+    def __init__(self, label="", enabled=PROFILE_ENABLED, top=PROFILE_TOP):
+        self.label = label
+        self.enabled = enabled
+        self.top = top
+        self.stages = []
+        self.created_at = datetime.now().isoformat(timespec="seconds")
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_FRAMES)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        before = self._snapshot()
+        traced_start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        rss_start = current_rss()
+        sampler = RSSSampler()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            # st.stop() や st.rerun() で抜けたときも、そこまでの値を記録する
+            seconds = time.perf_counter() - t0
+            traced_end, traced_peak = tracemalloc.get_traced_memory()
+            rss_peak = sampler.stop()
+            diff = self._snapshot().compare_to(before, "lineno")
+            self.stages.append({
+                "stage": name,
+                "seconds": round(seconds, 3),
+                "traced_peak_mb": round((traced_peak - traced_start) / MB, 2),
+                "retained_mb": round((traced_end - traced_start) / MB, 2),
+                "rss_start_mb": round(rss_start / MB, 1),
+                "rss_peak_mb": round(rss_peak / MB, 1),
+                "rss_end_mb": round(current_rss() / MB, 1),
+                "top": [{
+                    "site": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+                    "size_mb": round(s.size_diff / MB, 3),
+                    "count": s.count_diff,
+                } for s in diff[:self.top] if s.size_diff >= MIN_SITE_BYTES],
+            })
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ])
+
+    def report(self):
+        return {
+            "label": self.label,
+            "version": code_version(),
+            "created_at": self.created_at,
+            "python": platform.python_version(),
+            "rss_peak_mb": max((s["rss_peak_mb"] for s in self.stages), default=0),
+            "traced_peak_mb": max((s["traced_peak_mb"] for s in self.stages), default=0),
+            "stages": self.stages,
+        }
+
+    def format(self):
+        lines = [f"[memory profile] {self.label}",
+                 f"{'stage':<16} {'sec':>7} {'peak MB':>8} {'kept MB':>8} {'RSS peak':>9} {'RSS end':>8}"]
+        for s in self.stages:
+            lines.append(f"{s['stage']:<16} {s['seconds']:7.2f} {s['traced_peak_mb']:8.1f} {s['retained_mb']:8.1f} {s['rss_peak_mb']:9.1f} {s['rss_end_mb']:8.1f}")
+        for s in self.stages:
+            if not s["top"]: continue
+            lines.append(f"-- {s['stage']}: 残っている確保箇所（上位{len(s['top'])}）")
+            for t in s["top"]:
+                lines.append(f"   {t['size_mb']:8.2f} MB {t['count']:>7}  {t['site']}")
+        return "\n".join(lines)
+
+    def write(self, directory=PROFILE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{self.label or 'run'}.json"
+        path = os.path.join(directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        return path
+
+    def finish(self):
+        # 何か記録したときだけ、表を出力してレポートを書く
+        if not (self.enabled and self.stages): return None
+        print(self.format(), flush=True)
+        return self.write()
@@ -0,0 +1,160 @@
+# 作成済みメニューの保管庫（作成履歴）
+# - 店舗名・メニュー名・作成日・入力内容のフィンガープリントで索引する
+# - menu_data・トラック・Webプレイヤーを1回だけ保存し、MP3は内容のハッシュで重複を除く
+# - 同じ入力で再度作成されたときは、AI解析と音声合成をせずにここから返す
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from datetime import datetime
+
+CATALOG_DIR = os.environ.get("MENU_PLAYER_CATALOG", "menu_catalog")
+
+_lock = threading.Lock()
+
+
+def input_fingerprint(sources, **settings):
+    # sources: 画像のバイト列やページのテキストなど、解析に渡す入力そのもの
+    h = hashlib.sha256()
+    h.update(json.dumps(settings, ensure_ascii=False, sort_keys=True).encode())
+    for src in sources:
+        if isinstance(src, str): src = src.encode()
+        h.update(hashlib.sha256(src).digest())
+    return h.hexdigest()
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MenuCatalog:
+    def __init__(self, root=CATALOG_DIR):
+        self.root = os.path.abspath(root)
+        self.audio_dir = os.path.join(self.root, "audio")
+        self.entries_dir = os.path.join(self.root, "entries")
+        self.index_path = os.path.join(self.root, "index.json")
+        os.makedirs(self.audio_dir, exist_ok=True)
+        os.makedirs(self.entries_dir, exist_ok=True)
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return []
+
+    def _save_index(self, entries):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.index_path)
+
+    def entries(self):
+        with _lock:
+            return sorted(self._load_index(), key=lambda e: e["created_at"], reverse=True)
+
+    def find(self, fingerprint):
+        return next((e for e in self.entries() if e["fingerprint"] == fingerprint), None)
+
+    def search(self, query=""):
+        q = query.strip().lower()
+        if not q: return self.entries()
+        return [e for e in self.entries()
+                if q in e["store_name"].lower() or q in e.get("menu_title", "").lower() or q in e["created_at"][:10] or e["fingerprint"].startswith(q)]
+
+    def add(self, fingerprint, store_name, menu_title, menu_data, tracks, html_path, html_name, zip_name, **extra):
+        entry_id = uuid.uuid4().hex[:12]
+        entry_dir = os.path.join(self.entries_dir, entry_id)
+        os.makedirs(entry_dir)
+        stored_tracks = []
+        for track in tracks:
+            stored_tracks.append({
+                "title": track['title'],
+                "sha256": file_sha256(track['path']),
+                "filename": track.get("arcname", os.path.basename(track['path'])),
+                "variant": track.get("variant", ""),
+            })
+        with open(os.path.join(entry_dir, "menu.json"), "w", encoding="utf-8") as f:
+            json.dump(menu_data, f, ensure_ascii=False, indent=2)
+        shutil.copyfile(html_path, os.path.join(entry_dir, "player.html"))
+        entry = {
+            "id": entry_id,
+            "fingerprint": fingerprint,
+            "store_name": store_name,
+            "menu_title": menu_title,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "html_name": html_name,
+            "zip_name": zip_name,
+            "tracks": stored_tracks,
+            **extra,
+        }
+        # MP3の保存から索引の更新までをまとめてロックする
+        # （間に delete() が入ると、まだ索引にないMP3を参照されていないものとして消してしまう）
+        with _lock:
+            for track, stored in zip(tracks, stored_tracks):
+                blob_path = os.path.join(self.audio_dir, f"{stored['sha256']}.mp3")
+                if not os.path.exists(blob_path):
+                    shutil.copyfile(track['path'], blob_path + ".tmp")
+                    os.replace(blob_path + ".tmp", blob_path)
+            entries = self._load_index()
+            for old in entries:
+                if old["fingerprint"] == fingerprint:
+                    shutil.rmtree(os.path.join(self.entries_dir, old["id"]), ignore_errors=True)
+            entries = [e for e in entries if e["fingerprint"] != fingerprint]
+            entries.append(entry)
+            self._save_index(entries)
+            # 作り直しで置き換えたエントリだけが使っていたMP3も消す
+            self._collect_audio(entries)
+        return entry
+
+    def delete(self, entry_id):
+        with _lock:
+            entries = self._load_index()
+            self._save_index([e for e in entries if e["id"] != entry_id])
+            shutil.rmtree(os.path.join(self.entries_dir, entry_id), ignore_errors=True)
+            self._collect_audio([e for e in entries if e["id"] != entry_id])
+
+    def _collect_audio(self, entries):
+        # どのエントリからも参照されなくなったMP3だけを消す（_lock の中で呼ぶ）
+        used = {t["sha256"] for e in entries for t in e["tracks"]}
+        for name in os.listdir(self.audio_dir):
+            if name.endswith(".mp3") and name[:-4] not in used:
+                os.remove(os.path.join(self.audio_dir, name))
+
+    def html_path(self, entry):
+        return os.path.join(self.entries_dir, entry["id"], "player.html")
+
+    def html_bytes(self, entry):
+        with open(self.html_path(entry), "rb") as f:
+            return f.read()
+
+    def menu_data(self, entry):
+        with open(os.path.join(self.entries_dir, entry["id"], "menu.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def variants(self, entry):
+        # 声・言語ごとに、生成時と同じ形式 {"title", "path"} のトラック一覧へ分けて返す
+        variants = {}
+        for t in entry["tracks"]:
+            v = variants.setdefault(t.get("variant", ""), {"label": t.get("variant", ""), "tracks": []})
+            v["tracks"].append({"title": t["title"], "path": os.path.join(self.audio_dir, f"{t['sha256']}.mp3")})
+        return list(variants.values())
+
+    def tracks(self, entry):
+        return self.variants(entry)[0]["tracks"]
+
+    def write_zip(self, entry, file):
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as z:
+            for t in entry["tracks"]:
+                z.write(os.path.join(self.audio_dir, f"{t['sha256']}.mp3"), t["filename"])
+        return file
+
+    def zip_bytes(self, entry):
+        return self.write_zip(entry, io.BytesIO()).getvalue()
@@ -0,0 +1,125 @@
+# AIの出力（JSON）の読み取り
+# - Gemini にはJSONで返すよう指定する（response_mime_type とスキーマ）が、指定に対応していないモデルや出力の上限で、
+#   前後の説明文・```・余計な括弧・末尾のカンマ・途中で切れた配列が混ざることがある
+# - そのまま読めなければ、配列の要素を1つずつ読み、読めた要素だけを残す（要素の中の末尾のカンマは直してから読む）
+# - 配列が閉じていない（途中で切れた）ことも返すので、呼び出し側は続きだけをモデルに頼める（menu_pipeline.read_menu_json）
+# - 読み取りの結果（そのまま・修復・途中で切れた・続きの取得・失敗）をプロセス全体で数える（json_usage）
+import json
+import re
+import threading
+
+FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+TRAILING_COMMA = re.compile(r",\s*([}\]])")
+ARRAY_OF_OBJECTS = re.compile(r"\[\s*\{")
+STRING_OR_ARRAY_VALUE = re.compile(r'"(\w+)"\s*:\s*("(?:[^"\\]|\\.)*"|\[)')
+decoder = json.JSONDecoder(strict=False)
+
+_lock = threading.Lock()
+_stats = {"responses": 0, "clean": 0, "repaired": 0, "truncated": 0, "continuations": 0, "failed": 0}
+
+
+def count_json(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def json_usage():
+    with _lock:
+        return dict(_stats)
+
+
+def strip_fences(text):
+    return FENCE.sub("", text.strip())
+
+
+def find_closing(text, start):
+    # start の { か [ に対応する括弧の次の位置（文字列の中の括弧は数えない）。閉じていなければ None
+    depth, in_string, escaped = 0, False, False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped: escaped = False
+            elif c == "\\": escaped = True
+            elif c == '"': in_string = False
+        elif c == '"': in_string = True
+        elif c in "{[": depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0: return i + 1
+    return None
+
+
+def read_element(text, pos):
+    # pos の { から要素を1つ読む。(要素, 次の位置, 直したか)。閉じていなければ次の位置は None、直しても読めなければ要素は None
+    try:
+        item, end = decoder.raw_decode(text, pos)
+        return item, end, False
+    except ValueError:
+        pass
+    end = find_closing(text, pos)
+    if end is None: return None, None, False
+    try:
+        return json.loads(TRAILING_COMMA.sub(r"\1", text[pos:end]), strict=False), end, True
+    except ValueError:
+        return None, end, True
+
+
+def parse_array(text):
+    # オブジェクトの配列を読む。(要素のリスト, 状態, 最後に読めた要素までの出力)
+    # 状態: "ok"（そのまま読めた）/ "repaired"（直して読んだ）/ "truncated"（途中で切れていた）/ None（配列が見つからない）
+    text = strip_fences(text)
+    try:
+        data = json.loads(text, strict=False)
+        if isinstance(data, list): return data, "ok", text
+        if isinstance(data, dict):
+            # {"categories": [...]} のように包まれていたとき
+            for value in data.values():
+                if isinstance(value, list): return value, "ok", text
+    except ValueError:
+        pass
+    # 説明文や余計な括弧があっても、オブジェクトの配列の始まり（[ の次が {）から読む
+    m = ARRAY_OF_OBJECTS.search(text)
+    if not m: return [], None, ""
+    items, pos, last = [], m.start() + 1, m.start() + 1
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,": pos += 1
+        if pos >= len(text): return items, "truncated", text[:last]
+        if text[pos] == "]": return items, "repaired", text[:pos + 1]
+        if text[pos] != "{":
+            # 要素の間の余計な文字は読み飛ばす
+            nxt = min([i for i in (text.find("{", pos), text.find("]", pos)) if i != -1], default=-1)
+            if nxt == -1: return items, "truncated", text[:last]
+            pos = nxt
+            continue
+        item, end, _ = read_element(text, pos)
+        if end is None: return items, "truncated", text[:last]
+        if item is not None: items.append(item)
+        pos = last = end
+
+
+def parse_object(text):
+    # オブジェクトを読む。(オブジェクト, 状態)。途中で切れていれば、文字列の値と、配列の値の読めた要素までを拾う
+    text = strip_fences(text)
+    try:
+        data = json.loads(text, strict=False)
+        if isinstance(data, dict): return data, "ok"
+    except ValueError:
+        pass
+    start = text.find("{")
+    if start == -1: return None, None
+    end = find_closing(text, start)
+    if end is not None:
+        try:
+            return json.loads(TRAILING_COMMA.sub(r"\1", text[start:end]), strict=False), "repaired"
+        except ValueError:
+            pass
+    data = {}
+    for m in STRING_OR_ARRAY_VALUE.finditer(text, start):
+        key, value = m.group(1), m.group(2)
+        if key in data: continue
+        if value == "[":
+            data[key] = parse_array(text[m.start(2):])[0]
+        else:
+            try: data[key] = json.loads(value, strict=False)
+            except ValueError: pass
+    return (data or None), "truncated"
@@ -0,0 +1,1032 @@
+# メニュー解析から音声・プレイヤー生成までの処理（Streamlitに依存しない部分）
+# 起動を速くするため、重いライブラリ（google.generativeai, edge_tts, gtts, bs4, PIL, requests）は
+# 各処理を最初に使うときに読み込む
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import re
+import unicodedata
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cancellation import count_cancelled
+from menu_json import count_json, parse_array, parse_object
+
+def sanitize_filename(name):
+    return re.sub(r'[\\/*?:"<>|]', "", name).replace(" ", "_").replace("　", "_")
+
+# 画像確認グリッド用のサムネイル
+THUMBNAIL_SIZE = (480, 480)
+
+def make_thumbnail_bytes(data, size=THUMBNAIL_SIZE):
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img.thumbnail(size)
+    if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=80)
+    return buf.getvalue()
+
+# URL入力: ページをブロックに分け、メニューらしさで採点して上位だけを予算内で使う
+MENU_TEXT_TOKEN_BUDGET = 6000
+BLOCK_TAGS = ["table", "ul", "ol", "dl", "section", "article", "div", "p", "li", "tr"]
+STRUCTURE_TAGS = ["table", "ul", "ol", "dl"]
+HEADING_TAGS = ["h1", "h2", "h3", "h4"]
+MIXED_BLOCK_CHARS = 1000  # 直下の文字と子のブロックをまとめる上限（ページ全体を包む要素はまとめない）
+PRICE_PATTERN = re.compile(r"\d[\d,，]*\s*円|[¥￥]\s*\d[\d,，]*|税込|税抜|\(税|（税")
+
+def estimate_tokens(text):
+    # 日本語は1文字≒1トークン、英数字は4文字≒1トークンとして概算する
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return len(text) - ascii_chars + ascii_chars // 4
+
+def text_owner(node):
+    # 文字の持ち主のブロック: 表・リストの中なら一番外側の表・リスト、それ以外は一番近いブロック要素（なければ None）
+    # あわせて、持ち主までの間にリンク（<a>）があるかを返す
+    nearest = outer = None
+    linked = in_link = False
+    for parent in node.parents:
+        if parent.name == "a": in_link = True
+        if parent.name in STRUCTURE_TAGS:
+            outer, linked = parent, in_link
+        elif nearest is None and parent.name in BLOCK_TAGS:
+            nearest, linked_nearest = parent, in_link
+    if outer is not None: return outer, linked
+    return nearest, (linked_nearest if nearest is not None else in_link)
+
+def extract_text_blocks(soup):
+    # ページを文書順に1回たどり、文字（<span>などのインライン要素の中も）を一番近いブロック要素ごとにまとめる
+    # 表・リストはまとめて1ブロック。ブロック要素の直下の文字が子のブロックと並ぶとき（<div><p>商品名</p><span>価格</span></div>）は、
+    # 小さければ子のブロックもまとめて1ブロックにする（商品名と価格を離さない）
+    # 見出し（h1〜h4）も同じ順にたどり、各ブロックには最初の文字より前の直近の見出しを付ける
+    from bs4 import NavigableString
+    blocks, heading, seq = {}, "", 0
+    for node in soup.descendants:
+        if getattr(node, "name", None) in HEADING_TAGS:
+            heading = node.get_text(" ", strip=True)
+            continue
+        if type(node) is not NavigableString or not node.strip(): continue
+        owner, linked = text_owner(node)
+        key = id(owner) if owner is not None else None
+        block = blocks.get(key)
+        if block is None:
+            block = blocks[key] = {"el": owner, "tag": owner.name if owner is not None else "body", "lines": [], "link_chars": 0, "heading": heading, "first": seq, "inline": False}
+            if block["tag"] == "table":
+                # 表は1行を「商品名 価格」のように1行のテキストにする
+                rows = [" ".join(c.get_text(" ", strip=True) for c in tr.find_all(["th", "td"])) for tr in owner.find_all("tr")]
+                block["lines"] = [(seq, row.strip()) for row in rows if row.strip()]
+                block["link_chars"] = sum(len(a.get_text(strip=True)) for a in owner.find_all("a"))
+        if block["tag"] != "table":
+            for line in node.splitlines():
+                if line.strip(): block["lines"].append((seq, line.strip()))
+            if linked: block["link_chars"] += len(node.strip())
+            # 見出しの文字は、子のブロックと並んでいてもまとめる理由にしない
+            if not node.find_parent(HEADING_TAGS): block["inline"] = True
+        seq += 1
+    # 子のブロックを、深いものから順に親（直近の、文字を持つブロック）へまとめる
+    def parent_block(block):
+        if block["el"] is None: return None
+        for parent in block["el"].parents:
+            if id(parent) in blocks: return blocks[id(parent)]
+        return blocks.get(None)
+    children = {}
+    for block in blocks.values():
+        parent = parent_block(block)
+        if parent is not None: children.setdefault(id(parent), []).append(block)
+    depth = lambda block: -1 if block["el"] is None else sum(1 for _ in block["el"].parents)
+    merged = set()
+    for block in sorted(blocks.values(), key=depth, reverse=True):
+        kids = children.get(id(block))
+        if not kids or not block["inline"] or block["tag"] in STRUCTURE_TAGS: continue
+        if sum(len(line) for b in [block] + kids for _, line in b["lines"]) > MIXED_BLOCK_CHARS: continue
+        for kid in kids:
+            block["lines"] += kid["lines"]
+            block["link_chars"] += kid["link_chars"]
+            if kid["first"] < block["first"]: block["first"], block["heading"] = kid["first"], kid["heading"]
+            merged.add(id(kid))
+        block["lines"].sort()
+    result = []
+    for block in sorted((b for b in blocks.values() if id(b) not in merged and b["lines"]), key=lambda b: b["first"]):
+        result.append({"tag": block["tag"], "lines": [line for _, line in block["lines"]], "link_chars": block["link_chars"],
+                       "heading": block["heading"], "order": len(result)})
+    return result
+
+def score_menu_block(block):
+    text = "\n".join(block["lines"])
+    prices = len(PRICE_PATTERN.findall(text))
+    # 商品名と価格の組（価格を含む短い行）の割合
+    item_lines = sum(1 for line in block["lines"] if len(line) <= 60 and PRICE_PATTERN.search(line))
+    density = item_lines / len(block["lines"])
+    score = prices * 3 + density * 10
+    if block["tag"] in STRUCTURE_TAGS and prices: score += 5
+    # リンクばかりのブロック（ナビゲーション・関連記事など）は減点
+    link_ratio = block["link_chars"] / max(1, len(text))
+    return score * (1 - link_ratio) - link_ratio * 5
+
+def select_menu_text(blocks, token_budget=MENU_TEXT_TOKEN_BUDGET):
+    ranked = sorted(blocks, key=score_menu_block, reverse=True)
+    selected, used = [], 0
+    for block in ranked:
+        if score_menu_block(block) <= 0: break
+        text = "\n".join(block["lines"])
+        cost = estimate_tokens(text)
+        if used + cost > token_budget: continue
+        selected.append(block)
+        used += cost
+    if not selected:
+        # メニューらしいブロックが無ければ、ページ先頭から予算分を使う
+        text = "\n".join(line for b in blocks for line in b["lines"])
+        while estimate_tokens(text) > token_budget: text = text[:int(len(text) * 0.9)]
+        return text
+    selected.sort(key=lambda b: b["order"])
+    # 見出し（「ランチ」「ドリンク」など）は、直前のブロックと変わるときだけ付ける
+    chunks, last_heading = [], None
+    for b in selected:
+        lines = b["lines"]
+        if b["heading"] and b["heading"] != last_heading and b["heading"] not in lines:
+            lines = [f"【{b['heading']}】"] + lines
+        last_heading = b["heading"]
+        chunks.append("\n".join(lines))
+    return "\n\n".join(chunks)
+
+def fetch_text_from_url(url, token_budget=MENU_TEXT_TOKEN_BUDGET):
+    import requests
+    from bs4 import BeautifulSoup
+    try:
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        response = requests.get(url, headers=headers, timeout=10)
+        response.encoding = response.apparent_encoding
+        soup = BeautifulSoup(response.text, 'html.parser')
+        for s in soup(["script", "style", "header", "footer", "nav"]): s.extract()
+        return select_menu_text(extract_text_blocks(soup), token_budget)
+    except: return None
+
+# --- メニュー解析（Gemini） ---
+# genai.configure() はプロセス全体の設定で、GenerativeModel は最初の呼び出しのときにそこからクライアントを取る
+# APIキーの違うセッションが同時に動くと他のキーで呼んでしまうので、キーごとにクライアントを作って渡す
+def api_clients(api_key):
+    from google.generativeai import client
+    manager = client._ClientManager()
+    manager.configure(api_key=api_key)
+    return manager
+
+def list_generate_models(api_key):
+    import google.generativeai as genai
+    return [m.name for m in genai.list_models(client=api_clients(api_key).get_default_client("model"))
+            if 'generateContent' in m.supported_generation_methods]
+
+def create_model(api_key, model_name):
+    import google.generativeai as genai
+    model = genai.GenerativeModel(model_name)
+    model._client = api_clients(api_key).get_default_client("generative")
+    return model
+
+def build_menu_prompt(user_dict):
+    # 辞書データの取得とJSON文字列化
+    user_dict_str = json.dumps(user_dict, ensure_ascii=False)
+    
+    return f"""
+            あなたは視覚障害者のためのメニュー読み上げデータ作成のプロです。
+            メニューの内容を解析し、聞きやすいように【5つ〜8つ程度の大きなカテゴリー】に分類してまとめてください。
+            
+            重要ルール:
+            1. メニュー項目1つごとに1つのカテゴリーを作らないこと。
+            2. 「前菜・サラダ」「メイン料理」「ご飯・麺」「ドリンク」「デザート」のようにグループ化する。
+            3. カテゴリー内のメニューは、挨拶などを抜きにして商品名と価格をテンポよく読み上げる文章にする。
+            4. 価格の数字には必ず「円」をつけて読み上げる（例：1000 -> 1000円）。
+            5. アレルギー、辛さ、量などの重要な注意書きは、省略せず商品名の後に補足して読み上げる。
+            
+            ★重要：以下の固有名詞・読み方辞書を必ず守ってください。
+            {user_dict_str}
+
+            出力フォーマット（JSONのみ）:
+            [
+              {{"title": "カテゴリー名（例：前菜・サラダ）", "text": "読み上げ文（例：まずは前菜です。シーザーサラダ800円。ポテトサラダ500円。なお、ドレッシングは別添え可能です。）"}},
+              {{"title": "カテゴリー名（例：メイン料理）", "text": "読み上げ文（例：続いてメインです。ハンバーグ定食1200円。ステーキ1500円。ご飯の大盛りは無料です。）"}}
+            ]
+            """
+
+# Geminiに返してもらうJSONの形（カテゴリーの配列）。指定に対応していないモデルには付けずに呼ぶ（model_router）
+MENU_SCHEMA = {"type": "array", "items": {"type": "object", "properties": {"title": {"type": "string"}, "text": {"type": "string"}}, "required": ["title", "text"]}}
+TRANSLATION_SCHEMA = {"type": "object", "properties": {"store_name": {"type": "string"}, "menu_title": {"type": "string"}, "categories": MENU_SCHEMA},
+                      "required": ["store_name", "menu_title", "categories"]}
+MAX_CONTINUATIONS = 2
+CONTINUE_PROMPT = "出力が途中で切れました。ここまでに出力した{count}件のカテゴリーは繰り返さず、その続きのカテゴリーだけを同じ形式のJSON配列で出力してください。続きがなければ [] を出力してください。"
+
+def json_config(schema):
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+def generate_with_retry(model, parts, on_retry=None, schema=None):
+    # 再試行とモデルの切り替えは model（model_router.RoutedModel）が行う
+    # schema: 渡されたときは、その形のJSONだけを返すように指定する
+    try: return model.generate_content(parts, on_retry=on_retry, **({"generation_config": json_config(schema)} if schema else {}))
+    except: return None
+
+def response_text(resp):
+    # 候補が空（安全フィルタなど）のときは .text が例外になる
+    try: return resp.text
+    except: return ""
+
+def menu_items(items):
+    return [{"title": str(item["title"]), "text": str(item["text"])} for item in items
+            if isinstance(item, dict) and item.get("title") and item.get("text")]
+
+def count_parse(status):
+    count_json("responses")
+    count_json({"ok": "clean", "repaired": "repaired", "truncated": "truncated"}.get(status, "failed"))
+
+def read_menu_json(model, parts, resp, on_retry=None, continuations=MAX_CONTINUATIONS):
+    # 解析の応答からカテゴリーのリストを読む（読めなければ None）
+    # 形が崩れていればその場で直し、途中で切れていれば、ここまでの出力を渡して続きだけを出力してもらう（解析をやり直さない）
+    items, status, prefix = parse_array(response_text(resp))
+    count_parse(status)
+    items = menu_items(items)
+    history = [{"role": "user", "parts": parts}]
+    while status == "truncated" and continuations:
+        continuations -= 1
+        count_json("continuations")
+        if on_retry: on_retry(f"AIの出力が途中で切れたため、続き（{len(items)}件目より後）だけを取得しています")
+        history += [{"role": "model", "parts": [prefix or "["]}, {"role": "user", "parts": [CONTINUE_PROMPT.format(count=len(items))]}]
+        resp = generate_with_retry(model, history, on_retry, MENU_SCHEMA)
+        if resp is None: break
+        more, status, prefix = parse_array(response_text(resp))
+        items += [item for item in menu_items(more) if item not in items]
+    return items or None
+
+# 写真の多いメニュー用: 画像をバッチに分けて並列に解析し、結果をまとめる
+BATCH_NOTE = """
+※これは複数枚に分かれたメニュー写真の一部です。後で他の写真の結果と統合するため、
+カテゴリー名は「前菜・サラダ」「メイン料理」「ご飯・麺」「ドリンク」「デザート」のような一般的な名前にしてください。
+"""
+
+STATUS_INTERVAL = 0.5
+
+def image_part(f):
+    f.seek(0)
+    return {"mime_type": f.type if hasattr(f, 'type') else 'image/jpeg', "data": f.getvalue()}
+
+def analyze_batch(model, prompt, images, retries=3, text=None, on_retry=None):
+    # 失敗したバッチはこのバッチだけを再試行する（呼び出しの失敗はモデルの切り替えで、ここでは直しても読めなかったときだけ）
+    # text: 画像の代わり（または画像に加えて）に渡すメニューの文字情報（PDFのテキストページなど）
+    parts = [prompt + BATCH_NOTE + (f"\n\n{text}" if text else "")] + [image_part(f) for f in images]
+    for _ in range(retries):
+        resp = generate_with_retry(model, parts, on_retry, MENU_SCHEMA)
+        if resp is None: return None
+        data = read_menu_json(model, parts, resp, on_retry)
+        if data: return data
+    return None
+
+def analyze_in_batches(model, prompt, images, batch_size, concurrency, progress_bar=None, on_retry=None):
+    # 再試行の知らせはバッチのスレッドから届くので、表示（on_retry）は進捗バーと同じくこのスレッドで行う
+    # 進捗バーは待つ間も更新し続ける（Streamlitから中止などを知らされる機会になる）。
+    # 例外で抜けたときは、まだ始まっていないバッチを取り消し、実行中のバッチを待たずに戻る
+    batches = [images[i:i+batch_size] for i in range(0, len(images), batch_size)]
+    results = [None] * len(batches)
+    notes = []
+    ex = ThreadPoolExecutor(max_workers=concurrency)
+    futures = {ex.submit(analyze_batch, model, prompt, b, on_retry=notes.append): i for i, b in enumerate(batches)}
+    try:
+        pending, done = set(futures), 0
+        while pending:
+            finished, pending = wait(pending, timeout=STATUS_INTERVAL, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                results[futures[fut]] = fut.result()
+                done += 1
+            if progress_bar: progress_bar.progress(done / len(batches))
+            if on_retry and notes: on_retry(notes[-1])
+            notes.clear()
+    finally:
+        count_cancelled("llm_calls", sum(fut.cancel() for fut in futures))
+        ex.shutdown(wait=False)
+    failed = [(i * batch_size + 1, i * batch_size + len(b)) for i, (b, r) in enumerate(zip(batches, results)) if r is None]
+    return [r for r in results if r], failed
+
+def normalize_title(title):
+    t = unicodedata.normalize("NFKC", title)
+    return re.sub(r"[\s・/、,&]", "", t).lower()
+
+def merge_categories(partials):
+    # 同じ（表記ゆれ程度の違いの）カテゴリーを1つにまとめ、重複した文は除く
+    merged = {}
+    for partial in partials:
+        for cat in partial:
+            key = normalize_title(cat['title'])
+            if key not in merged:
+                merged[key] = {"title": cat['title'], "sentences": []}
+            for sentence in re.split(r"(?<=。)", cat['text']):
+                sentence = sentence.strip()
+                if sentence and sentence not in merged[key]["sentences"]:
+                    merged[key]["sentences"].append(sentence)
+    return [{"title": m["title"], "text": "".join(m["sentences"])} for m in merged.values()]
+
+# --- 音声生成 ---
+# 声・言語の選択肢（ラベル -> (edge-ttsの声, 言語)）
+VOICE_OPTIONS = {
+    "女性（七海）": ("ja-JP-NanamiNeural", "ja"),
+    "男性（慶太）": ("ja-JP-KeitaNeural", "ja"),
+    "English 女性（Jenny）": ("en-US-JennyNeural", "en"),
+    "English 男性（Guy）": ("en-US-GuyNeural", "en"),
+}
+# 全ての声・言語のトラックで共有する、音声合成の同時実行数
+TTS_CONCURRENCY = 8
+
+# 「はじめに・目次」のうち、解析結果がなくても決まる文
+INTRO_NOTICE = {"ja": "このプレイヤーは、スクリーンリーダーでの操作に対応しています。", "en": "This player works with screen readers. "}
+INTRO_CLOSING = {"ja": "それではどうぞ。", "en": "Let's begin."}
+
+def intro_greeting(store_name, menu_title, lang="ja"):
+    if lang == "en":
+        greeting = f"Hello, welcome to {store_name}. "
+        if menu_title: greeting += f"Here is our {menu_title} menu. "
+        return greeting
+    greeting = f"こんにちは、{store_name}です。"
+    if menu_title: greeting += f"ただいまより{menu_title}をご紹介します。"
+    return greeting
+
+def build_intro_segments(store_name, menu_title, menu_data, lang="ja"):
+    # 「はじめに・目次」の文を、(文, 定型かどうか) の並びで返す
+    # 定型の部分（カテゴリー数だけで決まる文を含む）は、声・話速ごとにキャッシュした音声を使い回せる
+    key = "en" if lang == "en" else "ja"
+    if lang == "en":
+        count = f"The menu is divided into {len(menu_data)} categories. First, the table of contents. "
+        titles = "".join(f"{i+1}, {tr['title']}. " for i, tr in enumerate(menu_data))
+    else:
+        count = f"このメニューは、全部で{len(menu_data)}つのカテゴリーに分かれています。まずは目次です。"
+        titles = "".join(f"{i+1}、{tr['title']}。" for i, tr in enumerate(menu_data))
+    return [
+        (intro_greeting(store_name, menu_title, lang), False),
+        (INTRO_NOTICE[key], True),
+        (count, True),
+        (titles, False),
+        (INTRO_CLOSING[key], True),
+    ]
+
+def intro_track_title(lang="ja"):
+    return "Introduction / Contents" if lang == "en" else "はじめに・目次"
+
+def translate_once(model, data, lang, on_retry=None):
+    prompt = f"""
+    Translate this restaurant menu data for a text-to-speech menu player into natural, spoken {"English" if lang == "en" else lang}.
+    Keep the JSON structure and the number of categories. Read prices like "1200 yen". Romanize the store name.
+    Output JSON only: {{"store_name": "...", "menu_title": "...", "categories": [{{"title": "...", "text": "..."}}]}}
+
+    {json.dumps(data, ensure_ascii=False)}
+    """
+    resp = model.generate_content(prompt, on_retry=on_retry, generation_config=json_config(TRANSLATION_SCHEMA))
+    result, status = parse_object(response_text(resp))
+    count_parse(status if result else None)
+    return result
+
+def translate_menu(model, menu_data, store_name, menu_title, lang, on_retry=None, continuations=MAX_CONTINUATIONS):
+    # 解析済みのmenu_dataを翻訳する（画像の再解析はしない）
+    # 出力が途中で切れてカテゴリーが足りないときは、足りないカテゴリーだけをもう一度翻訳する
+    result = translate_once(model, {"store_name": store_name, "menu_title": menu_title, "categories": menu_data}, lang, on_retry)
+    if result is None: raise ValueError("翻訳の結果を読み取れませんでした")
+    categories = menu_items(result.get("categories") or [])
+    while len(categories) < len(menu_data) and continuations:
+        continuations -= 1
+        count_json("continuations")
+        if on_retry: on_retry(f"翻訳が途中で切れたため、残り{len(menu_data) - len(categories)}件のカテゴリーだけを翻訳しています")
+        rest = translate_once(model, {"categories": menu_data[len(categories):]}, lang, on_retry)
+        if not rest: break
+        categories += menu_items(rest.get("categories") or [])[:len(menu_data) - len(categories)]
+    return {**result, "categories": categories}
+
+async def synthesize_edge(text, filename, voice_code, rate_value, pool=None):
+    # pool: 渡されたときは、接続を使い回す TTSPool で合成する
+    # プールは edge_tts の内部の手順で合成するので、失敗したら（手順が変わったときも）このチャプターは Communicate で合成し直す
+    import edge_tts
+    for attempt in range(3):
+        try:
+            if pool:
+                try: await pool.synthesize(text, voice_code, rate_value, filename)
+                except asyncio.CancelledError: raise
+                except: pass
+                if os.path.exists(filename) and os.path.getsize(filename) > 0:
+                    return True
+                pool = None
+            comm = edge_tts.Communicate(text, voice_code, rate=rate_value)
+            await comm.save(filename)
+            if os.path.exists(filename) and os.path.getsize(filename) > 0:
+                return True
+        except asyncio.CancelledError:
+            raise
+        except:
+            await asyncio.sleep(1)
+    return False
+
+async def generate_single_track_fast(text, filename, voice_code, rate_value, lang="ja", pool=None):
+    if await synthesize_edge(text, filename, voice_code, rate_value, pool):
+        return True
+    try:
+        def gtts_task():
+            from gtts import gTTS
+            tts = gTTS(text=text, lang=lang)
+            tts.save(filename)
+        await asyncio.to_thread(gtts_task)
+        return True
+    except asyncio.CancelledError:
+        raise
+    except:
+        return False
+
+def id3v2_length(data):
+    if data[:3] != b"ID3" or len(data) < 10: return 0
+    return 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+
+def strip_id3(data):
+    # MP3をつなぐときに、先頭のID3v2タグと末尾のID3v1タグを除く
+    data = data[id3v2_length(data):]
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return data
+
+def concat_mp3(paths, filename):
+    # MP3はフレームの並びなので、タグを除いてそのまま連結すれば1つのファイルとして再生できる
+    with open(filename, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                out.write(strip_id3(f.read()))
+    return filename
+
+async def generate_segmented_track(segments, filename, voice_code, rate_value, lang, cache, limit, pool=None, prepared=None):
+    # 定型文はキャッシュから、店ごとに変わる部分だけを合成して1つのトラックにつなぐ
+    # prepared: presynthesize_intro が解析中に先に合成した文 {(文, 声): Task}。同じ文ならその音声を使う
+    # どこかの合成に失敗したときは、全文を1回で合成する（gTTSへの切り替えも含めて通常と同じ）
+    part_paths = [f"{filename}.part{i}" for i in range(len(segments))]
+    async def one(i, text, fixed):
+        if fixed:
+            return await cache.get(text, voice_code, rate_value, lambda path: limit(synthesize_edge(text, path, voice_code, rate_value, pool)))
+        task = (prepared or {}).get((text, voice_code))
+        if task:
+            path = await asyncio.shield(task)
+            if path: return path
+        return part_paths[i] if await limit(synthesize_edge(text, part_paths[i], voice_code, rate_value, pool)) else None
+    try:
+        paths = await asyncio.gather(*[one(i, text, fixed) for i, (text, fixed) in enumerate(segments) if text])
+        if all(paths):
+            concat_mp3(paths, filename)
+            return True
+    finally:
+        for path in part_paths:
+            if os.path.exists(path): os.remove(path)
+    return await limit(generate_single_track_fast("".join(text for text, _ in segments), filename, voice_code, rate_value, lang, pool))
+
+async def presynthesize_intro(prepared, store_name, menu_title, voices, rate_value, segment_cache, work_dir, slot=None, pool=None, warm=TTS_CONCURRENCY):
+    # AI解析を待つ間に、解析結果がなくても決まる「はじめに・目次」の文を合成し、音声合成の接続も開いておく
+    # voices: [(声, 言語)]。定型文は全ての声で、あいさつ（店名・メニュー名）は翻訳しない日本語の声だけで作る
+    # prepared: あいさつの合成を {(文, 声): Task} で入れる。最初のawaitより前に入れ終わるので、
+    #           あとから共有ループへ投入した process_all_tracks_fast は必ずこれを見られる
+    limit = slot or (lambda coro: coro)
+    async def speculate(text, path, voice_code):
+        return path if await limit(synthesize_edge(text, path, voice_code, rate_value, pool)) else None
+    async def fixed(text, voice_code):
+        return await segment_cache.get(text, voice_code, rate_value, lambda path: limit(synthesize_edge(text, path, voice_code, rate_value, pool)))
+    tasks = []
+    for n, (voice_code, lang) in enumerate(voices):
+        key = "en" if lang == "en" else "ja"
+        if lang == "ja":
+            greeting = intro_greeting(store_name, menu_title, lang)
+            prepared[(greeting, voice_code)] = asyncio.ensure_future(speculate(greeting, os.path.join(work_dir, f"greeting_{n}.mp3"), voice_code))
+            tasks.append(prepared[(greeting, voice_code)])
+        tasks += [asyncio.ensure_future(fixed(INTRO_NOTICE[key], voice_code)), asyncio.ensure_future(fixed(INTRO_CLOSING[key], voice_code))]
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # 先に合成した接続はプールに戻っているので、足りない分だけ開く
+    if pool: await pool.warm(warm)
+
+async def process_all_tracks_fast(variants, rate_value, on_progress=None, concurrency=TTS_CONCURRENCY, slot=None, segment_cache=None, tts_pool=None, prepared=None):
+    # variants: [{"label", "voice", "lang", "menu_data", "output_dir", "intro_segments"(任意)}]
+    # 全ての声・言語のトラックを1つの同時実行枠の中で並列に生成し、各variantに"tracks"を入れて返す
+    # slot: 全セッション共通の同時実行枠（TTSLoop.slot）。渡されたときはその枠の中で合成する
+    # segment_cache: 渡されたときは、「はじめに・目次」を定型文のキャッシュとつないで作る
+    # tts_pool: 渡されたときは、edge-tts の接続を使い回す（TTSPool）
+    # prepared: presynthesize_intro で先に合成した「はじめに・目次」の文
+    # on_progress(completed, total): ループのスレッドから呼ばれるので、Streamlitの部品は直接触らないこと
+    sem = asyncio.Semaphore(concurrency)
+    async def limit(coro):
+        try:
+            async with sem:
+                return await (slot(coro) if slot else coro)
+        finally:
+            coro.close()  # 枠を待つ間に取り消されて実行しなかった合成を閉じる（実行済みなら何もしない）
+
+    tasks = []
+    for v in variants:
+        v["tracks"] = []
+        for i, track in enumerate(v["menu_data"]):
+            safe_title = sanitize_filename(track['title'])
+            filename = f"{i+1:02}_{safe_title}.mp3"
+            save_path = os.path.join(v["output_dir"], filename)
+            speech_text = track['text']
+            
+            # i=0 (はじめに) は番号なし
+            # i=1 (最初の料理) を「1番」とする
+            if i > 0: 
+                 speech_text = f"{i}. {track['title']}.\n{track['text']}" if v["lang"] == "en" else f"{i}、{track['title']}。\n{track['text']}"
+                 
+            if i == 0 and segment_cache and v.get("intro_segments"):
+                tasks.append(generate_segmented_track(v["intro_segments"], save_path, v["voice"], rate_value, v["lang"], segment_cache, limit, tts_pool, prepared))
+            else:
+                tasks.append(limit(generate_single_track_fast(speech_text, save_path, v["voice"], rate_value, v["lang"], tts_pool)))
+            v["tracks"].append({"title": track['title'], "path": save_path})
+    
+    tasks = [asyncio.ensure_future(task) for task in tasks]
+    total = len(tasks)
+    completed = 0
+    try:
+        for task in asyncio.as_completed(tasks):
+            await task
+            completed += 1
+            if on_progress: on_progress(completed, total)
+    except asyncio.CancelledError:
+        # 作成が中止されたら、まだ終わっていないトラックの合成も取り消す（途中のファイルは呼び出し元で消す）
+        pending = [task for task in tasks if not task.done()]
+        for task in pending: task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        count_cancelled("tts_tasks", len(pending))
+        raise
+    return variants
+
+# HTMLプレイヤー生成
+# 音声はチャンク単位でbase64化し、テンプレートの部品と一緒に順次書き出す
+# (MP3全体・base64文字列・JSON・置換後HTMLを同時にメモリに持たないため)
+B64_CHUNK_SIZE = 3 * 64 * 1024
+
+PLAYER_HTML_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>__STORE_NAME__ 音声メニュー</title>
+<style>
+body{font-family:sans-serif;background:#f4f4f4;margin:0;padding:20px;line-height:1.6;}
+.c{max-width:600px;margin:0 auto;background:#fff;padding:20px;border-radius:15px;box-shadow:0 2px 10px rgba(0,0,0,0.1);}
+h1{text-align:center;font-size:1.5em;color:#333;margin-bottom:10px;}
+h2{font-size:1.2em;color:#555;margin-top:20px;margin-bottom:10px;border-bottom:2px solid #eee;padding-bottom:5px;}
+.box{background:#fff5f5;border:2px solid #ff4b4b;border-radius:10px;padding:15px;text-align:center;margin-bottom:20px;}
+.ti{font-size:1.3em;font-weight:bold;color:#b71c1c;}
+.ctrl{display:flex;gap:15px;margin:20px 0;justify-content:center;}
+button{
+    flex:1;
+    padding:15px 0;
+    font-size:1.8em; 
+    font-weight:bold;
+    color:#fff;
+    background:#ff4b4b; 
+    border:none;
+    border-radius:8px; 
+    cursor:pointer;
+    min-height:60px;
+    display:flex; justify-content:center; align-items:center;
+    transition:background 0.2s;
+}
+button:hover{background:#e04141;}
+button:focus, .map-btn:focus, select:focus, .itm:focus{outline:3px solid #333; outline-offset: 2px;}
+.map-btn{display:inline-block; padding:12px 20px; background-color:#4285F4; color:white; text-decoration:none; border-radius:8px; font-weight:bold; box-shadow:0 2px 5px rgba(0,0,0,0.2);}
+.lst{border-top:1px solid #eee;padding-top:10px;}
+.itm{padding:15px;border-bottom:1px solid #eee;cursor:pointer; font-size:1.1em;}
+.itm:hover{background:#f9f9f9;}
+.itm.active{background:#ffecec;color:#b71c1c;font-weight:bold;border-left:5px solid #ff4b4b;}
+</style></head>
+<body>
+<main class="c" role="main">
+    <h1>🎧 __STORE_NAME__</h1>
+    __MAP_BUTTON__
+    <section aria-label="再生状況">
+        <div class="box"><div class="ti" id="ti" aria-live="polite">Loading...</div></div>
+    </section>
+    <audio id="au" style="width:100%" aria-label="メニュー読み上げプレイヤー"></audio>
+    <section class="ctrl" aria-label="再生コントロール">
+        <button onclick="prev()" aria-label="前のチャプターへ">⏮</button>
+        <button onclick="toggle()" id="pb" aria-label="再生">▶</button>
+        <button onclick="next()" aria-label="次のチャプターへ">⏭</button>
+    </section>
+    <div style="text-align:center;margin-bottom:20px;">
+        <label for="sp" style="font-weight:bold; margin-right:5px;">読み上げ速度:</label>
+        <select id="sp" onchange="csp()" style="font-size:1rem; padding:5px;">
+            <option value="0.8">0.8 (ゆっくり)</option>
+            <option value="1.0" selected>1.0 (標準)</option>
+            <option value="1.2">1.2 (やや速い)</option>
+            <option value="1.5">1.5 (速い)</option>
+        </select>
+    </div>
+    <div id="vw" style="text-align:center;margin-bottom:20px;" hidden>
+        <label for="vo" style="font-weight:bold; margin-right:5px;">声・言語:</label>
+        <select id="vo" onchange="cvo()" style="font-size:1rem; padding:5px;"></select>
+    </div>
+    <h2>📜 チャプター一覧</h2>
+    <div id="ls" class="lst" role="list" aria-label="メニューのチャプター一覧"></div>
+</main>
+<script>
+const vs=__VARIANTS_JSON__;let pl=vs[0].tracks;let idx=0;
+const au=document.getElementById('au');
+const ti=document.getElementById('ti');
+const pb=document.getElementById('pb');
+const its=[];
+const bl={};
+const fs={};
+const pre=new Audio();pre.preload="auto";
+function init(){ivo();ren();ld(0);csp();}
+// 声・言語の切り替え（2つ以上あるときだけ表示）
+function ivo(){
+    document.documentElement.lang=vs[0].lang;
+    if(vs.length<2)return;
+    const s=document.getElementById('vo');
+    vs.forEach((v,i)=>{const o=document.createElement('option');o.value=i;o.innerText=v.label;s.appendChild(o);});
+    document.getElementById('vw').hidden=false;
+}
+function cvo(){
+    const playing=!au.paused;
+    const v=vs[parseInt(document.getElementById('vo').value)];
+    pl=v.tracks;
+    document.documentElement.lang=v.lang;
+    for(const k in bl){URL.revokeObjectURL(bl[k]);delete bl[k];}
+    for(const k in fs)delete fs[k];
+    // 声ごとにチャプターの数が違うことがある（音声のないチャプターは除くため）ので、一覧を作り直し、位置を範囲内に収める
+    document.getElementById('ls').replaceChildren();its.length=0;
+    ren();
+    idx=Math.min(idx,pl.length-1);
+    ld(idx);
+    if(playing)au.play();
+}
+function lbl(i){return i>0?i+". "+pl[i].title:pl[i].title;}
+function ld(i){
+    its[idx].classList.remove("active");
+    idx=i;
+    att(idx);
+    // 先読みした音声は今と次のチャプターの分だけ残す（埋め込みのbase64とは別に、全チャプターの音声を持ち続けないように）
+    for(const k in bl){if(k!=idx&&k!=idx+1){URL.revokeObjectURL(bl[k]);delete bl[k];}}
+    ti.innerText=pl[idx].title;
+    its[idx].classList.add("active");
+    csp();
+    pf(idx+1);
+}
+// 分割版（segsがある）: MediaSourceが使えれば、最初の区切りが届いた時点で再生を始めて残りを順に足す
+// 使えなければHLS、それもだめなら通常のMP3を読む
+const mse=!!(window.MediaSource&&MediaSource.isTypeSupported('audio/mpeg'));
+const hls=!!au.canPlayType('application/vnd.apple.mpegurl');
+let ms=null;
+function att(i){
+    const t=pl[i];
+    if(ms){URL.revokeObjectURL(au.src);ms=null;}
+    if(t.segs&&mse){stm(t,i);return;}
+    if(t.m3u8&&hls){au.src=t.m3u8;return;}
+    au.src=bl[i]||t.src;
+}
+function stm(t,i){
+    const m=new MediaSource();ms=m;
+    au.src=URL.createObjectURL(m);
+    m.addEventListener('sourceopen',()=>{
+        if(ms!==m)return;
+        if(t.dur)m.duration=t.dur;
+        const sb=m.addSourceBuffer('audio/mpeg');
+        sb.mode='sequence';
+        let n=0;
+        const add=()=>{
+            if(ms!==m)return;
+            if(n>=t.segs.length){if(m.readyState==='open')m.endOfStream();return;}
+            const k=n++;
+            (k===0&&fs[i]?Promise.resolve(fs[i]):fetch(t.segs[k]).then(r=>{if(!r.ok)throw r;return r.arrayBuffer();}))
+                .then(b=>{if(ms===m)sb.appendBuffer(b);})
+                .catch(()=>{if(ms===m){URL.revokeObjectURL(au.src);ms=null;const p=!au.paused;au.src=t.src;if(p)au.play();}});
+        };
+        sb.addEventListener('updateend',add);
+        add();
+    },{once:true});
+}
+// 再生中に次のチャプターを読み込み・デコードしておく（分割版は最初の区切りだけ）
+function pf(i){
+    if(i>=pl.length)return;
+    const p=pl;
+    if(pl[i].segs&&mse){
+        if(!fs[i])fetch(pl[i].segs[0]).then(r=>r.arrayBuffer()).then(b=>{if(p===pl)fs[i]=b;}).catch(()=>{});
+        return;
+    }
+    if(pl[i].m3u8&&hls)return;
+    if(bl[i]){pre.src=bl[i];pre.load();return;}
+    fetch(pl[i].src).then(r=>r.blob()).then(b=>{
+        if(p!==pl)return;
+        bl[i]=URL.createObjectURL(b);
+        if(i===idx+1){pre.src=bl[i];pre.load();}
+    }).catch(()=>{});
+}
+function toggle(){
+    if(au.paused){
+        au.play();
+        pb.innerText="⏸";
+        pb.setAttribute("aria-label", "一時停止");
+    }else{
+        au.pause();
+        pb.innerText="▶";
+        pb.setAttribute("aria-label", "再生");
+    }
+}
+function next(){
+    if(idx<pl.length-1){
+        ld(idx+1);
+        au.play();
+        pb.innerText="⏸";
+        pb.setAttribute("aria-label", "一時停止");
+    }
+}
+function prev(){
+    if(idx>0){
+        ld(idx-1);
+        au.play();
+        pb.innerText="⏸";
+        pb.setAttribute("aria-label", "一時停止");
+    }
+}
+function csp(){au.playbackRate=parseFloat(document.getElementById('sp').value);}
+au.onended=function(){
+    if(idx<pl.length-1){ next(); }
+    else { pb.innerText="▶"; pb.setAttribute("aria-label", "再生");}
+};
+// 一覧は最初と声の切り替えのときだけ作り、以降はld()でactiveのクラスだけ付け替える
+function ren(){
+    const d=document.getElementById('ls');
+    pl.forEach((t,i)=>{
+        const m=document.createElement('div');
+        m.className="itm";
+        m.setAttribute("role", "listitem");
+        m.setAttribute("tabindex", "0");
+        
+        let label = lbl(i);
+        
+        m.setAttribute("aria-label", label);
+        m.innerText=label;
+        m.onclick=()=>{ld(i);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");};
+        m.onkeydown=(e)=>{if(e.key==='Enter'||e.key===' '){e.preventDefault();m.click();}};
+        d.appendChild(m);
+        its.push(m);
+    });
+}
+init();
+</script></body></html>"""
+
+PLAYER_TEMPLATE_PARTS = re.split(r"(__STORE_NAME__|__MAP_BUTTON__|__VARIANTS_JSON__)", PLAYER_HTML_TEMPLATE)
+
+def iter_base64_file(file_path, chunk_size=B64_CHUNK_SIZE):
+    # chunk_sizeは3の倍数なので、チャンクごとのbase64を連結しても正しい
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: break
+            yield base64.b64encode(chunk).decode()
+
+def iter_playlist_json(tracks):
+    yield "["
+    first = True
+    for track in tracks:
+        if not os.path.exists(track['path']): continue
+        if not first: yield ", "
+        first = False
+        yield '{"title": ' + json.dumps(track['title'], ensure_ascii=False) + ', "src": "data:audio/mp3;base64,'
+        yield from iter_base64_file(track['path'])
+        yield '"}'
+    yield "]"
+
+def iter_variants_json(variants):
+    # variants: [{"label", "lang", "tracks"}] 声・言語ごとのプレイリスト
+    yield "["
+    for n, v in enumerate(variants):
+        if n: yield ", "
+        yield '{"label": ' + json.dumps(v['label'], ensure_ascii=False) + ', "lang": ' + json.dumps(v['lang']) + ', "tracks": '
+        yield from iter_playlist_json(v['tracks'])
+        yield "}"
+    yield "]"
+
+def iter_standalone_html_player(store_name, variants, map_url="", variants_json=None):
+    # variants_json: 音声を埋め込まない版（分割版など）で、プレイリストのJSONをそのまま渡すとき
+    map_button_html = ""
+    if map_url:
+        map_button_html = f"""
+        <div style="text-align:center; margin-bottom: 15px;">
+            <a href="{map_url}" target="_blank" role="button" aria-label="地図・アクセス（Googleマップが別タブで開きます）" class="map-btn">
+                🗺️ 地図・アクセス (Google Map)
+            </a>
+        </div>
+        """
+    values = {"__STORE_NAME__": store_name, "__MAP_BUTTON__": map_button_html}
+    for part in PLAYER_TEMPLATE_PARTS:
+        if part == "__VARIANTS_JSON__":
+            if variants_json is not None: yield variants_json
+            else: yield from iter_variants_json(variants)
+        else:
+            yield values.get(part, part)
+
+def write_standalone_html_player(file_path, store_name, variants, map_url="", token=None):
+    # 別名で書いてから置き換える（中止・失敗したときに、前回の結果を壊さず、途中のファイルも残さない）
+    # token: 渡されたときは、チャンクごとに中止されていないか確かめる
+    tmp = f"{file_path}.part"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            for chunk in iter_standalone_html_player(store_name, variants, map_url):
+                if token: token.check()
+                f.write(chunk)
+        os.replace(tmp, file_path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    return file_path
+
+def write_zip(zip_path, src_dir, compression=zipfile.ZIP_DEFLATED, token=None):
+    # src_dir の中身をZIPにする。書き方は write_standalone_html_player と同じ
+    tmp = f"{zip_path}.part"
+    try:
+        with zipfile.ZipFile(tmp, 'w', compression) as z:
+            for root, dirs, files in os.walk(src_dir):
+                for file in files:
+                    if token: token.check()
+                    z.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), src_dir))
+        os.replace(tmp, zip_path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    return zip_path
+
+# --- 分割（ストリーミング）版の書き出し ---
+# 各チャプターのMP3をフレームの境目で短い区切りに分け、HLSのプレイリスト（m3u8）とプレイヤー用の一覧を付ける
+# プレイヤーは MediaSource が使えれば最初の区切りが届いた時点で再生を始め、残りを順に読み込む
+# 使えなければHLS（iPhoneなど）、それもだめなら通常のMP3で再生する。Webサーバーに置いて使う
+STREAM_SEGMENT_SECONDS = 2.0
+STREAM_FIRST_SEGMENT_SECONDS = 1.0  # 最初の音が出るまでを短くするため、先頭の区切りだけ短くする
+MP3_SYNC_FRAMES = 4
+MP3_MIN_COVERAGE = 0.9
+
+# MPEGオーディオのフレームヘッダー: (バージョン, レイヤー) ごとのビットレート(kbps)
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_BITRATES[(2, 3)] = MP3_BITRATES[(2, 2)]
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+def mp3_frame(data, pos):
+    # pos からのフレームヘッダーを読み、(長さ, 秒数) を返す。ヘッダーとして読めなければ None
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0: return None
+    b1, b2 = data[pos + 1], data[pos + 2]
+    version = {3: 1, 2: 2, 0: 2.5}.get((b1 >> 3) & 3)
+    layer = {3: 1, 2: 2, 1: 3}.get((b1 >> 1) & 3)
+    bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+    if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3: return None
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 1
+    if layer == 1:
+        samples, length = 384, (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and version != 1:
+        samples, length = 576, 72 * bitrate // sample_rate + padding
+    else:
+        samples, length = 1152, 144 * bitrate // sample_rate + padding
+    return length, samples / sample_rate
+
+def mp3_synced(data, pos, stop=None, frames=MP3_SYNC_FRAMES):
+    # pos から frames 個のフレームが、ヘッダーから計算した長さちょうどの位置に続いているか（途中でデータが終わるのはよい）
+    stop = len(data) if stop is None else stop
+    for _ in range(frames):
+        frame = mp3_frame(data, pos)
+        if frame is None or pos + frame[0] > stop: return False
+        pos += frame[0]
+        if pos == stop: return True
+    return True
+
+def is_mp3(data):
+    # 先頭（ID3v2タグの後）からMP3のフレームが続いているか
+    return mp3_synced(data, id3v2_length(data))
+
+def iter_mp3_frames(data):
+    # (開始位置, 長さ, 秒数) を順に返す。フレームとして読めないところ（タグなど）は飛ばす
+    # 偶然ヘッダーに見えるバイト列を拾わないよう、同期を取るときは MP3_SYNC_FRAMES 個のフレームが続くことを確かめる
+    pos = id3v2_length(data)
+    stop = len(data) - 128 if data[-128:-125] == b"TAG" else len(data)
+    synced = False
+    while pos + 4 <= stop:
+        frame = mp3_frame(data, pos)
+        if frame is None or pos + frame[0] > stop or not (synced or mp3_synced(data, pos, stop)):
+            synced = False
+            pos += 1
+            continue
+        synced = True
+        yield pos, frame[0], frame[1]
+        pos += frame[0]
+
+def split_mp3(data, seconds=STREAM_SEGMENT_SECONDS, first_seconds=STREAM_FIRST_SEGMENT_SECONDS):
+    # フレームの境目で、おおよそseconds秒ずつの区切りに分ける: [(バイト列, 秒数)]
+    # フレームがデータの大半（MP3_MIN_COVERAGE）を占めなければ、MP3ではないとみなして [] を返す（区切らずに通常版で再生する）
+    frames = list(iter_mp3_frames(data))
+    if sum(length for _, length, _ in frames) < len(strip_id3(data)) * MP3_MIN_COVERAGE: return []
+    segments, start, end, duration = [], None, 0, 0.0
+    for pos, length, frame_seconds in frames:
+        if start is None: start = pos
+        end, duration = pos + length, duration + frame_seconds
+        if duration >= (first_seconds if not segments else seconds):
+            segments.append((data[start:end], duration))
+            start, duration = None, 0.0
+    if start is not None:
+        segments.append((data[start:end], duration))
+    return segments
+
+def hls_timestamp_tag(seconds):
+    # HLSのパックドオーディオでは、各区切りの先頭に開始時刻（90kHz）を入れたID3タグを付ける
+    owner = b"com.apple.streaming.transportStreamTimestamp\x00"
+    payload = owner + (int(seconds * 90000) & ((1 << 33) - 1)).to_bytes(8, "big")
+    synchsafe = lambda n: bytes([(n >> 21) & 0x7F, (n >> 14) & 0x7F, (n >> 7) & 0x7F, n & 0x7F])
+    frame = b"PRIV" + synchsafe(len(payload)) + b"\x00\x00" + payload
+    return b"ID3\x04\x00\x00" + synchsafe(len(frame)) + frame
+
+def build_m3u8(segment_names, durations):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(durations, default=1)))}",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for name, duration in zip(segment_names, durations):
+        lines += [f"#EXTINF:{duration:.3f},", name]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+def write_streaming_export(export_dir, store_name, variants, map_url="", token=None):
+    # export_dir/index.html と audio/v{声}/{チャプター}.mp3（通常版）, audio/v{声}/{チャプター}/（区切りとm3u8）を書き出す
+    # token: 渡されたときは、チャプターごとに中止されていないか確かめる（途中のファイルは呼び出し元で消す）
+    stream_variants = []
+    for n, v in enumerate(variants):
+        tracks = []
+        for i, track in enumerate(v["tracks"]):
+            if token: token.check()
+            if not os.path.exists(track['path']): continue
+            base = f"audio/v{n + 1}/{i + 1:02}"
+            os.makedirs(os.path.join(export_dir, f"audio/v{n + 1}"), exist_ok=True)
+            with open(track['path'], "rb") as f:
+                data = f.read()
+            with open(os.path.join(export_dir, base + ".mp3"), "wb") as f:
+                f.write(data)
+            tracks.append({"title": track['title'], "src": base + ".mp3"})
+            # MP3のフレームが見つからないときは、区切らずに通常版だけで再生する
+            segments = split_mp3(data)
+            if not segments: continue
+            os.makedirs(os.path.join(export_dir, base), exist_ok=True)
+            names, durations, elapsed = [], [], 0.0
+            for k, (segment, duration) in enumerate(segments):
+                name = f"seg{k:03}.mp3"
+                with open(os.path.join(export_dir, base, name), "wb") as f:
+                    f.write(hls_timestamp_tag(elapsed) + segment)
+                names.append(name)
+                durations.append(duration)
+                elapsed += duration
+            with open(os.path.join(export_dir, base, "index.m3u8"), "w", encoding="utf-8") as f:
+                f.write(build_m3u8(names, durations))
+            tracks[-1].update({"segs": [f"{base}/{name}" for name in names], "m3u8": f"{base}/index.m3u8", "dur": round(elapsed, 3)})
+        stream_variants.append({"label": v['label'], "lang": v['lang'], "tracks": tracks})
+    with open(os.path.join(export_dir, "index.html"), "w", encoding="utf-8") as f:
+        for chunk in iter_standalone_html_player(store_name, stream_variants, map_url, variants_json=json.dumps(stream_variants, ensure_ascii=False)):
+            f.write(chunk)
+    return export_dir
+
+# プレビュー用プレイヤー
+def build_preview_html(tracks):
+    playlist_json = "".join(iter_playlist_json(tracks))
+    
+    html_template = """<!DOCTYPE html><html><head><style>
+    body{margin:0;padding:0;font-family:sans-serif;}
+    .p-box{border:2px solid #e0e0e0;border-radius:12px;padding:15px;background:#fcfcfc;text-align:center;}
+    .t-ti{font-size:18px;font-weight:bold;color:#333;margin-bottom:10px;padding:10px;background:#fff;border-radius:8px;border-left:5px solid #ff4b4b;}
+    .ctrls{display:flex; gap:10px; margin:15px 0;}
+    button {
+        flex: 1;
+        background-color: #ff4b4b; color: white; border: none;
+        border-radius: 8px; font-size: 24px; padding: 10px 0;
+        cursor: pointer; line-height: 1; min-height: 50px;
+    }
+    button:hover { background-color: #e04141; }
+    button:focus { outline: 3px solid #333; outline-offset: 2px; }
+    .lst{text-align:left;max-height:150px;overflow-y:auto;border-top:1px solid #eee;margin-top:10px;padding-top:5px;}
+    .it{padding:8px;border-bottom:1px solid #eee;cursor:pointer;font-size:14px;}
+    .it:focus{outline:2px solid #333; background:#eee;}
+    .it.active{color:#b71c1c;font-weight:bold;background:#ffecec;}
+    </style></head><body><div class="p-box"><div id="ti" class="t-ti">...</div><audio id="au" controls style="width:100%;height:30px;"></audio>
+    <div class="ctrls">
+        <button onclick="pv()" aria-label="前へ">⏮</button>
+        <button onclick="tg()" id="pb" aria-label="再生">▶</button>
+        <button onclick="nx()" aria-label="次へ">⏭</button>
+    </div>
+    <div style="font-size:12px;color:#666; margin-top:5px;">
+        速度:<select id="sp" onchange="sp()"><option value="0.8">0.8</option><option value="1.0" selected>1.0</option><option value="1.2">1.2</option><option value="1.5">1.5</option></select>
+    </div>
+    <div id="ls" class="lst" role="list"></div></div>
+    <script>
+    const pl=__PLAYLIST__;let x=0;const au=document.getElementById('au');const ti=document.getElementById('ti');const pb=document.getElementById('pb');const ls=document.getElementById('ls');
+    const its=[];const bl={};const pre=new Audio();pre.preload="auto";
+    function init(){rn();ld(0);sp();}
+    function ld(i){its[x].classList.remove("active");x=i;au.src=bl[x]||pl[x].src;for(const k in bl){if(k!=x&&k!=x+1){URL.revokeObjectURL(bl[k]);delete bl[k];}}ti.innerText=pl[x].title;its[x].classList.add("active");sp();pf(x+1);}
+    function pf(i){if(i>=pl.length)return;if(bl[i]){pre.src=bl[i];pre.load();return;}fetch(pl[i].src).then(r=>r.blob()).then(b=>{bl[i]=URL.createObjectURL(b);if(i===x+1){pre.src=bl[i];pre.load();}}).catch(()=>{});}
+    function tg(){if(au.paused){au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");}else{au.pause();pb.innerText="▶";pb.setAttribute("aria-label","再生");}}
+    function nx(){if(x<pl.length-1){ld(x+1);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");}}
+    function pv(){if(x>0){ld(x-1);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");}}
+    function sp(){au.playbackRate=parseFloat(document.getElementById('sp').value);}
+    au.onended=function(){if(x<pl.length-1)nx();else{pb.innerText="▶";pb.setAttribute("aria-label","再生");}};
+    function rn(){pl.forEach((t,i)=>{
+        const d=document.createElement('div');
+        d.className="it";
+        let l=t.title; if(i>0){l=i+". "+t.title;}
+        d.innerText=l;
+        d.setAttribute("role","listitem");d.setAttribute("tabindex","0");d.onclick=()=>{ld(i);au.play();pb.innerText="⏸";pb.setAttribute("aria-label","一時停止");};d.onkeydown=(e)=>{if(e.key==='Enter'||e.key===' '){e.preventDefault();d.click();}};ls.appendChild(d);its.push(d);});}
+    init();</script></body></html>"""
+    return html_template.replace("__PLAYLIST__", playlist_json)
@@ -0,0 +1,207 @@
+# Gemini のモデルの振り分け（generate_content の呼び出し）
+# - 成功した呼び出しの応答時間をモデルごとに指数移動平均（EWMA）で記録する
+# - 利用上限（ResourceExhausted）に達したモデルはしばらく休ませ、待たずに互換のモデルへ切り替える
+#   休ませる時間は、続けて上限に達するたびに倍にする（APIが再試行までの時間を返したときは、それより短くしない）
+# - サーバーエラー（5xx）・タイムアウト・通信の失敗も短く休ませ、次のモデルで試す
+# - リクエストの誤り（4xx: 引数・権限・APIキーなど）はモデルを替えても直らないので、休ませず・切り替えずにそのまま返す
+# - 互換のモデル: 一覧（valid_models）のうち、画像とテキストを読んで文章を返す Gemini（音声・画像生成・埋め込み・Live用などは除く）
+#   選んだモデル → 同じ系統（pro / flash / flash-lite）→ その他 の順で、同じ順位では最近の応答が速いものから使う
+# - すべてのモデルが休んでいるときだけ、最初に空くモデルを待つ（上限 MAX_WAIT 秒）。待つ間も残り秒数を知らせる
+# - 状態はAPIキーごとに全セッションで共有する（app.py の get_model_router）。他のセッションで上限に達したモデルは最初から避ける
+# - JSONの出力指定（generation_config の response_schema）を受け付けないと返したモデルは、以後は指定を外して呼ぶ（出力はローカルで読み取る）
+# - 作成が中止されたら（CancelToken）、次の呼び出し・再試行・待ちをせずに抜け、実行中だった呼び出しの結果は捨てる
+import math
+import threading
+import time
+
+from cancellation import Cancelled, count_cancelled
+
+EWMA_ALPHA = 0.3
+DEFAULT_LATENCY = 10.0  # 秒。まだ使っていないモデルの見込み
+QUOTA_COOLDOWN = 10.0
+MAX_COOLDOWN = 300.0
+ERROR_COOLDOWN = 5.0
+MAX_WAIT = 60.0
+WAIT_TICK = 1.0
+MODEL_TIERS = ("flash-lite", "flash", "pro")
+SCHEMA_ERROR_WORDS = ("response_schema", "responseschema", "response_mime_type", "responsemimetype", "json mode")
+INCOMPATIBLE = ("tts", "image", "embedding", "live", "audio", "aqa", "robotics", "computer-use")
+
+
+class ModelUnavailable(Exception):
+    pass
+
+
+def short_name(name):
+    return name.removeprefix("models/")
+
+
+def model_tier(name):
+    return next((tier for tier in MODEL_TIERS if tier in name), "")
+
+
+def is_compatible(name):
+    return "gemini" in name and not any(word in name for word in INCOMPATIBLE)
+
+
+def is_schema_error(e):
+    # InvalidArgument のうち、JSONの出力指定（スキーマ・MIMEタイプ）を受け付けないことによるもの
+    # 画像やサイズ・APIキーの誤りなど、他の理由の InvalidArgument では指定を外さない
+    message = str(e).lower()
+    return any(word in message for word in SCHEMA_ERROR_WORDS)
+
+
+def retry_after(e):
+    # 429の詳細（RetryInfo）に再試行までの時間があれば使う
+    for detail in getattr(e, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None: return delay.seconds + delay.nanos / 1e9
+    return 0.0
+
+
+class ModelRouter:
+    def __init__(self, factory, models=()):
+        # factory(model_name): モデルを作る（menu_pipeline.create_model にAPIキーを渡したもの）
+        self.factory = factory
+        self.models = []
+        self.handles = {}
+        self.health = {}
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "failovers": 0, "quota_errors": 0, "errors": 0, "waits": 0, "wait_sec": 0.0}
+        self.update_models(models)
+
+    def update_models(self, models):
+        self.models = [m for m in models if is_compatible(m)]
+
+    def model(self, preferred, token=None):
+        return RoutedModel(self, preferred, token)
+
+    def _health(self, name):
+        return self.health.setdefault(name, {"latency": None, "cooldown_until": 0.0, "quota_streak": 0, "calls": 0, "failures": 0, "json_mode": True})
+
+    def _handle(self, name):
+        with self.lock:
+            if name not in self.handles: self.handles[name] = self.factory(name)
+            return self.handles[name]
+
+    def candidates(self, preferred):
+        now = time.monotonic()
+        with self.lock:
+            def rank(name):
+                h = self._health(name)
+                return (h["cooldown_until"] > now, name != preferred, model_tier(name) != model_tier(preferred), h["latency"] or DEFAULT_LATENCY)
+            return sorted([preferred] + [m for m in self.models if m != preferred], key=rank)
+
+    def _choose(self, preferred, on_retry, token=None):
+        # 休んでいないモデルがなければ、最初に空くモデルを待つ。待ちきれないときは None
+        deadline = time.monotonic() + MAX_WAIT
+        waited = 0.0
+        while True:
+            names = self.candidates(preferred)
+            with self.lock:
+                # 全て休んでいるときは、最初に空くモデルを待つ
+                name = names[0] if self._health(names[0])["cooldown_until"] <= time.monotonic() else min(names, key=lambda n: self._health(n)["cooldown_until"])
+                remaining = self._health(name)["cooldown_until"] - time.monotonic()
+            if remaining <= 0:
+                if waited:
+                    with self.lock:
+                        self.stats["waits"] += 1
+                        self.stats["wait_sec"] += waited
+                return name
+            if time.monotonic() + remaining > deadline: return None
+            if on_retry: on_retry(f"使えるモデルがすべて休止中です。あと{math.ceil(remaining)}秒で {short_name(name)} で再試行します")
+            tick = min(WAIT_TICK, remaining)
+            if token: token.sleep(tick)
+            else: time.sleep(tick)
+            waited += tick
+
+    def _succeeded(self, name, seconds):
+        with self.lock:
+            h = self._health(name)
+            h["latency"] = seconds if h["latency"] is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * h["latency"]
+            h["calls"] += 1
+            h["quota_streak"] = 0
+
+    def _failed(self, name, quota=False, delay=0.0):
+        with self.lock:
+            h = self._health(name)
+            h["calls"] += 1
+            h["failures"] += 1
+            now = time.monotonic()
+            if quota:
+                self.stats["quota_errors"] += 1
+                # 同時に送っていた呼び出しがまとめて失敗した分は、続けて上限に達した回数に数えない
+                if h["cooldown_until"] <= now: h["quota_streak"] += 1
+                cooldown = max(delay, min(QUOTA_COOLDOWN * 2 ** (h["quota_streak"] - 1), MAX_COOLDOWN))
+            else:
+                self.stats["errors"] += 1
+                cooldown = ERROR_COOLDOWN
+            h["cooldown_until"] = max(h["cooldown_until"], now + cooldown)
+            return h["cooldown_until"] - now
+
+    def generate(self, parts, preferred, retries=3, on_retry=None, token=None, **kwargs):
+        # retries回（モデルを切り替えながら）試して応答を返す。得られなければ ModelUnavailable、中止されたら Cancelled
+        # on_retry(message): 切り替えや待ちの理由（呼び出したスレッドから呼ぶ）
+        # kwargs: generate_content にそのまま渡す（generation_config など）
+        from google.api_core import exceptions
+        with self.lock: self.stats["calls"] += 1
+        reason, last_error, previous = "", None, None
+        for attempt in range(retries):
+            try:
+                if token: token.check()
+                name = self._choose(preferred, on_retry, token)
+            except Cancelled:
+                count_cancelled("llm_calls")
+                raise
+            if name is None: break
+            if previous and name != previous:
+                with self.lock: self.stats["failovers"] += 1
+            if reason and on_retry: on_retry(f"{reason}。{short_name(name)} で再試行しています（{attempt + 1}/{retries}回目）")
+            previous = name
+            with self.lock: json_mode = self._health(name)["json_mode"]
+            call_kwargs = kwargs if json_mode else {k: v for k, v in kwargs.items() if k != "generation_config"}
+            t0 = time.monotonic()
+            try:
+                try:
+                    response = self._handle(name).generate_content(parts, **call_kwargs)
+                except exceptions.InvalidArgument as e:
+                    if "generation_config" not in call_kwargs or not is_schema_error(e): raise
+                    # JSONの出力指定に対応していないモデル: 以後は指定を外す。この呼び出しも指定なしですぐ呼び直す（再試行の回数に数えない）
+                    with self.lock: self._health(name)["json_mode"] = False
+                    call_kwargs = {k: v for k, v in call_kwargs.items() if k != "generation_config"}
+                    response = self._handle(name).generate_content(parts, **call_kwargs)
+            except exceptions.ResourceExhausted as e:
+                last_error = e
+                cooldown = self._failed(name, quota=True, delay=retry_after(e))
+                reason = f"{short_name(name)} が利用上限に達しました（{math.ceil(cooldown)}秒休ませます）"
+                continue
+            except exceptions.ClientError:
+                raise
+            except (exceptions.ServerError, exceptions.RetryError, OSError) as e:
+                last_error = e
+                self._failed(name)
+                reason = f"{short_name(name)} でエラーが発生しました（{type(e).__name__}）"
+                continue
+            self._succeeded(name, time.monotonic() - t0)
+            if token and token.cancelled:
+                count_cancelled("llm_calls")
+                raise Cancelled()
+            return response
+        raise ModelUnavailable(reason or "利用できるモデルがありません") from last_error
+
+    def usage(self):
+        with self.lock:
+            now = time.monotonic()
+            return {**self.stats, "models": {short_name(name): {"latency": h["latency"], "cooling_sec": max(0.0, h["cooldown_until"] - now),
+                                                                "calls": h["calls"], "failures": h["failures"], "json_mode": h["json_mode"]} for name, h in self.health.items()}}
+
+
+class RoutedModel:
+    # GenerativeModel の代わりに渡す（generate_content が振り分けと再試行をする）
+    def __init__(self, router, preferred, token=None):
+        self.router = router
+        self.model_name = preferred
+        self.token = token
+
+    def generate_content(self, parts, on_retry=None, retries=3, **kwargs):
+        return self.router.generate(parts, self.model_name, retries, on_retry, self.token, **kwargs)
@@ -0,0 +1,40 @@
+import streamlit as st
+import hmac
+from functools import partial
+from menu_catalog import MenuCatalog
+
+st.set_page_config(page_title="作成履歴 - Menu Player Generator", layout="wide")
+
+st.title("📚 作成履歴")
+st.caption("これまでに作成した音声メニューを、AI解析や音声生成をせずにすぐ再ダウンロードできます。")
+
+catalog = MenuCatalog()
+
+# 削除は管理者だけ（secrets の CATALOG_ADMIN_PASSWORD を入力したとき）。設定がなければ削除ボタンは出さない
+try: admin_password = st.secrets.get("CATALOG_ADMIN_PASSWORD")
+except FileNotFoundError: admin_password = None  # secrets.toml がない
+can_delete = False
+if admin_password:
+    with st.sidebar:
+        password = st.text_input("管理者パスワード（削除する場合）", type="password")
+    can_delete = bool(password) and hmac.compare_digest(password.encode(), str(admin_password).encode())
+
+query = st.text_input("🔍 検索", placeholder="店舗名・メニュー名・日付（例：2024-05-01）")
+entries = catalog.search(query)
+
+if not entries:
+    st.info("該当する作成履歴はありません。")
+
+for entry in entries:
+    label = entry["store_name"]
+    if entry.get("menu_title"): label += f"　{entry['menu_title']}"
+    label += f"　({entry['created_at'][:16].replace('T', ' ')})"
+    with st.expander(label):
+        st.caption(f"{len(entry['tracks'])}トラック / 声: {entry.get('voice', '-')}")
+        c1, c2, c3 = st.columns([2, 2, 1])
+        # ダウンロード内容はボタンが押されたときに読み込む（押しても再実行しない）
+        with c1: st.download_button(f"🌐 Webプレイヤー ({entry['html_name']})", partial(catalog.html_bytes, entry), entry['html_name'], "text/html", key=f"html_{entry['id']}", type="primary", on_click="ignore")
+        with c2: st.download_button(f"📦 ZIPファイル ({entry['zip_name']})", partial(catalog.zip_bytes, entry), entry['zip_name'], "application/zip", key=f"zip_{entry['id']}", on_click="ignore")
+        if can_delete and c3.button("🗑️ 削除", key=f"del_{entry['id']}"):
+            catalog.delete(entry["id"])
+            st.rerun()
@@ -0,0 +1,109 @@
+# PDFのメニューの読み込み
+# - 文字情報（テキストレイヤー）のあるページは、そのままテキストとしてAIに渡す（画像より安く速い）
+# - 文字情報がない・少ない・文字化けしている・写真が中心のページだけを画像にする
+# - 画像にするページは、ワーカーごとに別プロセス（このファイルをスクリプトとして実行）で並列に描画する
+#   PyMuPDFはスレッドセーフではなく、multiprocessingのspawn・forkserverはStreamlitの __main__（app.py）を
+#   読み込み直してしまうため。壊れたPDFで描画が落ちても、アプリのプロセスは巻き込まない
+# - アプリのプロセスの中でのPyMuPDFの利用（ページ数・ページの判定）は、セッションをまたいで1つずつ行う（_lock）
+#   解像度は PDF_DPI（大きなページは長辺 MAX_SIDE_PX まで下げる）
+import os
+import pickle
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PDF_DPI = int(os.environ.get("MENU_PLAYER_PDF_DPI", "150"))
+PDF_WORKERS = int(os.environ.get("MENU_PLAYER_PDF_WORKERS", "2"))
+MAX_SIDE_PX = 3000
+JPEG_QUALITY = 85
+MIN_TEXT_CHARS = 30
+PHOTO_TEXT_CHARS = 200  # 写真が大半を占めるページは、これより文字が少なければ画像として読む
+PHOTO_COVERAGE = 0.5
+RENDER_TIMEOUT = 120
+GARBLED_RATIO = 0.1
+
+_lock = threading.Lock()
+
+
+def is_pdf(f):
+    return getattr(f, "type", "") == "application/pdf" or f.name.lower().endswith(".pdf")
+
+
+def make_executor(workers=PDF_WORKERS):
+    # 同時に動かす描画プロセスの数を、全セッションでworkers本までに抑える
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-render")
+
+
+def open_pdf(data):
+    import pymupdf
+    return pymupdf.open(stream=data, filetype="pdf")
+
+
+def page_count(data):
+    with _lock, open_pdf(data) as doc:
+        return doc.page_count
+
+
+def classify_page(page):
+    # (テキストとして使うか, 文字情報, 判断の理由) を返す
+    text = page.get_text("text", sort=True).strip()
+    chars = sum(1 for c in text if not c.isspace())
+    if chars < MIN_TEXT_CHARS:
+        return False, text, f"文字が少ない（{chars}文字）"
+    garbled = sum(1 for c in text if c == "\ufffd" or "\ue000" <= c <= "\uf8ff")  # 置換文字・私用領域
+    if garbled / chars > GARBLED_RATIO:
+        return False, text, "文字化け"
+    area = abs(page.rect)
+    covered = sum(abs(page.rect & info["bbox"]) for info in page.get_image_info())
+    if area and covered / area > PHOTO_COVERAGE and chars < PHOTO_TEXT_CHARS:
+        return False, text, "写真が中心"
+    return True, text, f"{chars}文字"
+
+
+def render_pages(data, numbers, dpi=PDF_DPI):
+    # ワーカーで実行する: 指定ページをJPEGにして [(ページ番号, JPEG, dpi)] を返す
+    results = []
+    with open_pdf(data) as doc:
+        for n in numbers:
+            page = doc[n]
+            page_dpi = min(dpi, int(MAX_SIDE_PX * 72 / max(page.rect.width, page.rect.height, 1)))
+            pix = page.get_pixmap(dpi=page_dpi)
+            results.append((n, pix.tobytes("jpg", jpg_quality=JPEG_QUALITY), page_dpi))
+    return results
+
+
+def render_in_subprocess(data, numbers, dpi=PDF_DPI):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), str(dpi)] + [str(n) for n in numbers],
+                         input=data, capture_output=True, timeout=RENDER_TIMEOUT)
+    if out.returncode:
+        raise RuntimeError(f"PDFのページを画像にできませんでした: {out.stderr.decode(errors='replace')[-300:]}")
+    return pickle.loads(out.stdout)
+
+
+def read_pdf(data, executor=None, dpi=PDF_DPI, workers=PDF_WORKERS):
+    # ページごとに [{"page"(1から), "mode"("text"/"image"), "text", "image", "reason"}] を返す
+    pages, image_pages = [], []
+    with _lock, open_pdf(data) as doc:
+        for page in doc:
+            use_text, text, reason = classify_page(page)
+            pages.append({"page": page.number + 1, "mode": "text" if use_text else "image",
+                          "text": text if use_text else "", "image": None, "reason": reason})
+            if not use_text: image_pages.append(page.number)
+    if image_pages:
+        # ワーカーごとにまとめて渡す（PDFの中身を送る回数を減らす）
+        chunks = [image_pages[i::workers] for i in range(min(workers, len(image_pages)))]
+        if executor:
+            rendered = [r for future in [executor.submit(render_in_subprocess, data, chunk, dpi) for chunk in chunks] for r in future.result()]
+        else:
+            with _lock:
+                rendered = render_pages(data, image_pages, dpi)
+        for n, jpeg, page_dpi in rendered:
+            pages[n]["image"] = jpeg
+            pages[n]["reason"] += f"・{page_dpi}dpi"
+    return pages
+
+
+if __name__ == "__main__":
+    # render_in_subprocess から: 引数は dpi とページ番号、PDFは標準入力、結果はpickleで標準出力へ
+    sys.stdout.buffer.write(pickle.dumps(render_pages(sys.stdin.buffer.read(), [int(n) for n in sys.argv[2:]], int(sys.argv[1]))))
@@ -0,0 +1,72 @@
+# 定型文の音声キャッシュ
+# - 「はじめに・目次」トラックの決まった言い回しを、声・話速ごとに1回だけ合成してディスクに置く
+# - キーは（声, 話速, 文）のハッシュなので、文が同じなら店やセッションが違っても同じファイルを使う
+# - 同じ文の合成が同時に要求されたときは、1回の合成を共有する（共有イベントループの中だけで使う）
+# - 一時ディレクトリにあり、同じホストの他のプロセスも使うので、MP3のフレームで始まらないファイルは使わずに消して作り直す
+#   キーには形式の版（SEGMENT_FORMAT）を入れ、保存の形を変えたときは前のファイルを使わない
+import asyncio
+import hashlib
+import os
+import tempfile
+import uuid
+
+from menu_pipeline import is_mp3
+
+SEGMENT_CACHE_DIR = os.environ.get("MENU_PLAYER_SEGMENT_CACHE", os.path.join(tempfile.gettempdir(), "menu_player_segments"))
+SEGMENT_FORMAT = "mp3-1"
+
+
+def valid_segment(path):
+    try:
+        with open(path, "rb") as f:
+            return is_mp3(f.read())
+    except OSError:
+        return False
+
+
+class SegmentCache:
+    def __init__(self, root=SEGMENT_CACHE_DIR):
+        self.root = root
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalid = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, text, voice_code, rate_value):
+        key = hashlib.sha256(f"{SEGMENT_FORMAT}\n{voice_code}\n{rate_value}\n{text}".encode()).hexdigest()
+        return os.path.join(self.root, f"{key}.mp3")
+
+    async def get(self, text, voice_code, rate_value, synthesize):
+        # synthesize(path) -> bool: 文をpathへ合成するコルーチン関数。失敗したときはNoneを返す
+        path = self.path(text, voice_code, rate_value)
+        if os.path.exists(path):
+            if valid_segment(path):
+                self.hits += 1
+                return path
+            self.invalid += 1
+            try: os.remove(path)
+            except OSError: pass
+        task = self.pending.get(path)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._create(path, synthesize))
+            self.pending[path] = task
+            task.add_done_callback(lambda t: self.pending.pop(path, None))
+        else:
+            self.hits += 1
+        # 待っている側が中断されても、他のセッションが待つ合成は止めない
+        return await asyncio.shield(task)
+
+    async def _create(self, path, synthesize):
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if await synthesize(tmp) and os.path.exists(tmp) and valid_segment(tmp):
+                os.replace(tmp, path)
+                return path
+            return None
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def usage(self):
+        return {"hits": self.hits, "misses": self.misses, "invalid": self.invalid}
@@ -0,0 +1,68 @@
+# 起動時間（初回描画までの時間）のベンチマーク
+# 新しいプロセスでアプリを1回実行し、タイトルが描画されるまでの時間と、1回目の実行全体の時間を計る
+#
+#   python tools/bench_startup.py               # このリポジトリのapp.py
+#   python tools/bench_startup.py --app old.py  # 別バージョンと比較（git show <rev>:app.py > old.py など）
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ["google.generativeai", "edge_tts", "gtts", "bs4", "PIL.Image", "requests"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(app_path):
+    t0 = time.perf_counter()
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    first_render = {}
+    original_title = st.title
+
+    def timed_title(*args, **kwargs):
+        first_render.setdefault("t", time.perf_counter())
+        return original_title(*args, **kwargs)
+
+    st.title = timed_title
+    sys.path.insert(0, os.path.dirname(app_path))
+    at = AppTest.from_file(app_path, default_timeout=60)
+    at.secrets["BENCH"] = "1"
+    t_run = time.perf_counter()
+    at.run()
+    t_end = time.perf_counter()
+    print(json.dumps({
+        "first_render_ms": (first_render.get("t", t_end) - t0) * 1000,
+        "script_ms": (t_end - t_run) * 1000,
+        "total_ms": (t_end - t0) * 1000,
+        "heavy_imported": [m for m in HEAVY_MODULES if m in sys.modules],
+        "exceptions": [str(e.value) for e in at.exception],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default=os.path.join(ROOT, "app.py"))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    app_path = os.path.abspath(args.app)
+    if args.child:
+        return child(app_path)
+
+    results = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, __file__, "--child", "--app", app_path], capture_output=True, text=True, cwd=ROOT)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    print(f"app: {app_path}  ({args.runs} runs, median)")
+    for key in ["first_render_ms", "script_ms", "total_ms"]:
+        print(f"  {key:16s} {statistics.median(r[key] for r in results):8.1f}")
+    print(f"  heavy modules imported during first run: {', '.join(results[-1]['heavy_imported']) or '-'}")
+    if results[-1]["exceptions"]:
+        print(f"  exceptions: {results[-1]['exceptions']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# 音声合成の接続コストのベンチマーク
+# 典型的な8チャプターのメニュー（はじめに＋7カテゴリー）を、次の2通りで合成して比べる
+#   per-track: これまでどおり、チャプターごとに edge_tts.Communicate（毎回TLS・WebSocketの接続から）
+#   pooled:    tts_pool.TTSPool（接続を使い回す）
+# あわせて、接続だけ（ハンドシェイクのみ）の時間を計り、1チャプターあたりの合成時間に占める割合を出す
+# edge-tts のサービスに実際に接続するので、ネットワークが必要
+#
+#   python tools/bench_tts.py
+#   python tools/bench_tts.py --concurrency 1 --rounds 5
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHAPTERS = [
+    "いらっしゃいませ。カフェタナカの音声メニューです。このメニューは、画面読み上げに対応しています。ランチメニューは、全部で7つのカテゴリーがあります。目次。前菜・サラダ、パスタ、ピザ、肉料理、デザート、ドリンク、セットメニュー。それではどうぞ。",
+    "1、前菜・サラダ。\nシーザーサラダ、800円。生ハムとルッコラのサラダ、950円。本日のスープ、500円。",
+    "2、パスタ。\nカルボナーラ、1200円。ペペロンチーノ、1000円。ボロネーゼ、1200円。季節野菜のトマトソース、1100円。",
+    "3、ピザ。\nマルゲリータ、1300円。クアトロフォルマッジ、1500円。",
+    "4、肉料理。\n鶏もも肉のグリル、1400円。牛ほほ肉の赤ワイン煮込み、1800円。",
+    "5、デザート。\nティラミス、600円。パンナコッタ、550円。本日のジェラート、450円。",
+    "6、ドリンク。\nコーヒー、400円。紅茶、400円。オレンジジュース、450円。グラスワイン、赤・白、各600円。",
+    "7、セットメニュー。\nパスタまたはピザに、サラダとドリンクが付きます。プラス500円。デザートを付ける場合は、さらにプラス300円です。",
+]
+
+
+async def run_per_track(voice, rate, concurrency, out_dir):
+    import edge_tts
+    sem = asyncio.Semaphore(concurrency)
+    times = []
+
+    async def one(i, text):
+        async with sem:
+            t0 = time.perf_counter()
+            await edge_tts.Communicate(text, voice, rate=rate).save(os.path.join(out_dir, f"track_{i}.mp3"))
+            times.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[one(i, text) for i, text in enumerate(CHAPTERS)])
+    return {"wall_sec": time.perf_counter() - t0, "track_ms": [t * 1000 for t in times]}
+
+
+async def run_pooled(pool, voice, rate, concurrency, out_dir):
+    sem = asyncio.Semaphore(concurrency)
+    times = []
+
+    async def one(i, text):
+        async with sem:
+            t0 = time.perf_counter()
+            await pool.synthesize(text, voice, rate, os.path.join(out_dir, f"pooled_{i}.mp3"))
+            times.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[one(i, text) for i, text in enumerate(CHAPTERS)])
+    return {"wall_sec": time.perf_counter() - t0, "track_ms": [t * 1000 for t in times]}
+
+
+async def measure_handshake(pool, samples):
+    # 接続を開いて閉じるだけ（speech.config の送信まで）
+    times = []
+    for _ in range(samples):
+        t0 = time.perf_counter()
+        conn = await pool._connect()
+        times.append((time.perf_counter() - t0) * 1000)
+        await conn.close()
+    return times
+
+
+async def bench(args):
+    from tts_pool import TTSPool
+    out_dir = tempfile.mkdtemp(prefix="bench_tts_")
+    pool = TTSPool(size=args.concurrency)
+    try:
+        handshake = await measure_handshake(pool, args.handshakes)
+        per_track, pooled = [], []
+        for _ in range(args.rounds):
+            per_track.append(await run_per_track(args.voice, args.rate, args.concurrency, out_dir))
+            pooled.append(await run_pooled(pool, args.voice, args.rate, args.concurrency, out_dir))
+        usage = pool.usage()
+    finally:
+        await pool.close()
+    # 使い回した接続での1チャプターの時間 ≒ 合成だけの時間
+    synth_ms = statistics.median(t for r in pooled[1:] or pooled for t in r["track_ms"])
+    handshake_ms = statistics.median(handshake)
+    return {
+        "chapters": len(CHAPTERS),
+        "concurrency": args.concurrency,
+        "rounds": args.rounds,
+        "handshake_ms": handshake_ms,
+        "synth_ms_per_chapter": synth_ms,
+        "handshake_share": handshake_ms / (handshake_ms + synth_ms),
+        "per_track_wall_sec": statistics.median(r["wall_sec"] for r in per_track),
+        "pooled_wall_sec": statistics.median(r["wall_sec"] for r in pooled),
+        "per_track_ms_per_chapter": statistics.median(t for r in per_track for t in r["track_ms"]),
+        "pool": usage,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voice", default="ja-JP-NanamiNeural")
+    parser.add_argument("--rate", default="+10%")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--handshakes", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    result = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    print(f"{result['chapters']} chapters, concurrency {result['concurrency']}, {result['rounds']} rounds (median)")
+    print(f"  handshake only            {result['handshake_ms']:8.1f} ms")
+    print(f"  synthesis per chapter     {result['synth_ms_per_chapter']:8.1f} ms  (reused connection)")
+    print(f"  handshake share           {result['handshake_share'] * 100:8.1f} %")
+    print(f"  per chapter, per-track    {result['per_track_ms_per_chapter']:8.1f} ms")
+    print(f"  menu wall time, per-track {result['per_track_wall_sec']:8.2f} s")
+    print(f"  menu wall time, pooled    {result['pooled_wall_sec']:8.2f} s")
+    pool = result["pool"]
+    print(f"  pool: opened {pool['opened']}, reused {pool['reused']}, recycled {pool['recycled']}, broken {pool['broken']}, reuse {'on' if pool['reuse'] else 'off'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# URL入力のメニュー抽出（extract_text_blocks / select_menu_text）の確認とベンチマーク
+# 次の2つのページで確かめる。ネットワークは不要
+#   mixed: 商品名が <p>、価格が隣の <span> にある店のページ（<div><p>ハンバーグ定食</p><span>1,200円</span></div>）
+#          価格がすべてAIに渡す文字に入り、商品名と同じブロックに入ることを確かめる
+#   large: 見出しが少なく、項目が多いページ（--items 件）。抽出にかかる時間（HTMLの解析は除く）を計る
+#
+#   python tools/bench_url_extract.py
+#   python tools/bench_url_extract.py --items 10000 --max-sec 1
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def mixed_page(items=12):
+    rows = "".join(f'<div class="item"><p>ハンバーグ定食{i + 1}</p><span class="price">1,{i % 10}00円</span></div>' for i in range(items))
+    return f"""<html><body>
+    <nav><ul><li><a href="/">ホーム</a></li><li><a href="/access">アクセス</a></li><li><a href="/news">お知らせ</a></li></ul></nav>
+    <h2>ランチ</h2><div class="menu">{rows}</div>
+    <h2>ドリンク</h2><div class="menu"><div class="item"><p>コーヒー</p><span>400円</span></div></div>
+    <footer><p>営業時間 11:00〜22:00</p></footer>
+    </body></html>"""
+
+
+def large_page(items):
+    rows = "".join(f'<div class="item"><p>料理{i + 1}</p><span>{(i % 20 + 5) * 100}円</span></div>' for i in range(items))
+    return f"<html><body><h1>メニュー</h1><h2>グランドメニュー</h2><div class='menu'>{rows}</div></body></html>"
+
+
+def extract(html):
+    from bs4 import BeautifulSoup
+    from menu_pipeline import extract_text_blocks, select_menu_text
+    soup = BeautifulSoup(html, "html.parser")
+    t0 = time.perf_counter()
+    blocks = extract_text_blocks(soup)
+    text = select_menu_text(blocks)
+    return blocks, text, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=3000, help="largeページの項目数")
+    parser.add_argument("--max-sec", type=float, default=2.0, help="largeページの抽出がこれを超えたら失敗にする")
+    args = parser.parse_args()
+    failures = []
+
+    blocks, text, sec = extract(mixed_page())
+    missing = [f"1,{i % 10}00円" for i in range(12) if f"ハンバーグ定食{i + 1}\n1,{i % 10}00円" not in text]
+    print(f"mixed: {len(blocks)} blocks, {sec * 1000:.1f}ms, 価格 {text.count('円')}件")
+    print("  " + text.replace("\n", "\n  "))
+    if missing: failures.append(f"mixed: 商品名と価格が並んでいない（{len(missing)}件）")
+    if "400円" not in text: failures.append("mixed: ドリンクの価格がない")
+    if "【ランチ】" not in text or "【ドリンク】" not in text: failures.append("mixed: 見出しが付いていない")
+
+    blocks, text, sec = extract(large_page(args.items))
+    print(f"large: {args.items} items, {len(blocks)} blocks, {sec:.2f}s, 価格 {text.count('円')}件（予算内）")
+    if sec > args.max_sec: failures.append(f"large: {sec:.2f}s > {args.max_sec}s")
+    if not text.count("円"): failures.append("large: 価格がない")
+
+    for f in failures: print(f"FAIL {f}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
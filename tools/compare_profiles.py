@@ -0,0 +1,39 @@
+# メモリプロファイル（MENU_PLAYER_PROFILE=1 で書き出したJSON）の比較
+# 段階ごとに、ピーク・残留量・RSSピークの差を表にする
+#
+#   python tools/compare_profiles.py profiles/old.json profiles/new.json
+import argparse
+import json
+
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    before, after = load(args.before), load(args.after)
+    print(f"before: {before.get('version') or '-'} {before['label']} ({before['created_at']})")
+    print(f"after:  {after.get('version') or '-'} {after['label']} ({after['created_at']})")
+    print(f"{'stage':<16} {'peak MB':>17} {'kept MB':>17} {'RSS peak MB':>19} {'sec':>15}")
+    stages_before = {s["stage"]: s for s in before["stages"]}
+    names = [s["stage"] for s in before["stages"]] + [s["stage"] for s in after["stages"] if s["stage"] not in stages_before]
+    stages_after = {s["stage"]: s for s in after["stages"]}
+    for name in names:
+        b, a = stages_before.get(name), stages_after.get(name)
+        cols = []
+        for key, width in [("traced_peak_mb", 17), ("retained_mb", 17), ("rss_peak_mb", 19), ("seconds", 15)]:
+            if b and a:
+                cols.append(f"{b[key]:7.1f}→{a[key]:7.1f}".rjust(width))
+            else:
+                cols.append(f"{(b or a)[key]:7.1f} ({'before' if b else 'after'})".rjust(width))
+        print(f"{name:<16} " + " ".join(cols))
+    print(f"{'合計':<16} RSSピーク {before['rss_peak_mb']:.1f}MB → {after['rss_peak_mb']:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+# 複数セッションの負荷テスト
+# Streamlitのテスト用API（AppTest）で、N個のセッションが同時に「作成開始」までを実行する。
+# AI解析・edge-tts・gTTS・URL取得はローカルのスタブに置き換えるので、APIキーやネットワークは不要。
+# セッション数ごとに新しいプロセスで実行し、スループット・待ち時間（p50/p95/p99）・エラー率・
+# gTTSへのフォールバック率・edge-ttsへの接続数・ピークRSS・CPU使用率を表にする。
+#
+#   python tools/loadtest.py                                  # 1,2,4,8セッション、写真3枚
+#   python tools/loadtest.py --sessions 1,4,16 --flow url     # URL入力で
+#   python tools/loadtest.py --tts-sec 0.5 --tts-server-limit 8  # edge-ttsの制限（同時8本を超えると失敗）を模擬
+#   python tools/loadtest.py --mp3-kb 800 --images 10         # base64化・ZIP作成の負荷を大きく
+#   python tools/loadtest.py --tts-pool 8                     # edge-ttsの接続を使い回す場合と比べる
+#   python tools/loadtest.py --llm-quota-rate 0.5             # 選んだモデル（flash）の半分の呼び出しを利用上限にする（proへ切り替わる）
+#   python tools/loadtest.py --llm-truncate-rate 0.5          # 解析の半分の出力を途中で切る（続きだけを取得する）
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+
+_session = threading.local()
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.llm_calls = 0
+        self.llm_quota = 0
+        self.llm_truncated = 0
+        self.tts_requests = 0
+        self.tts_failures = 0
+        self.tts_active = 0
+        self.tts_peak = 0
+        self.tts_connects = 0
+        self.fallbacks = 0
+
+    def add(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+
+def stub_mp3(size):
+    # MP3のフレーム（MPEG1 Layer III・128kbps・44.1kHz、中身は乱数）を並べた、おおよそsizeバイトのデータ
+    return b"".join(b"\xff\xfb\x90\x64" + os.urandom(413) for _ in range(max(1, size // 417)))
+
+
+def install_stubs(args, stats):
+    # 本物のライブラリを読み込んだうえで、外部へ通信する部分だけを差し替える
+    import edge_tts
+    import google.generativeai as genai
+    from google.api_core import exceptions
+    import gtts
+    import requests
+    import tts_pool
+    categories = [{"title": f"カテゴリ{i + 1}", "text": "。".join(f"メニュー{i + 1}-{j + 1} {random.randint(4, 20) * 100}円" for j in range(8)) + "。"}
+                  for i in range(args.categories)]
+
+    class Response:
+        def __init__(self, text): self.text = text
+
+    class Model:
+        def __init__(self, model_name, **kwargs): self.model_name = model_name
+
+        def generate_content(self, parts, **kwargs):
+            stats.add("llm_calls")
+            if "flash" in self.model_name and random.random() < args.llm_quota_rate:
+                stats.add("llm_quota")
+                raise exceptions.ResourceExhausted("stub: quota")
+            time.sleep(args.llm_sec)
+            if "Translate" in str(parts if isinstance(parts, str) else parts[0]):
+                return Response(json.dumps({"store_name": "Load Test", "menu_title": "", "categories": categories}, ensure_ascii=False))
+            half = len(categories) // 2
+            if isinstance(parts[0], dict) and "role" in parts[0]:
+                # 続きの取得: 切った残りを返す
+                return Response(json.dumps(categories[half:], ensure_ascii=False))
+            if random.random() < args.llm_truncate_rate:
+                stats.add("llm_truncated")
+                return Response(json.dumps(categories[:half], ensure_ascii=False)[:-1] + ', {"title": "' + categories[half]["title"][:2])
+            return Response("```json\n" + json.dumps(categories, ensure_ascii=False) + "\n```")
+
+    class ModelInfo:
+        def __init__(self, name):
+            self.name = name
+            self.supported_generation_methods = ["generateContent"]
+
+    async def synthesize(filename):
+        stats.add("tts_requests")
+        with stats.lock:
+            stats.tts_active += 1
+            stats.tts_peak = max(stats.tts_peak, stats.tts_active)
+            throttled = args.tts_server_limit and stats.tts_active > args.tts_server_limit
+        try:
+            await asyncio.sleep(args.tts_sec)
+            if throttled or random.random() < args.tts_fail_rate:
+                stats.add("tts_failures")
+                raise edge_tts.exceptions.NoAudioReceived("stub: throttled")
+            with open(filename, "wb") as f:
+                f.write(stub_mp3(args.mp3_kb * 1024))
+        finally:
+            with stats.lock: stats.tts_active -= 1
+
+    async def connect():
+        # TLS・WebSocketのハンドシェイクの代わりに待つ
+        stats.add("tts_connects")
+        await asyncio.sleep(args.tts_connect_sec)
+
+    class Communicate:
+        def __init__(self, text, voice, **kwargs): self.text = text
+
+        async def save(self, filename):
+            await connect()
+            await synthesize(filename)
+
+    class PooledConnection:
+        def __init__(self): self.closed = False
+
+        def healthy(self): return not self.closed
+
+        async def synthesize(self, text, voice_code, rate_value, filename): await synthesize(filename)
+
+        async def close(self): self.closed = True
+
+    async def pool_connect(pool):
+        await connect()
+        pool.stats["opened"] += 1
+        return PooledConnection()
+
+    class GTTS:
+        def __init__(self, text, lang="ja", **kwargs): pass
+
+        def save(self, filename):
+            stats.add("fallbacks")
+            time.sleep(args.tts_sec)
+            with open(filename, "wb") as f:
+                f.write(stub_mp3(args.mp3_kb * 1024))
+
+    class Page:
+        apparent_encoding = "utf-8"
+        text = "<html><body>" + "".join(f"<h2>{c['title']}</h2><ul>" + "".join(f"<li>{m}</li>" for m in c["text"].split("。") if m) + "</ul>" for c in categories) + "</body></html>"
+
+    genai.list_models = lambda **kwargs: [ModelInfo("models/gemini-1.5-flash"), ModelInfo("models/gemini-1.5-pro")]
+    genai.GenerativeModel = Model
+    edge_tts.Communicate = Communicate
+    tts_pool.TTSPool._connect = pool_connect
+    gtts.gTTS = GTTS
+    requests.get = lambda *a, **k: Page()
+
+
+def make_images(count, size_kb):
+    from PIL import Image
+    images = []
+    for i in range(count):
+        # ノイズ画像にして、写真に近いJPEGサイズにする
+        side = max(64, int((size_kb * 1024 / 3) ** 0.5))
+        img = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        images.append((f"menu_{i + 1}.jpg", buf.getvalue(), "image/jpeg"))
+    return images
+
+
+def run_session(index, args, images, results):
+    from streamlit.testing.v1 import AppTest
+    _session.id = f"loadtest-{index}"
+    at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+    try:
+        at.run()
+        [t for t in at.text_input if t.label.startswith("🏠")][0].input(f"負荷テスト{index}")
+        if args.flow == "url":
+            at.radio[0].set_value("🌐 URL入力").run()
+            [t for t in at.text_input if t.label == "URL"][0].input(f"https://stub.local/menu/{index}")
+        else:
+            at.file_uploader[0].set_value(images)
+        if args.voices > 1:
+            at.multiselect[0].set_value(at.multiselect[0].options[:args.voices])
+        [c for c in at.checkbox if "作り直す" in c.label][0].check()
+        at.run()
+        for _ in range(args.iterations):
+            t0 = time.perf_counter()
+            [b for b in at.button if "作成開始" in b.label][0].click().run()
+            elapsed = time.perf_counter() - t0
+            errors = [str(e.value) for e in at.exception] + [e.value for e in at.error]
+            if not errors and not at.session_state["generated_result"]:
+                errors = ["結果なし: " + " / ".join(w.value for w in at.warning)]
+            ok = not errors
+            results.append({"latency": elapsed, "ok": ok, "error": errors[0] if errors else ""})
+    except Exception as e:
+        results.append({"latency": 0, "ok": False, "error": repr(e)})
+
+
+def share_test_runtime():
+    # AppTestは1回の実行ごとにグローバルなRuntimeを差し替えて最後に消すため、そのままでは
+    # 複数スレッドから同時に動かせない。1つのサーバーのように、全セッションで同じRuntimeを使わせる
+    from unittest.mock import MagicMock
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.components.v2.component_manager import BidiComponentManager
+    from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.bidi_component_registry = BidiComponentManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    # スクリプトのコンパイル結果もサーバーと同じく1つのキャッシュを共有する
+    # （実行ごとに別々にコンパイルすると、Python 3.11ではast.parseが並列実行で壊れることがある）
+    shared_cache = ScriptCache()
+    get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(shared_cache, script_path)
+
+    # AppTestは実行のたびにPagesManager.uses_pages_directoryを消すので、他のセッションの実行中に
+    # pages/を使わない実行になってウィジェットの状態が失われる。消す先をサブクラスにずらす
+    class PagesManager(app_test.PagesManager):
+        pass
+    app_test.PagesManager = PagesManager
+    PagesManager.__base__.uses_pages_directory = os.path.isdir(os.path.join(ROOT, "pages"))
+
+    # 同じく実行ごとに設定global.appTestをオン・オフするので、プロセス全体でオンのままにする
+    from streamlit import config
+    config.set_option("global.appTest", True)
+    app_test.patch_config_options = lambda options: contextlib.nullcontext()
+
+    # AppTestは全て同じsession_idで動くので、セッションごとの作業領域が分かれるようにスレッドごとのIDを使う
+    original_init = LocalScriptRunner.__init__
+
+    def init(self, *a, **kw):
+        original_init(self, *a, **kw)
+        self._session_id = getattr(_session, "id", self._session_id)
+
+    LocalScriptRunner.__init__ = init
+
+
+def percentile(values, p):
+    if not values: return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def child(args):
+    work = tempfile.mkdtemp(prefix="menu_player_loadtest_")
+    os.environ["MENU_PLAYER_CATALOG"] = os.path.join(work, "catalog")
+    os.environ["MENU_PLAYER_WORKSPACE"] = os.path.join(work, "sessions")
+    # 定型文の音声キャッシュは同じホストのアプリと共有の場所にあるので、スタブの音声を入れないよう作業ディレクトリに移す
+    os.environ["MENU_PLAYER_SEGMENT_CACHE"] = os.path.join(work, "segments")
+    if args.tts_pool is not None: os.environ["MENU_PLAYER_TTS_POOL"] = str(args.tts_pool)
+    sys.path.insert(0, ROOT)
+    os.chdir(work)
+    # st.secretsもAppTestの実行ごとに差し替えられるので、ファイルで渡す
+    os.makedirs(".streamlit")
+    with open(os.path.join(".streamlit", "secrets.toml"), "w") as f:
+        f.write('GEMINI_API_KEY = "stub"\n')
+    stats = StubStats()
+    install_stubs(args, stats)
+    share_test_runtime()
+    images = make_images(args.images, args.image_kb)
+    results = []
+    threads = [threading.Thread(target=run_session, args=(i, args, images, results)) for i in range(args.n)]
+    cpu0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.perf_counter() - t0
+    cpu1 = resource.getrusage(resource.RUSAGE_SELF)
+    shutil.rmtree(work, ignore_errors=True)
+    latencies = [r["latency"] for r in results if r["ok"]]
+    from menu_json import json_usage
+    print(json.dumps({
+        "sessions": args.n,
+        "runs": len(results),
+        "ok": len(latencies),
+        "wall_s": wall,
+        "throughput_per_min": len(latencies) / wall * 60 if wall else 0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "error_rate": 1 - len(latencies) / len(results) if results else 0,
+        "errors": sorted({r["error"] for r in results if r["error"]})[:3],
+        "llm_calls": stats.llm_calls,
+        "llm_quota_errors": stats.llm_quota,
+        "llm_truncated": stats.llm_truncated,
+        "json_continuations": json_usage()["continuations"],
+        "tts_requests": stats.tts_requests,
+        "tts_failure_rate": stats.tts_failures / stats.tts_requests if stats.tts_requests else 0,
+        "fallback_rate": stats.fallbacks / (stats.tts_requests - stats.tts_failures + stats.fallbacks) if stats.tts_requests else 0,
+        "tts_peak_concurrency": stats.tts_peak,
+        "tts_connects": stats.tts_connects,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cpu_util": (cpu1.ru_utime + cpu1.ru_stime - cpu0.ru_utime - cpu0.ru_stime) / wall if wall else 0,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", default="1,2,4,8", help="同時セッション数（カンマ区切りで段階的に増やす）")
+    parser.add_argument("--iterations", type=int, default=1, help="1セッションあたりの作成回数")
+    parser.add_argument("--flow", choices=["album", "url"], default="album")
+    parser.add_argument("--images", type=int, default=3)
+    parser.add_argument("--image-kb", type=int, default=500)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--voices", type=int, default=1, help="1回の作成で生成する声・言語の数")
+    parser.add_argument("--llm-sec", type=float, default=2.0, help="AI解析1回あたりの待ち時間（スタブ）")
+    parser.add_argument("--llm-truncate-rate", type=float, default=0.0, help="解析の出力を途中で切る割合（スタブ）")
+    parser.add_argument("--llm-quota-rate", type=float, default=0.0, help="flashのモデルの呼び出しを利用上限（429）にする割合（スタブ）")
+    parser.add_argument("--tts-sec", type=float, default=0.3, help="音声合成1トラックあたりの待ち時間（スタブ）")
+    parser.add_argument("--tts-connect-sec", type=float, default=0.15, help="edge-ttsへの接続（TLS・WebSocket）1回あたりの待ち時間（スタブ）")
+    parser.add_argument("--tts-pool", type=int, help="edge-ttsの接続プールの大きさ（0で使わない。省略時はアプリの既定値）")
+    parser.add_argument("--tts-fail-rate", type=float, default=0.0)
+    parser.add_argument("--tts-server-limit", type=int, default=0, help="これを超える同時合成を失敗させる（0は無制限）")
+    parser.add_argument("--mp3-kb", type=int, default=300)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("-n", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    rows = []
+    for n in [int(s) for s in args.sessions.split(",")]:
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", "-n", str(n)] + [a for a in sys.argv[1:] if a != "--json"]
+        out = subprocess.run(cmd, capture_output=True, text=True, cwd=ROOT)
+        lines = out.stdout.strip().splitlines()
+        if out.returncode or not lines:
+            print(f"sessions={n}: failed\n{out.stderr[-2000:]}", file=sys.stderr)
+            continue
+        rows.append(json.loads(lines[-1]))
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+        return
+
+    print(f"flow={args.flow} images={args.images} categories={args.categories} voices={args.voices} "
+          f"llm={args.llm_sec}s tts={args.tts_sec}s/track mp3={args.mp3_kb}KB")
+    print(f"{'N':>4} {'ok/runs':>8} {'thr/min':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'err%':>6} {'llm429':>6} {'cut/cont':>8} {'ttsfail%':>8} {'fallbk%':>7} {'tts∥':>5} {'conn':>5} {'RSS MB':>7} {'CPU':>5}")
+    for r in rows:
+        print(f"{r['sessions']:>4} {str(r['ok']) + '/' + str(r['runs']):>8} {r['throughput_per_min']:8.1f} {r['p50_s']:7.2f} {r['p95_s']:7.2f} {r['p99_s']:7.2f} "
+              f"{r['error_rate'] * 100:6.1f} {r['llm_quota_errors']:>6} {str(r['llm_truncated']) + '/' + str(r['json_continuations']):>8} {r['tts_failure_rate'] * 100:8.1f} {r['fallback_rate'] * 100:7.1f} {r['tts_peak_concurrency']:>5} {r['tts_connects']:>5} {r['peak_rss_mb']:7.0f} {r['cpu_util']:5.2f}")
+        for e in r["errors"]:
+            print(f"       error: {e[:120]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# 音声合成用に、プロセス内で1つだけ動かし続けるイベントループ
+# - 専用スレッドでループを回し、各セッションのスクリプトスレッドからスレッドセーフに処理を投入する
+# - 全セッション共通の同時実行枠（TTS_GLOBAL_CONCURRENCY）で、合成の同時リクエスト数を抑える
+# - クリックごとに asyncio.run で新しいループを作らないので、nest_asyncio は不要
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+TTS_GLOBAL_CONCURRENCY = int(os.environ.get("MENU_PLAYER_TTS_CONCURRENCY", "16"))
+CANCEL_GRACE = 2.0
+
+
+class TTSLoop:
+    def __init__(self, concurrency=TTS_GLOBAL_CONCURRENCY):
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.sem = asyncio.Semaphore(concurrency)
+        # 以下のカウンタはループのスレッドだけが更新する
+        self.jobs = 0
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.thread = threading.Thread(target=self._run, name="tts-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def slot(self, coro):
+        # 全セッション共通の枠が空くまで待ってから実行する
+        self.waiting += 1
+        try:
+            await self.sem.acquire()
+        except BaseException:
+            # 枠を待つ間に取り消された合成は、実行しないまま閉じる
+            coro.close()
+            raise
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            return await coro
+        finally:
+            self.sem.release()
+            self.active -= 1
+            self.completed += 1
+
+    async def _job(self, coro, finished=None):
+        self.jobs += 1
+        try:
+            return await coro
+        finally:
+            self.jobs -= 1
+            if finished: finished.set()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(self._job(coro), self.loop)
+
+    def run(self, coro, on_wait=None, interval=0.2, grace=CANCEL_GRACE):
+        # 呼び出し元のスレッドで完了を待つ。待っている間は on_wait で進捗表示などを更新できる
+        # 呼び出し元が例外で抜けたとき（Streamlitの中止・再実行・切断など）は合成も取り消し、止まるまで少し待つ
+        finished = threading.Event()
+        future = asyncio.run_coroutine_threadsafe(self._job(coro, finished), self.loop)
+        try:
+            while True:
+                try:
+                    return future.result(timeout=interval)
+                except concurrent.futures.TimeoutError:
+                    if on_wait: on_wait()
+        except BaseException:
+            if not future.done():
+                future.cancel()
+                finished.wait(grace)
+            raise
+
+    def usage(self):
+        return {
+            "jobs": self.jobs,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "concurrency": self.concurrency,
+        }
@@ -0,0 +1,183 @@
+# edge-tts の接続プール
+# - edge_tts.Communicate は合成ごとにTLS・WebSocketの接続からやり直すので、短いチャプターでは接続の時間が大きな割合を占める
+# - 1本のWebSocketの上で合成要求を順に送り、終わった接続はプールへ戻して次の合成で使い回す
+# - 使い回す前に、閉じていないか・古すぎないか・使った回数・放置時間を確かめ、外れた接続は閉じて作り直す（recycled）
+# - 送受信に失敗した接続は捨てる。使い回した接続で失敗したときは、新しい接続で1回だけやり直す
+# - AI解析の間などに warm() で接続を先に開いておける
+# - 使い回しが続けて失敗するなら（サービス側が1接続1要求に戻ったなど）、使い回しをやめて毎回接続する
+# - プロトコルは edge_tts の内部（communicate モジュール）の関数と定数で組み立てるので、requirements.txt の edge-tts の版に固定している
+#   既定では使わない（MENU_PLAYER_TTS_POOL=0）。合成に失敗したら、menu_pipeline.synthesize_edge が edge_tts.Communicate に切り替える
+# - 共有イベントループ（TTSLoop）の中だけで使う
+import asyncio
+import os
+import time
+from xml.sax.saxutils import escape
+
+import aiohttp
+from edge_tts import communicate as edge
+from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS, WSS_URL
+from edge_tts.data_classes import TTSConfig
+from edge_tts.drm import DRM
+
+TTS_POOL_SIZE = int(os.environ.get("MENU_PLAYER_TTS_POOL", "0"))  # 1以上でプールを使う（8くらい）
+MAX_AGE = 240.0  # 秒。接続時の認証トークン（Sec-MS-GEC）は5分単位なので、その前に作り直す
+MAX_USES = 50
+IDLE_TIMEOUT = 60.0  # AI解析の間に開いておいた接続を、解析が終わるまで持たせる
+HEARTBEAT = 15.0  # 放置中の接続にもpingを送り、応答がなければaiohttpが閉じる（closedで分かる）
+CONNECT_TIMEOUT = 10
+RECEIVE_TIMEOUT = 60
+REUSE_FAILURE_LIMIT = 3
+SPEECH_CONFIG = (
+    "Content-Type:application/json; charset=utf-8\r\n"
+    "Path:speech.config\r\n\r\n"
+    '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+    '"sentenceBoundaryEnabled":"false","wordBoundaryEnabled":"false"},'
+    '"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}\r\n'
+)
+
+
+class TTSConnectionError(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, ws):
+        self.ws = ws
+        self.created = self.last_used = time.monotonic()
+        self.uses = 0
+
+    def healthy(self, max_age=MAX_AGE, max_uses=MAX_USES, idle_timeout=IDLE_TIMEOUT):
+        now = time.monotonic()
+        return (not self.ws.closed and self.ws.exception() is None and now - self.created < max_age
+                and self.uses < max_uses and now - self.last_used < idle_timeout)
+
+    async def synthesize(self, text, voice_code, rate_value, filename):
+        # 4096バイトを超える文は edge_tts と同じ位置で分け、1つのファイルへ続けて書く
+        config = TTSConfig(voice_code, rate_value, "+0%", "+0Hz", "SentenceBoundary")
+        received = 0
+        with open(filename, "wb") as f:
+            for chunk in edge.split_text_by_byte_length(escape(edge.remove_incompatible_characters(text)), 4096):
+                await self.ws.send_str(edge.ssml_headers_plus_data(edge.connect_id(), edge.date_to_string(), edge.mkssml(config, chunk)))
+                received += await self._receive_turn(f)
+        self.uses += 1
+        self.last_used = time.monotonic()
+        if not received: raise TTSConnectionError("音声が返ってきませんでした")
+        return received
+
+    async def _receive_turn(self, f):
+        received = 0
+        while True:
+            msg = await self.ws.receive(timeout=RECEIVE_TIMEOUT)
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                data = msg.data.encode("utf-8")
+                headers, _ = edge.get_headers_and_data(data, data.find(b"\r\n\r\n"))
+                if headers.get(b"Path") == b"turn.end": return received
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                if len(msg.data) < 2: raise TTSConnectionError("音声のヘッダーが壊れています")
+                headers, data = edge.get_headers_and_data(msg.data, int.from_bytes(msg.data[:2], "big"))
+                if headers.get(b"Path") == b"audio" and headers.get(b"Content-Type") == b"audio/mpeg" and data:
+                    f.write(data)
+                    received += len(data)
+            else:
+                raise TTSConnectionError(f"接続が閉じられました（{msg.type.name}）")
+
+    async def close(self):
+        if not self.ws.closed: await self.ws.close()
+
+
+class TTSPool:
+    def __init__(self, size=TTS_POOL_SIZE):
+        self.size = size
+        self.session = None
+        self.idle = []
+        self.reuse = True
+        self.reuse_failures = 0
+        self.warming = 0
+        self.stats = {"requests": 0, "opened": 0, "reused": 0, "recycled": 0, "broken": 0, "warmed": 0,
+                      "connect_sec": 0.0, "synth_sec": 0.0}
+
+    def _url(self):
+        return f"{WSS_URL}&ConnectionId={edge.connect_id()}&Sec-MS-GEC={DRM.generate_sec_ms_gec()}&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}"
+
+    async def _connect(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(trust_env=True, timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT))
+        t0 = time.perf_counter()
+        for attempt in range(2):
+            try:
+                ws = await self.session.ws_connect(self._url(), compress=15, heartbeat=HEARTBEAT,
+                                                   headers=DRM.headers_with_muid(WSS_HEADERS), ssl=edge._SSL_CTX)
+                break
+            except aiohttp.WSServerHandshakeError as e:
+                # 時計のずれで認証に失敗したときは、edge_tts と同じく補正して1回だけやり直す
+                if e.status != 403 or attempt: raise
+                DRM.handle_client_response_error(e)
+        await ws.send_str(f"X-Timestamp:{edge.date_to_string()}\r\n" + SPEECH_CONFIG)
+        self.stats["opened"] += 1
+        self.stats["connect_sec"] += time.perf_counter() - t0
+        return PooledConnection(ws)
+
+    async def _acquire(self):
+        while self.idle:
+            conn = self.idle.pop()  # 最後に使った接続ほど生きている可能性が高い
+            if conn.healthy():
+                self.stats["reused"] += 1
+                return conn, True
+            self.stats["recycled"] += 1
+            await conn.close()
+        return await self._connect(), False
+
+    async def _release(self, conn):
+        if self.reuse and len(self.idle) < self.size and conn.healthy():
+            self.idle.append(conn)
+        else:
+            await conn.close()
+
+    async def warm(self, n):
+        # 合成が始まる前に、空いている接続がn本（プールの大きさまで）になるよう開いておく
+        # 他のセッションが開いている途中の分も数えて、開きすぎないようにする
+        n = min(n, self.size) - len(self.idle) - self.warming
+        if not self.reuse or n <= 0: return 0
+        self.warming += n
+        try:
+            conns = await asyncio.gather(*[self._connect() for _ in range(n)], return_exceptions=True)
+        finally:
+            self.warming -= n
+        conns = [conn for conn in conns if not isinstance(conn, BaseException)]
+        for conn in conns: await self._release(conn)
+        self.stats["warmed"] += len(conns)
+        return len(conns)
+
+    async def synthesize(self, text, voice_code, rate_value, filename):
+        self.stats["requests"] += 1
+        for attempt in range(2):
+            conn, reused = await self._acquire()
+            t0 = time.perf_counter()
+            try:
+                await conn.synthesize(text, voice_code, rate_value, filename)
+            except BaseException as e:
+                # 途中で止まった接続には読み残しがあるので、中断でも失敗でも捨てる
+                self.stats["broken"] += 1
+                await conn.close()
+                if not (reused and isinstance(e, (TTSConnectionError, aiohttp.ClientError, ConnectionError)) and attempt == 0):
+                    raise
+                self.reuse_failures += 1
+                if self.reuse_failures >= REUSE_FAILURE_LIMIT and self.reuse:
+                    self.reuse = False
+                    await self.clear()
+                continue
+            self.stats["synth_sec"] += time.perf_counter() - t0
+            if reused: self.reuse_failures = 0
+            await self._release(conn)
+            return True
+
+    async def clear(self):
+        idle, self.idle = self.idle, []
+        for conn in idle: await conn.close()
+
+    async def close(self):
+        await self.clear()
+        if self.session and not self.session.closed: await self.session.close()
+
+    def usage(self):
+        return {**self.stats, "idle": len(self.idle), "reuse": self.reuse}